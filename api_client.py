@@ -0,0 +1,40 @@
+"""
+Client HTTP del server API (api_server.py), usato dalle app Streamlit.
+
+Le app non eseguono la pipeline di chat: leggono la cronologia della sessione
+e ricevono la risposta token per token (server-sent events) dal server.
+"""
+import json
+
+import requests
+
+
+def load_history(api_url, session_id):
+    """Cronologia compatta della sessione (messaggi e URL delle fonti) conservata dal server."""
+    response = requests.get(f"{api_url}/sessions/{session_id}", timeout=10)
+    response.raise_for_status()
+    return response.json()["messages"]
+
+
+def stream_answer(api_url, session_id, message, result):
+    """
+    Invia la domanda al server e restituisce i token della risposta man mano
+    che arrivano (server-sent events); fonti ed eventuale errore finiscono in `result`.
+    """
+    with requests.post(
+        f"{api_url}/chat", json={"session_id": session_id, "message": message}, stream=True, timeout=(10, 300)
+    ) as response:
+        response.raise_for_status()
+        response.encoding = "utf-8"
+        event = None
+        for line in response.iter_lines(decode_unicode=True):
+            if line.startswith("event: "):
+                event = line[len("event: "):]
+            elif line.startswith("data: "):
+                data = json.loads(line[len("data: "):])
+                if event == "token":
+                    yield data["delta"]
+                elif event == "sources":
+                    result["sources"] = data["sources"]
+                elif event == "error":
+                    result["error"] = data["error"]
@@ -0,0 +1,299 @@
+"""
+Server HTTP asincrono (aiohttp) con la pipeline di chat di AskDIEM.
+
+Le componenti del motore (ChatEngineComponents) sono costruite una volta per
+processo; ogni richiesta crea un motore leggero sulla memoria della sessione
+e ne trasmette la risposta token per token come server-sent events. Le
+sessioni sono identificate da un ID e conservate da session_store.py; le
+richieste della stessa sessione vengono servite una alla volta.
+
+Con API_WORKERS > 1 vengono avviati più processi in ascolto sulla stessa
+porta (SO_REUSEPORT) e le sessioni sono condivise tramite il file SQLite.
+
+Endpoint:
+    POST   /sessions        -> {"session_id": ...}
+    GET    /sessions/{id}   -> {"session_id": ..., "messages": [...]}
+    DELETE /sessions/{id}   -> azzera la cronologia della sessione
+    POST   /chat            -> stream SSE; corpo JSON {"message": ..., "session_id": ... (opzionale)}
+    GET    /health
+
+Eventi SSE di /chat, con dati JSON:
+    session  {"session_id"}     (sempre per primo)
+    token    {"delta"}
+    sources  {"sources": [url, ...]}
+    done     {"answer"}
+    error    {"error"}
+"""
+import asyncio
+import datetime
+import json
+import multiprocessing
+import os
+import uuid
+import weakref
+
+from aiohttp import web
+from babel.dates import format_datetime
+from dotenv import load_dotenv
+from google.generativeai.types import HarmCategory, HarmBlockThreshold
+from llama_index.core import VectorStoreIndex, Settings
+from llama_index.embeddings.huggingface_api import HuggingFaceInferenceAPIEmbedding
+from llama_index.llms.google_genai import GoogleGenAI
+from llama_index.postprocessor.cohere_rerank import CohereRerank
+from llama_index.vector_stores.qdrant import QdrantVectorStore
+from qdrant_client import AsyncQdrantClient, QdrantClient
+
+from askdiem_engine import build_chat_components, source_urls
+from chat_cache import get_answer_cache, get_retrieval_cache
+from embedding_cache import CachedEmbedding, get_query_embedding_cache
+from local_embedding import local_embedding_from_env
+from qdrant_utils import collection_has_sparse, get_alias_target, hybrid_vector_store_kwargs
+from rerank import local_reranker_from_env
+from session_store import get_session_store
+
+load_dotenv()
+API_HOST = os.getenv("API_HOST", "0.0.0.0")
+API_PORT = int(os.getenv("API_PORT", 8000))
+API_WORKERS = int(os.getenv("API_WORKERS", 1))
+# "api" (HuggingFace Inference API) oppure "local" (bge-m3 ONNX int8 su CPU)
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "api")
+QDRANT_URL = os.getenv("QDRANT_URL", "https://e542824d-6590-4005-91db-6dd34bf8f471.eu-west-2-0.aws.cloud.qdrant.io:6333")
+QDRANT_COLLECTION_ALIAS = os.getenv("QDRANT_COLLECTION_ALIAS", "diem_chatbot")
+# Secondi fra i controlli della collezione puntata dall'alias (0: mai, serve un riavvio dopo --rebuild)
+ALIAS_CHECK_INTERVAL = int(os.getenv("ALIAS_CHECK_INTERVAL", 60))
+# "cohere" (API) oppure "local" (cross-encoder ONNX int8 su CPU)
+RERANKER_BACKEND = os.getenv("RERANKER_BACKEND", "cohere")
+# Nodi passati all'LLM dopo il riordino (minore dei candidati: il rerank deve anche potare)
+RERANK_TOP_N = int(os.getenv("RERANK_TOP_N", 6))
+# Token (stimati) di contesto passati all'LLM a ogni turno, dopo la compressione
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", 12000))
+# Turni recenti usati per condensare le domande non autonome (0: condensa sempre, sull'intera memoria)
+CONDENSE_HISTORY_TURNS = int(os.getenv("CONDENSE_HISTORY_TURNS", 3))
+# Retrieval e rerank sulla domanda originale in parallelo alla condensazione (usati se la domanda non cambia)
+SPECULATIVE_RETRIEVAL = os.getenv("SPECULATIVE_RETRIEVAL", "0") == "1"
+SPECULATIVE_RETRIEVAL_THRESHOLD = float(os.getenv("SPECULATIVE_RETRIEVAL_THRESHOLD", 0.95))
+
+# Imposta i filtri al livello più basso (BLOCK_NONE)
+safety_settings = {
+    HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
+    HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
+    HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
+    HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
+}
+
+
+def load_models():
+    """LLM, modello di embedding e reranker: caricati una volta per processo."""
+    Settings.llm = GoogleGenAI(
+        model="gemini-2.5-flash",
+        api_key=os.getenv("GOOGLE_API_KEY"),
+        temperature=0.5,
+        safety_settings=safety_settings,
+    )
+
+    if EMBEDDING_BACKEND == "local":
+        base_embed_model = local_embedding_from_env()
+    else:
+        base_embed_model = HuggingFaceInferenceAPIEmbedding(
+            model_name="BAAI/bge-m3",
+            token=os.getenv("HUGGINGFACE_API_KEY"),
+        )
+    # Le domande ripetute (anche da sessioni diverse) non ricalcolano l'embedding
+    Settings.embed_model = CachedEmbedding(base_embed_model, query_cache=get_query_embedding_cache())
+
+    if RERANKER_BACKEND == "local":
+        reranker = local_reranker_from_env(top_n=RERANK_TOP_N)
+    else:
+        reranker = CohereRerank(api_key=os.getenv("COHERE_API_KEY"), top_n=RERANK_TOP_N)
+    return base_embed_model, reranker
+
+
+def load_chat_components(base_embed_model, reranker, qdrant_client, qdrant_aclient):
+    """
+    Indice e componenti del motore di chat, condivisi da tutte le richieste del
+    processo, per la collezione a cui punta ora l'alias. Restituisce
+    (collezione, componenti).
+    """
+    # La collezione concreta, non l'alias: modalità ibrida e nomi dei vettori dipendono
+    # dalla sua configurazione; watch_alias ricrea le componenti quando l'alias si sposta
+    collection_name = get_alias_target(qdrant_client, QDRANT_COLLECTION_ALIAS) or "diem_chatbot3_v2"
+    vector_store_kwargs = {}
+    sparse_encoder = None
+    if getattr(base_embed_model, "supports_sparse", False) and collection_has_sparse(qdrant_client, collection_name):
+        # Ricerca ibrida: vettore denso + pesi lessicali di bge-m3 (codici, cognomi), fusi con RRF
+        sparse_encoder = base_embed_model.encode_sparse
+        vector_store_kwargs = hybrid_vector_store_kwargs(sparse_encoder)
+    print(f"Collezione '{collection_name}' ({'ibrida' if sparse_encoder else 'solo densa'}).")
+    vector_store = QdrantVectorStore(
+        client=qdrant_client, aclient=qdrant_aclient, collection_name=collection_name, **vector_store_kwargs
+    )
+    vector_index = VectorStoreIndex.from_vector_store(vector_store=vector_store)
+
+    return collection_name, build_chat_components(
+        vector_index,
+        reranker,
+        context_token_budget=CONTEXT_TOKEN_BUDGET,
+        condense_history_turns=CONDENSE_HISTORY_TURNS,
+        speculative_retrieval=SPECULATIVE_RETRIEVAL,
+        speculation_threshold=SPECULATIVE_RETRIEVAL_THRESHOLD,
+        # Vettore sparso della domanda calcolato in un thread, non sul ciclo degli eventi
+        sparse_encoder=sparse_encoder,
+        answer_cache=get_answer_cache(qdrant_client),
+        retrieval_cache=get_retrieval_cache(collection_name, qdrant_client),
+        verbose=True,
+    )
+
+
+async def watch_alias(app):
+    """
+    Controlla ogni ALIAS_CHECK_INTERVAL secondi la collezione a cui punta l'alias:
+    dopo uno spostamento (update.py --rebuild o --rollback) le componenti vengono
+    ricreate, riconoscendo anche se la nuova collezione ha il vettore sparso. Le
+    richieste in corso terminano sulla collezione precedente.
+    """
+    qdrant_client = app["qdrant_clients"][0]
+    while True:
+        await asyncio.sleep(ALIAS_CHECK_INTERVAL)
+        try:
+            target = await asyncio.to_thread(get_alias_target, qdrant_client, QDRANT_COLLECTION_ALIAS)
+            if target is None or target == app["pipeline"]["collection_name"]:
+                continue
+            print(f"L'alias '{QDRANT_COLLECTION_ALIAS}' punta ora a '{target}': ricreo le componenti.")
+            collection_name, chat_components = await asyncio.to_thread(
+                load_chat_components, *app["models"], *app["qdrant_clients"]
+            )
+            app["pipeline"].update(collection_name=collection_name, chat_components=chat_components)
+        except Exception as e:
+            print(f"Errore durante il controllo dell'alias '{QDRANT_COLLECTION_ALIAS}': {e}")
+
+
+async def alias_watcher(app):
+    task = asyncio.create_task(watch_alias(app))
+    yield
+    task.cancel()
+
+
+def session_lock(request, session_id):
+    """Lock della sessione: i turni della stessa sessione non si sovrappongono (la memoria è condivisa)."""
+    locks = request.app["session_locks"]
+    lock = locks.get(session_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        locks[session_id] = lock
+    return lock
+
+
+async def send_event(response, event, data):
+    await response.write(f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8"))
+
+
+async def create_session(request):
+    return web.json_response({"session_id": uuid.uuid4().hex})
+
+
+async def get_session(request):
+    session_id = request.match_info["session_id"]
+    chat_session = await asyncio.to_thread(get_session_store().get, session_id)
+    return web.json_response({"session_id": session_id, "messages": chat_session.messages})
+
+
+async def reset_session(request):
+    session_id = request.match_info["session_id"]
+    async with session_lock(request, session_id):
+        store = get_session_store()
+        chat_session = await asyncio.to_thread(store.get, session_id)
+        await asyncio.to_thread(store.reset, chat_session)
+    return web.json_response({"session_id": session_id})
+
+
+async def chat(request):
+    try:
+        body = await request.json()
+    except json.JSONDecodeError:
+        raise web.HTTPBadRequest(text="Corpo della richiesta non valido: atteso JSON.")
+    message = (body.get("message") or "").strip()
+    if not message:
+        raise web.HTTPBadRequest(text="Il campo 'message' è obbligatorio.")
+    session_id = body.get("session_id") or uuid.uuid4().hex
+
+    response = web.StreamResponse(headers={
+        "Content-Type": "text/event-stream",
+        "Cache-Control": "no-cache",
+        # Niente buffering nei reverse proxy (nginx): i token arrivano subito
+        "X-Accel-Buffering": "no",
+    })
+    await response.prepare(request)
+    await send_event(response, "session", {"session_id": session_id})
+
+    async with session_lock(request, session_id):
+        store = get_session_store()
+        chat_session = await asyncio.to_thread(store.get, session_id)
+        current_date_str = format_datetime(datetime.datetime.now(), format="EEEE, d MMMM yyyy", locale="it_IT")
+        chat_engine = request.app["pipeline"]["chat_components"].create_engine(chat_session.memory, current_date_str)
+        try:
+            streaming_response = await chat_engine.astream_chat(message)
+            answer = ""
+            async for token in streaming_response.async_response_gen():
+                answer += token
+                await send_event(response, "token", {"delta": token})
+        except ConnectionResetError:
+            # Il client si è disconnesso: il turno non viene salvato
+            return response
+        except Exception as e:
+            print(f"Errore durante la risposta per la sessione {session_id}: {e}")
+            await send_event(response, "error", {"error": str(e)})
+            await response.write_eof()
+            return response
+        urls = source_urls(streaming_response.source_nodes)
+        await asyncio.to_thread(store.record_turn, chat_session, message, answer, urls)
+
+    await send_event(response, "sources", {"sources": urls})
+    await send_event(response, "done", {"answer": answer})
+    await response.write_eof()
+    return response
+
+
+async def health(request):
+    return web.json_response({"status": "ok"})
+
+
+def create_app():
+    app = web.Application()
+    app["models"] = load_models()
+    # Client sincrono per la configurazione, asincrono per le query servite dal ciclo degli eventi
+    app["qdrant_clients"] = (
+        QdrantClient(url=QDRANT_URL, api_key=os.getenv("QDRANT__API_KEY")),
+        AsyncQdrantClient(url=QDRANT_URL, api_key=os.getenv("QDRANT__API_KEY")),
+    )
+    collection_name, chat_components = load_chat_components(*app["models"], *app["qdrant_clients"])
+    # Dizionario mutabile: watch_alias sostituisce le componenti con il server avviato
+    app["pipeline"] = {"collection_name": collection_name, "chat_components": chat_components}
+    if ALIAS_CHECK_INTERVAL > 0:
+        app.cleanup_ctx.append(alias_watcher)
+    # Un lock resta in vita finché una richiesta della sessione lo usa
+    app["session_locks"] = weakref.WeakValueDictionary()
+    app.add_routes([
+        web.post("/sessions", create_session),
+        web.get("/sessions/{session_id}", get_session),
+        web.delete("/sessions/{session_id}", reset_session),
+        web.post("/chat", chat),
+        web.get("/health", health),
+    ])
+    return app
+
+
+def run_worker(reuse_port):
+    web.run_app(create_app(), host=API_HOST, port=API_PORT, reuse_port=reuse_port)
+
+
+if __name__ == "__main__":
+    if API_WORKERS <= 1:
+        run_worker(reuse_port=False)
+    else:
+        # Le sessioni passano dal file SQLite: il turno successivo può arrivare a un altro processo
+        os.environ.setdefault("SESSION_SHARED", "1")
+        workers = [multiprocessing.Process(target=run_worker, args=(True,)) for _ in range(API_WORKERS)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
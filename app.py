@@ -1,54 +1,9 @@
 import streamlit as st
-import datetime
-from babel.dates import format_datetime
-from llama_index.core import (
-    VectorStoreIndex,
-    Settings
-)
-from llama_index.vector_stores.qdrant import QdrantVectorStore
-from llama_index.embeddings.huggingface_api import HuggingFaceInferenceAPIEmbedding
-from llama_index.llms.google_genai import GoogleGenAI
-from qdrant_client import QdrantClient
-from llama_index.core.memory import ChatMemoryBuffer
-from llama_index.core.chat_engine import CondensePlusContextChatEngine
-from llama_index.postprocessor.cohere_rerank import CohereRerank
-from llama_index.core.postprocessor import SimilarityPostprocessor
+import itertools
 import os
+import uuid
 from dotenv import load_dotenv
-from google.generativeai.types import HarmCategory, HarmBlockThreshold
-
-from llama_index.core.postprocessor.types import BaseNodePostprocessor
-from typing import List
-
-# --- CLASSE POST-PROCESSOR PERSONALIZZATA ---
-class KeepAtLeastOneNodePostprocessor(BaseNodePostprocessor):
-    """
-    Un post-processore personalizzato che "avvolge" altri post-processori 
-    per garantire che, se il retriever aveva originariamente trovato dei nodi,
-    almeno uno venga sempre restituito per evitare che il ChatEngine fallisca.
-    """
-    postprocessors: List[BaseNodePostprocessor]
-
-    def _postprocess_nodes(self, nodes, query_str):
-        """
-        Applica la logica di post-processing.
-        """
-        if not nodes:
-            # Se il retriever non ha trovato nulla, restituisce una lista vuota.
-            return []
-        
-        # Salviamo un riferimento al nodo migliore prima di applicare i filtri.
-        best_node = nodes[0] 
-        
-        # Applica tutti i post-processori "avvolti"
-        processed_nodes = nodes
-        for pp in self.postprocessors:
-            processed_nodes = pp.postprocess_nodes(processed_nodes, query_str=query_str)
-        
-        if not processed_nodes:
-            return [best_node]
-        
-        return processed_nodes
+from api_client import load_history, stream_answer
 
 # --- 0. DIZIONARIO PER LE TRADUZIONI ---
 TRANSLATIONS = {
@@ -95,11 +50,9 @@ selected_language = st.sidebar.selectbox(
     index=["Italiano", "English"].index(st.session_state.language)
 )
 
-# Se la lingua cambia, aggiorna lo stato e resetta i messaggi
+# Se la lingua cambia, aggiorna lo stato (il messaggio iniziale segue la nuova lingua)
 if st.session_state.language != selected_language:
     st.session_state.language = selected_language
-    if "messages" in st.session_state and len(st.session_state.messages) <= 1:
-        st.session_state.messages = None 
     st.rerun()
 
 # Carica i testi dell'interfaccia nella lingua corretta
@@ -113,202 +66,55 @@ st.set_page_config(
 )
 
 load_dotenv()
-os.environ['GOOGLE_API_KEY'] = os.getenv("GOOGLE_API_KEY")
-os.environ['COHERE_API_KEY'] = os.getenv("COHERE_API_KEY")
-os.environ['QDRANT__API_KEY'] = os.getenv("QDRANT__API_KEY")
-os.environ['HF_TOKEN'] = os.getenv("HUGGINGFACE_API_KEY")
-
-# Imposta i filtri al livello più basso (BLOCK_NONE)
-safety_settings = {
-    HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
-    HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
-    HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
-    HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
-}
-
-@st.cache_resource(show_spinner=False)
-def load_index():
-    """Carica i dati, inizializza i modelli e costruisce l'indice."""
-
-    with st.spinner(ui_texts["spinner_message"]):
-        Settings.llm = GoogleGenAI(
-            model="gemini-2.5-flash",
-            api_key=os.environ['GOOGLE_API_KEY'],
-            temperature=0.5,
-            safety_settings=safety_settings,
-        )
-
-        Settings.embed_model = HuggingFaceInferenceAPIEmbedding(
-            model_name="BAAI/bge-m3",
-            token=os.environ['HF_TOKEN'],
-        )
-
-        qdrant_client = QdrantClient(
-            url="https://e542824d-6590-4005-91db-6dd34bf8f471.eu-west-2-0.aws.cloud.qdrant.io:6333", 
-            api_key=os.environ['QDRANT__API_KEY'],
-        )
-
-        vector_store = QdrantVectorStore(client=qdrant_client, collection_name="diem_chatbot3_v2")
-
-        vector_index = VectorStoreIndex.from_vector_store(vector_store=vector_store)
-
-        return vector_index
-
-vector_index = load_index()
+# Indirizzo del server API (api_server.py) che esegue la pipeline di chat
+ASKDIEM_API_URL = os.getenv("ASKDIEM_API_URL", "http://localhost:8000").rstrip("/")
 
 # --- 2. GESTIONE DELLA CHAT ---
 
 st.title(ui_texts["title"])
 st.caption(ui_texts["caption"])
 
-SYSTEM_PROMPT_TEMPLATE = (
-    """Il tuo nome è AskDIEM, sei un assistente virtuale dell'Università di Salerno, specializzato nell'aiutare gli studenti del Dipartimento di Ingegneria dell'Informazione ed Elettrica e Matematica Applicata (DIEM).
+# La sessione Streamlit conserva solo l'ID: cronologia e memoria sono sul server
+if "session_id" not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex
 
-    Il tuo obiettivo è fornire risposte accurate basandoti esclusivamente sulle informazioni ufficiali che ti vengono fornite.
-    Tieni presente che oggi è: {current_date}.
+# Il messaggio iniziale non fa parte della cronologia: segue sempre la lingua scelta
+with st.chat_message("assistant"):
+    st.write(ui_texts["initial_message"])
 
-    REGOLE GENERALI:
-    - *IMPORTANTE*: Se la domanda ti viene posta in inglese rispondi in inglese, a prescindere dalla lingua dei messaggi precedenti o da quella del contesto fornito.
-    - A meno che nella domanda non venga specificato un anno o una data in particolare, rispondi sempre tenendo presente la data di oggi.
-    - Se nomini un evento, adegua i tempi verbali in base alla data attuale.
-    - Se non disponi delle informazioni necessarie per rispondere a una domanda, dichiara chiaramente: "Non dispongo delle informazioni necessarie per rispondere a questa domanda."
-    - Non inventare mai informazioni, contatti, date o procedure. La tua priorità è l'accuratezza."""
-)
-
-if "chat_engine" not in st.session_state:
-
-    context_prompt = (
-        """Date le seguenti informazioni estratte dai documenti ufficiali e la domanda dell'utente, fornisci una risposta chiara ed esaustiva.
-
-        Contesto:
-        {context_str}
-
-        Istruzioni per la risposta:
-        - Se il contesto è presente ED È RILEVANTE per la domanda, basa la tua risposta su di esso.
-        - Se il contesto è vuoto o NON È RILEVANTE per la domanda (ad esempio, se la domanda è un saluto, "come ti chiami?", o una domanda conversazionale generica), rispondi alla domanda usando la tua conoscenza generale e seguendo la tua personalità definita nel system prompt.
-        
-        - ISTRUZIONE PER I LINK: Se nel contesto è presente una risorsa rilevante (come un PDF di un bando, una graduatoria o una pagina web) che supporta la tua risposta, devi citarla usando il formato Markdown: [Titolo Significativo](URL).
-        - Il "Titolo Significativo" dovrebbe essere il titolo del documento (es. 'Bando Collaborazioni studentesche 2024') che trovi nel contesto.
-        - L' "URL" è l'indirizzo web (source_url) associato a quel titolo.
-        
-        - Esempio di formato CORRETTO:
-        Per maggiori dettagli, puoi consultare il [Bando per Collaborazioni Studentesche](https://www.unisa.it/bando-collaborazioni-...).
-        
-        - Esempio di formato ERRATO (da non usare):
-        Per maggiori dettagli, puoi consultare https://www.unisa.it/bando-collaborazioni-...
-        
-        - Non includere link o titoli che non siano esplicitamente presenti nel contesto.
-
-        Domanda: {query_str}
-        Risposta:
-        """
-    )
-
-    # Definiamo i post-processori che vogliamo filtrare
-    filtering_postprocessors = [
-        SimilarityPostprocessor(similarity_cutoff=0.15)
-    ]
-    
-    st.session_state.chat_engine = CondensePlusContextChatEngine.from_defaults(
-        retriever=vector_index.as_retriever(similarity_top_k=15),
-        memory=ChatMemoryBuffer.from_defaults(token_limit=50000),
-        system_prompt=SYSTEM_PROMPT_TEMPLATE,
-        context_prompt=context_prompt,
-        node_postprocessors=[
-            CohereRerank(api_key=os.environ['COHERE_API_KEY'], top_n=15), 
-            KeepAtLeastOneNodePostprocessor(postprocessors=filtering_postprocessors)
-        ],
-        verbose=True,
-    )
-
-if "messages" not in st.session_state or st.session_state.messages is None:
-    st.session_state.messages = [{
-        "role": "assistant",
-        "content": ui_texts["initial_message"]
-    }]
-
-for message in st.session_state.messages:
+for message in load_history(ASKDIEM_API_URL, st.session_state.session_id):
     with st.chat_message(message["role"]):
         st.write(message["content"])
 
-        # Se il messaggio è dell'assistente e contiene fonti, mostrale
-        if message["role"] == "assistant" and "sources" in message and message["sources"]:
+        # Se il messaggio è dell'assistente e contiene fonti (URL già unici), mostrale
+        if message["role"] == "assistant" and message.get("sources"):
             with st.expander(ui_texts["sources_expander"]):
-                
-                all_urls = []
-                for node in message["sources"]:
-                    source_info = node.metadata.get("source_url") or node.metadata.get("file_name")
-                    if source_info:
-                        all_urls.append(source_info)
-                
-                # Ottieni una lista di URL unici mantenendo l'ordine
-                unique_urls = list(dict.fromkeys(all_urls))
-                
-                if not unique_urls:
-                    st.info(ui_texts["no_sources_message"])
-                else:
-                    # Elenca ogni URL unico
-                    for url in unique_urls:
-                        st.markdown(f"- {url}")
+                for url in message["sources"]:
+                    st.markdown(f"- {url}")
 
 if prompt := st.chat_input(ui_texts["chat_input_placeholder"]):
-    st.session_state.messages.append({"role": "user", "content": prompt})
     with st.chat_message("user"):
         st.write(prompt)
 
     with st.chat_message("assistant"):
-        
-        streaming_response = None
-        
+        result = {"sources": [], "error": None}
+
         with st.spinner(ui_texts["thinking_message"]):
-            
-            # Formatta la data
-            current_date_str = format_datetime(datetime.datetime.now(), format="EEEE, d MMMM yyyy", locale="it_IT")
-            
-            chat_engine = st.session_state.chat_engine
-            # Aggiorna il system prompt del motore RAG con la data corrente
-            chat_engine._system_prompt = SYSTEM_PROMPT_TEMPLATE.format(current_date=current_date_str)
-            
-            # Avvia lo stream
-            streaming_response = chat_engine.stream_chat(prompt)
-            
-        # Scrivi lo stream sul frontend e cattura la risposta completa
-        final_response_text = st.write_stream(streaming_response.response_gen)
-        
-        source_nodes_for_display = streaming_response.source_nodes
+            # Il server condensa la domanda, recupera il contesto e genera la risposta in streaming:
+            # lo spinner resta fino al primo token
+            token_stream = stream_answer(ASKDIEM_API_URL, st.session_state.session_id, prompt, result)
+            first_token = next(token_stream, "")
 
-        # Mostra le fonti
+        # Scrivi lo stream sul frontend (il server salva il turno nella cronologia della sessione)
+        st.write_stream(itertools.chain([first_token], token_stream))
+
+        if result["error"]:
+            st.error(result["error"])
+
+        # Mostra le fonti (già senza duplicati e vuote per le risposte conversazionali)
         with st.expander(ui_texts["sources_expander"]):
-            
-            is_conversational = False
-            if len(source_nodes_for_display) == 1:
-                if source_nodes_for_display[0].score < 0.15: 
-                     is_conversational = True
-            
-            if not source_nodes_for_display or is_conversational:
+            if not result["sources"]:
                 st.info(ui_texts["no_sources_message"])
             else:
-                all_urls = []
-                for node in source_nodes_for_display:
-                    source_info = node.metadata.get("source_url") or node.metadata.get("file_name")
-                    if source_info:
-                        all_urls.append(source_info)
-                
-                unique_urls = list(dict.fromkeys(all_urls))
-                
-                if not unique_urls:
-                    st.info(ui_texts["no_sources_message"])
-                else:
-                    for url in unique_urls:
-                        st.markdown(f"- {url}")
-
-    nodes_to_save = []
-    if not is_conversational:
-        nodes_to_save = source_nodes_for_display
-    
-    # Aggiungi la risposta e le fonti dell'assistente alla cronologia
-    st.session_state.messages.append({
-        "role": "assistant", 
-        "content": final_response_text,
-        "sources": nodes_to_save
-    })
\ No newline at end of file
+                for url in result["sources"]:
+                    st.markdown(f"- {url}")
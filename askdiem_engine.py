@@ -0,0 +1,643 @@
+"""
+Motore di chat di AskDIEM: CondensePlusContextChatEngine con cache delle risposte e del retrieval.
+
+Dopo la condensazione della domanda, l'embedding della domanda autonoma viene
+cercato nella cache delle risposte (chat_cache.py): in caso di successo la
+risposta memorizzata viene restituita subito, con le sue fonti, senza
+retrieval, rerank né chiamata all'LLM. L'embedding passa dalla cache delle
+query, quindi in caso di mancato successo il retriever non lo ricalcola.
+
+I nodi prodotti da retriever e post-processori (rerank compreso) per una
+domanda condensata sono a loro volta in cache (RetrievalCache): se la stessa
+domanda torna con una cronologia diversa, solo la generazione viene ripetuta.
+
+Retriever, post-processori, LLM e prompt sono costruiti una sola volta per
+processo (ChatEngineComponents) e condivisi da tutte le sessioni: per ogni
+turno si crea soltanto un motore leggero sopra la memoria della sessione.
+
+La condensazione della domanda segue una CondensePolicy (condense_policy.py):
+le domande già autonome non passano dall'LLM e le altre vengono condensate
+sui soli ultimi turni, non sull'intera memoria.
+
+In modalità speculativa, quando la domanda va condensata, retrieval e rerank
+partono subito sulla domanda originale, in parallelo alla chiamata all'LLM:
+se la domanda condensata è in sostanza la stessa (uguale dopo la
+normalizzazione o con embedding molto simile) i nodi speculativi vengono
+usati, altrimenti il retrieval viene ripetuto sulla domanda condensata.
+"""
+import asyncio
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, List, Optional
+
+import numpy as np
+
+from llama_index.core.base.llms.types import ChatMessage, ChatResponse, MessageRole
+from llama_index.core.base.response.schema import AsyncStreamingResponse, StreamingResponse
+from llama_index.core.callbacks import trace_method
+from llama_index.core.chat_engine import CondensePlusContextChatEngine
+from llama_index.core.chat_engine.types import AgentChatResponse, StreamingAgentChatResponse, ToolOutput
+from llama_index.core.postprocessor import SimilarityPostprocessor
+from llama_index.core.postprocessor.types import BaseNodePostprocessor
+from llama_index.core.prompts import PromptTemplate
+from llama_index.core.schema import NodeWithScore, QueryBundle, TextNode
+from llama_index.core.settings import Settings
+
+from chat_cache import guess_language
+from condense_policy import CondensePolicy
+from context_compression import ContextCompressor
+from embedding_cache import normalize_query
+
+
+# --- CLASSE POST-PROCESSOR PERSONALIZZATA ---
+class KeepAtLeastOneNodePostprocessor(BaseNodePostprocessor):
+    """
+    Un post-processore personalizzato che "avvolge" altri post-processori 
+    per garantire che, se il retriever aveva originariamente trovato dei nodi,
+    almeno uno venga sempre restituito per evitare che il ChatEngine fallisca.
+    """
+    postprocessors: List[BaseNodePostprocessor]
+
+    def _postprocess_nodes(self, nodes, query_str):
+        """
+        Applica la logica di post-processing.
+        """
+        if not nodes:
+            # Se il retriever non ha trovato nulla, restituisce una lista vuota.
+            return []
+        
+        # Salviamo un riferimento al nodo migliore prima di applicare i filtri.
+        best_node = nodes[0] 
+        
+        # Applica tutti i post-processori "avvolti"
+        processed_nodes = nodes
+        for pp in self.postprocessors:
+            processed_nodes = pp.postprocess_nodes(processed_nodes, query_str=query_str)
+        
+        if not processed_nodes:
+            return [best_node]
+        
+        return processed_nodes
+
+
+SYSTEM_PROMPT_TEMPLATE = (
+    """Il tuo nome è AskDIEM, sei un assistente virtuale dell'Università di Salerno, specializzato nell'aiutare gli studenti del Dipartimento di Ingegneria dell'Informazione ed Elettrica e Matematica Applicata (DIEM).
+
+    Il tuo obiettivo è fornire risposte accurate basandoti esclusivamente sulle informazioni ufficiali che ti vengono fornite.
+    Tieni presente che oggi è: {current_date}.
+
+    REGOLE GENERALI:
+    - *IMPORTANTE*: Se la domanda ti viene posta in inglese rispondi in inglese, a prescindere dalla lingua dei messaggi precedenti o da quella del contesto fornito.
+    - A meno che nella domanda non venga specificato un anno o una data in particolare, rispondi sempre tenendo presente la data di oggi.
+    - Se nomini un evento, adegua i tempi verbali in base alla data attuale.
+    - Se non disponi delle informazioni necessarie per rispondere a una domanda, dichiara chiaramente: "Non dispongo delle informazioni necessarie per rispondere a questa domanda."
+    - Non inventare mai informazioni, contatti, date o procedure. La tua priorità è l'accuratezza."""
+)
+
+CONTEXT_PROMPT_TEMPLATE = (
+        """Date le seguenti informazioni estratte dai documenti ufficiali e la domanda dell'utente, fornisci una risposta chiara ed esaustiva.
+
+        Contesto:
+        {context_str}
+
+        Istruzioni per la risposta:
+        - Se il contesto è presente ED È RILEVANTE per la domanda, basa la tua risposta su di esso.
+        - Se il contesto è vuoto o NON È RILEVANTE per la domanda (ad esempio, se la domanda è un saluto, "come ti chiami?", o una domanda conversazionale generica), rispondi alla domanda usando la tua conoscenza generale e seguendo la tua personalità definita nel system prompt.
+        
+        - ISTRUZIONE PER I LINK: Se nel contesto è presente una risorsa rilevante (come un PDF di un bando, una graduatoria o una pagina web) che supporta la tua risposta, devi citarla usando il formato Markdown: [Titolo Significativo](URL).
+        - Il "Titolo Significativo" dovrebbe essere il titolo del documento (es. 'Bando Collaborazioni studentesche 2024') che trovi nel contesto.
+        - L' "URL" è l'indirizzo web (source_url) associato a quel titolo.
+        
+        - Esempio di formato CORRETTO:
+        Per maggiori dettagli, puoi consultare il [Bando per Collaborazioni Studentesche](https://www.unisa.it/bando-collaborazioni-...).
+        
+        - Esempio di formato ERRATO (da non usare):
+        Per maggiori dettagli, puoi consultare https://www.unisa.it/bando-collaborazioni-...
+        
+        - Non includere link o titoli che non siano esplicitamente presenti nel contesto.
+
+        Domanda: {query_str}
+        Risposta:
+        """
+)
+
+
+def source_pairs(nodes):
+    """Coppie (source_url, punteggio) delle fonti, nell'ordine del contesto."""
+    return [
+        (node.metadata.get("source_url") or node.metadata.get("file_name"), node.score)
+        for node in nodes
+    ]
+
+
+_speculation_executor = None
+_speculation_executor_lock = threading.Lock()
+
+
+def get_speculation_executor():
+    """
+    Pool di thread condiviso nel processo per il retrieval speculativo dei
+    motori sincroni (SPECULATIVE_RETRIEVAL_WORKERS thread).
+    """
+    global _speculation_executor
+    with _speculation_executor_lock:
+        if _speculation_executor is None:
+            _speculation_executor = ThreadPoolExecutor(
+                max_workers=int(os.getenv("SPECULATIVE_RETRIEVAL_WORKERS", 8)),
+                thread_name_prefix="speculative-retrieval",
+            )
+        return _speculation_executor
+
+
+def source_urls(nodes):
+    """
+    URL unici delle fonti da mostrare e salvare; nessuno per le risposte
+    conversazionali (un solo nodo, tenuto da KeepAtLeastOne, con punteggio basso).
+    """
+    if len(nodes) == 1 and nodes[0].score is not None and nodes[0].score < 0.15:
+        return []
+    return [url for url in dict.fromkeys(
+        node.metadata.get("source_url") or node.metadata.get("file_name") for node in nodes
+    ) if url]
+
+
+class AskDIEMChatEngine(CondensePlusContextChatEngine):
+    """
+    CondensePlusContextChatEngine con cache opzionali, entrambe chiavate sulla
+    domanda condensata: delle risposte (`answer_cache`, un SemanticAnswerCache)
+    e dei nodi riordinati (`retrieval_cache`, un RetrievalCache). Con una
+    `condense_policy` la condensazione avviene solo quando serve; con
+    `speculative_retrieval` il retrieval sulla domanda originale procede in
+    parallelo alla condensazione e viene usato se la similarità fra le due
+    domande è almeno `speculation_threshold`. `sparse_encoder` è la funzione
+    sparsa del vector store ibrido: nel percorso asincrono viene eseguita in un
+    thread prima della ricerca, perché QdrantVectorStore.aquery la chiama in
+    modo sincrono sul ciclo degli eventi.
+    """
+
+    def __init__(self, *args: Any, answer_cache=None, retrieval_cache=None, embed_model=None,
+                 condense_policy=None, speculative_retrieval=False, speculation_threshold=0.95,
+                 sparse_encoder=None, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        self._answer_cache = answer_cache
+        self._retrieval_cache = retrieval_cache
+        self._embed_model = embed_model or Settings.embed_model
+        self._condense_policy = condense_policy
+        self._speculative_retrieval = speculative_retrieval
+        self._speculation_threshold = speculation_threshold
+        self._sparse_encoder = sparse_encoder
+
+    @classmethod
+    def from_defaults(cls, retriever, answer_cache=None, retrieval_cache=None, embed_model=None,
+                      condense_policy=None, speculative_retrieval=False, speculation_threshold=0.95,
+                      sparse_encoder=None, **kwargs: Any) -> "AskDIEMChatEngine":
+        engine = super().from_defaults(retriever=retriever, **kwargs)
+        engine._answer_cache = answer_cache
+        engine._retrieval_cache = retrieval_cache
+        engine._embed_model = embed_model or Settings.embed_model
+        engine._condense_policy = condense_policy
+        engine._speculative_retrieval = speculative_retrieval
+        engine._speculation_threshold = speculation_threshold
+        engine._sparse_encoder = sparse_encoder
+        return engine
+
+    def _condense_history(self, chat_history, message):
+        """Cronologia da passare alla condensazione: vuota se la domanda non va condensata."""
+        if self._condense_policy is None:
+            return chat_history
+        history = self._condense_policy.history_for_condense(chat_history, message)
+        if history is None:
+            if chat_history and self._verbose:
+                print("Domanda autonoma: condensazione saltata.")
+            return []
+        return history
+
+    def _will_condense(self, chat_history, message):
+        """True se la condensazione di `message` chiamerà l'LLM."""
+        if self._skip_condense or not chat_history:
+            return False
+        if self._condense_policy is None:
+            return True
+        return self._condense_policy.history_for_condense(chat_history, message) is not None
+
+    def _same_question(self, message, condensed_question):
+        """True se la condensazione non ha cambiato la domanda nella sostanza."""
+        if normalize_query(message) == normalize_query(condensed_question):
+            return True
+        # L'embedding della domanda originale è già nella cache delle query (retrieval speculativo)
+        return self._similarity(
+            self._embed_model.get_query_embedding(message), self._embed_model.get_query_embedding(condensed_question)
+        ) >= self._speculation_threshold
+
+    async def _asame_question(self, message, condensed_question):
+        if normalize_query(message) == normalize_query(condensed_question):
+            return True
+        return self._similarity(
+            await self._embed_model.aget_query_embedding(message),
+            await self._embed_model.aget_query_embedding(condensed_question),
+        ) >= self._speculation_threshold
+
+    @staticmethod
+    def _similarity(a, b):
+        a = np.asarray(a, dtype=np.float32)
+        b = np.asarray(b, dtype=np.float32)
+        return float(a @ b / (np.linalg.norm(a) * np.linalg.norm(b) + 1e-12))
+
+    def _start_speculation(self, message, chat_history):
+        """Avvia retrieval e rerank sulla domanda originale, se la condensazione chiamerà l'LLM."""
+        if not self._speculative_retrieval or not self._will_condense(chat_history, message):
+            return None
+        return get_speculation_executor().submit(self._get_nodes, message)
+
+    def _astart_speculation(self, message, chat_history):
+        if not self._speculative_retrieval or not self._will_condense(chat_history, message):
+            return None
+        return asyncio.ensure_future(self._aget_nodes(message))
+
+    @staticmethod
+    def _discard_speculation(speculation):
+        """
+        Annulla il retrieval speculativo. Future.cancel() non ferma un retrieval già in
+        esecuzione nel pool, che termina in background; l'eventuale errore viene letto
+        comunque, così non resta un'eccezione mai recuperata.
+        """
+        if speculation is None:
+            return
+        speculation.cancel()
+        speculation.add_done_callback(lambda done: done.cancelled() or done.exception())
+
+    def _context_nodes(self, message, condensed_question, speculation):
+        """Nodi per la domanda condensata: quelli speculativi, se la domanda non è cambiata."""
+        if speculation is not None:
+            try:
+                same_question = self._same_question(message, condensed_question)
+            except BaseException:
+                self._discard_speculation(speculation)
+                raise
+            if same_question:
+                try:
+                    nodes = speculation.result()
+                    if self._verbose:
+                        print("Nodi dal retrieval speculativo.")
+                    return nodes
+                except Exception as e:
+                    print(f"Retrieval speculativo fallito, si ripete sulla domanda condensata: {e}")
+            else:
+                self._discard_speculation(speculation)
+        return self._get_nodes(condensed_question)
+
+    async def _acontext_nodes(self, message, condensed_question, speculation):
+        if speculation is not None:
+            try:
+                same_question = await self._asame_question(message, condensed_question)
+            except BaseException:
+                self._discard_speculation(speculation)
+                raise
+            if same_question:
+                try:
+                    nodes = await speculation
+                    if self._verbose:
+                        print("Nodi dal retrieval speculativo.")
+                    return nodes
+                except Exception as e:
+                    print(f"Retrieval speculativo fallito, si ripete sulla domanda condensata: {e}")
+            else:
+                self._discard_speculation(speculation)
+        return await self._aget_nodes(condensed_question)
+
+    def _condense_question(self, chat_history: List[ChatMessage], latest_message: str) -> str:
+        return super()._condense_question(self._condense_history(chat_history, latest_message), latest_message)
+
+    async def _acondense_question(self, chat_history: List[ChatMessage], latest_message: str) -> str:
+        return await super()._acondense_question(
+            self._condense_history(chat_history, latest_message), latest_message
+        )
+
+    def _get_nodes(self, message: str) -> List[NodeWithScore]:
+        if self._retrieval_cache is None:
+            return super()._get_nodes(message)
+        nodes = self._retrieval_cache.get(message)
+        if nodes is None:
+            nodes = super()._get_nodes(message)
+            self._retrieval_cache.put(message, nodes)
+        elif self._verbose:
+            print("Nodi dalla cache del retrieval.")
+        return nodes
+
+    async def _aget_nodes(self, message: str) -> List[NodeWithScore]:
+        if self._retrieval_cache is not None:
+            nodes = self._retrieval_cache.get(message)
+            if nodes is not None:
+                if self._verbose:
+                    print("Nodi dalla cache del retrieval.")
+                return nodes
+        if self._sparse_encoder is not None:
+            # Il vettore sparso (forward pass di bge-m3 se non è in cache) viene calcolato fuori dal
+            # ciclo degli eventi; la chiamata sincrona dentro aquery lo trova poi nella cache
+            await asyncio.to_thread(self._sparse_encoder, [message])
+        nodes = await self._retriever.aretrieve(message)
+        # Rerank e compressione sono sincroni (modello locale o API): fuori dal ciclo degli eventi
+        nodes = await asyncio.to_thread(self._postprocess, nodes, message)
+        if self._retrieval_cache is not None:
+            self._retrieval_cache.put(message, nodes)
+        return nodes
+
+    def _postprocess(self, nodes, message):
+        for postprocessor in self._node_postprocessors:
+            nodes = postprocessor.postprocess_nodes(nodes, query_bundle=QueryBundle(message))
+        return nodes
+
+    def _lookup_answer(self, message, chat_history):
+        """
+        Condensa la domanda e la cerca nella cache. Restituisce
+        (domanda condensata, chiave per la cache, voce trovata o None).
+        """
+        condensed_question = self._condense_question(chat_history, message)
+        if self._verbose:
+            print(f"Condensed question: {condensed_question}")
+        if self._answer_cache is None:
+            return condensed_question, None, None
+        # La lingua della risposta segue quella del messaggio originale, non della domanda condensata
+        cache_key = (self._embed_model.get_query_embedding(condensed_question), guess_language(message))
+        return condensed_question, cache_key, self._answer_cache.lookup(*cache_key)
+
+    async def _alookup_answer(self, message, chat_history):
+        """Versione asincrona di `_lookup_answer`."""
+        condensed_question = await self._acondense_question(chat_history, message)
+        if self._verbose:
+            print(f"Condensed question: {condensed_question}")
+        if self._answer_cache is None:
+            return condensed_question, None, None
+        cache_key = (await self._embed_model.aget_query_embedding(condensed_question), guess_language(message))
+        return condensed_question, cache_key, self._answer_cache.lookup(*cache_key)
+
+    def _store_answer(self, cache_key, answer, context_nodes):
+        if self._answer_cache is not None and cache_key is not None:
+            self._answer_cache.put(*cache_key, answer, source_pairs(context_nodes))
+
+    @staticmethod
+    def _cached_source_nodes(entry):
+        # Nodi "segnaposto" con i soli metadati usati dall'app per mostrare le fonti
+        return [
+            NodeWithScore(node=TextNode(text="", metadata={"source_url": url}), score=score)
+            for url, score in entry["sources"]
+        ]
+
+    def _save_turn(self, message, answer):
+        self._memory.put(ChatMessage(content=message, role=MessageRole.USER))
+        self._memory.put(ChatMessage(content=answer, role=MessageRole.ASSISTANT))
+
+    def _context_source(self, condensed_question, context_nodes):
+        return ToolOutput(
+            tool_name="retriever",
+            content=str(context_nodes),
+            raw_input={"message": condensed_question},
+            raw_output=context_nodes,
+        )
+
+    @trace_method("chat")
+    def chat(self, message: str, chat_history: Optional[List[ChatMessage]] = None) -> AgentChatResponse:
+        if chat_history is not None:
+            self._memory.set(chat_history)
+        chat_history = self._memory.get(input=message)
+
+        speculation = self._start_speculation(message, chat_history)
+        try:
+            condensed_question, cache_key, entry = self._lookup_answer(message, chat_history)
+        except Exception:
+            self._discard_speculation(speculation)
+            raise
+        if entry is not None:
+            self._discard_speculation(speculation)
+            if self._verbose:
+                print(f"Risposta dalla cache (similarità {entry['similarity']:.3f}).")
+            context_nodes = self._cached_source_nodes(entry)
+            answer = entry["answer"]
+        else:
+            context_nodes = self._context_nodes(message, condensed_question, speculation)
+            synthesizer = self._get_response_synthesizer(chat_history)
+            answer = str(synthesizer.synthesize(message, context_nodes))
+            self._store_answer(cache_key, answer, context_nodes)
+
+        self._save_turn(message, answer)
+        return AgentChatResponse(
+            response=answer,
+            sources=[self._context_source(condensed_question, context_nodes)],
+            source_nodes=context_nodes,
+        )
+
+    @trace_method("chat")
+    def stream_chat(self, message: str, chat_history: Optional[List[ChatMessage]] = None) -> StreamingAgentChatResponse:
+        if chat_history is not None:
+            self._memory.set(chat_history)
+        chat_history = self._memory.get(input=message)
+
+        speculation = self._start_speculation(message, chat_history)
+        try:
+            condensed_question, cache_key, entry = self._lookup_answer(message, chat_history)
+        except Exception:
+            self._discard_speculation(speculation)
+            raise
+        if entry is not None:
+            self._discard_speculation(speculation)
+            if self._verbose:
+                print(f"Risposta dalla cache (similarità {entry['similarity']:.3f}).")
+            context_nodes = self._cached_source_nodes(entry)
+            tokens = iter([entry["answer"]])
+        else:
+            context_nodes = self._context_nodes(message, condensed_question, speculation)
+            synthesizer = self._get_response_synthesizer(chat_history, streaming=True)
+            response = synthesizer.synthesize(message, context_nodes)
+            assert isinstance(response, StreamingResponse)
+            tokens = response.response_gen
+
+        def wrapped_gen():
+            full_response = ""
+            for token in tokens:
+                full_response += token
+                yield ChatResponse(
+                    message=ChatMessage(content=full_response, role=MessageRole.ASSISTANT),
+                    delta=token,
+                )
+            if entry is None:
+                # Solo le risposte generate per intero entrano nella cache
+                self._store_answer(cache_key, full_response, context_nodes)
+            self._save_turn(message, full_response)
+
+        return StreamingAgentChatResponse(
+            chat_stream=wrapped_gen(),
+            sources=[self._context_source(condensed_question, context_nodes)],
+            source_nodes=context_nodes,
+            is_writing_to_memory=False,
+        )
+
+    @trace_method("chat")
+    async def achat(self, message: str, chat_history: Optional[List[ChatMessage]] = None) -> AgentChatResponse:
+        if chat_history is not None:
+            await self._memory.aset(chat_history)
+        chat_history = await self._memory.aget(input=message)
+
+        speculation = self._astart_speculation(message, chat_history)
+        try:
+            condensed_question, cache_key, entry = await self._alookup_answer(message, chat_history)
+        except BaseException:
+            self._discard_speculation(speculation)
+            raise
+        if entry is not None:
+            self._discard_speculation(speculation)
+            if self._verbose:
+                print(f"Risposta dalla cache (similarità {entry['similarity']:.3f}).")
+            context_nodes = self._cached_source_nodes(entry)
+            answer = entry["answer"]
+        else:
+            context_nodes = await self._acontext_nodes(message, condensed_question, speculation)
+            synthesizer = self._get_response_synthesizer(chat_history)
+            answer = str(await synthesizer.asynthesize(message, context_nodes))
+            self._store_answer(cache_key, answer, context_nodes)
+
+        self._save_turn(message, answer)
+        return AgentChatResponse(
+            response=answer,
+            sources=[self._context_source(condensed_question, context_nodes)],
+            source_nodes=context_nodes,
+        )
+
+    @trace_method("chat")
+    async def astream_chat(
+        self, message: str, chat_history: Optional[List[ChatMessage]] = None
+    ) -> StreamingAgentChatResponse:
+        if chat_history is not None:
+            await self._memory.aset(chat_history)
+        chat_history = await self._memory.aget(input=message)
+
+        speculation = self._astart_speculation(message, chat_history)
+        try:
+            condensed_question, cache_key, entry = await self._alookup_answer(message, chat_history)
+        except BaseException:
+            # Anche in caso di cancellazione della richiesta (client disconnesso)
+            self._discard_speculation(speculation)
+            raise
+        if entry is not None:
+            self._discard_speculation(speculation)
+            if self._verbose:
+                print(f"Risposta dalla cache (similarità {entry['similarity']:.3f}).")
+            context_nodes = self._cached_source_nodes(entry)
+
+            async def cached_tokens():
+                yield entry["answer"]
+
+            tokens = cached_tokens()
+        else:
+            context_nodes = await self._acontext_nodes(message, condensed_question, speculation)
+            synthesizer = self._get_response_synthesizer(chat_history, streaming=True)
+            response = await synthesizer.asynthesize(message, context_nodes)
+            assert isinstance(response, AsyncStreamingResponse)
+            tokens = response.async_response_gen()
+
+        async def wrapped_gen():
+            full_response = ""
+            async for token in tokens:
+                full_response += token
+                yield ChatResponse(
+                    message=ChatMessage(content=full_response, role=MessageRole.ASSISTANT),
+                    delta=token,
+                )
+            if entry is None:
+                self._store_answer(cache_key, full_response, context_nodes)
+            self._save_turn(message, full_response)
+
+        return StreamingAgentChatResponse(
+            achat_stream=wrapped_gen(),
+            sources=[self._context_source(condensed_question, context_nodes)],
+            source_nodes=context_nodes,
+            is_writing_to_memory=False,
+        )
+
+
+class ChatEngineComponents:
+    """
+    Parti del motore di chat condivise da tutte le sessioni del processo:
+    retriever, catena di post-processori, LLM, prompt e cache. Sono tutte
+    prive di stato per sessione; `create_engine` le combina con la memoria
+    di una sessione.
+    """
+
+    def __init__(self, retriever, node_postprocessors, llm=None, system_prompt_template=SYSTEM_PROMPT_TEMPLATE,
+                 context_prompt=CONTEXT_PROMPT_TEMPLATE, answer_cache=None, retrieval_cache=None,
+                 embed_model=None, condense_policy=None, speculative_retrieval=False, speculation_threshold=0.95,
+                 sparse_encoder=None, verbose=False):
+        self.retriever = retriever
+        self.node_postprocessors = node_postprocessors
+        self.llm = llm or Settings.llm
+        self.system_prompt_template = system_prompt_template
+        self.context_prompt = PromptTemplate(context_prompt) if isinstance(context_prompt, str) else context_prompt
+        self.answer_cache = answer_cache
+        self.retrieval_cache = retrieval_cache
+        self.embed_model = embed_model or Settings.embed_model
+        self.condense_policy = condense_policy
+        self.speculative_retrieval = speculative_retrieval
+        self.speculation_threshold = speculation_threshold
+        self.sparse_encoder = sparse_encoder
+        self.verbose = verbose
+
+    def create_engine(self, memory, current_date):
+        """Motore per un turno di una sessione, con la data corrente nel system prompt."""
+        return AskDIEMChatEngine(
+            retriever=self.retriever,
+            llm=self.llm,
+            memory=memory,
+            context_prompt=self.context_prompt,
+            system_prompt=self.system_prompt_template.format(current_date=current_date),
+            node_postprocessors=self.node_postprocessors,
+            callback_manager=Settings.callback_manager,
+            answer_cache=self.answer_cache,
+            retrieval_cache=self.retrieval_cache,
+            embed_model=self.embed_model,
+            condense_policy=self.condense_policy,
+            speculative_retrieval=self.speculative_retrieval,
+            speculation_threshold=self.speculation_threshold,
+            sparse_encoder=self.sparse_encoder,
+            verbose=self.verbose,
+        )
+
+
+def build_chat_components(vector_index, reranker, context_token_budget=12000, answer_cache=None,
+                          retrieval_cache=None, condense_history_turns=3, speculative_retrieval=False,
+                          speculation_threshold=0.95, sparse_encoder=None, verbose=False):
+    """
+    Costruisce le parti condivise del motore a partire dall'indice: retriever
+    (ibrido se il vector store lo consente), rerank, filtro di similarità con
+    almeno un nodo garantito e compressione del contesto. Le domande vengono
+    condensate solo se non autonome, sugli ultimi `condense_history_turns`
+    turni (None: sempre, sull'intera memoria); con `speculative_retrieval`
+    il retrieval sulla domanda originale procede in parallelo. `sparse_encoder`
+    (la funzione sparsa passata al vector store ibrido) serve al percorso asincrono.
+    """
+    if getattr(vector_index.vector_store, "enable_hybrid", False):
+        # La ricerca ibrida trova già i termini esatti: bastano meno candidati da riordinare
+        retriever_kwargs = dict(vector_store_query_mode="hybrid", similarity_top_k=10, sparse_top_k=10, hybrid_top_k=10)
+    else:
+        retriever_kwargs = dict(similarity_top_k=15)
+
+    # Definiamo i post-processori che vogliamo filtrare
+    filtering_postprocessors = [
+        SimilarityPostprocessor(similarity_cutoff=0.15)
+    ]
+
+    return ChatEngineComponents(
+        retriever=vector_index.as_retriever(**retriever_kwargs),
+        node_postprocessors=[
+            reranker,
+            KeepAtLeastOneNodePostprocessor(postprocessors=filtering_postprocessors),
+            # Solo i periodi pertinenti, senza le sovrapposizioni fra chunk dello stesso documento
+            ContextCompressor(token_budget=context_token_budget),
+        ],
+        answer_cache=answer_cache,
+        retrieval_cache=retrieval_cache,
+        condense_policy=CondensePolicy(max_history_turns=condense_history_turns) if condense_history_turns else None,
+        speculative_retrieval=speculative_retrieval,
+        speculation_threshold=speculation_threshold,
+        sparse_encoder=sparse_encoder,
+        verbose=verbose,
+    )
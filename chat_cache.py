@@ -0,0 +1,432 @@
+"""
+Cache della chat condivise da tutte le sessioni del processo: risposte e risultati del retrieval.
+
+Per le risposte la chiave è l'embedding della domanda condensata (autonoma):
+una nuova domanda abbastanza simile (similarità coseno sopra soglia) a una
+già risposta riceve la stessa risposta, con le stesse fonti, senza retrieval,
+rerank né chiamata all'LLM. Le risposte scadono:
+- al cambio di data, perché il system prompt contiene la data corrente;
+- quando update.py re-indicizza uno dei documenti citati come fonte. Gli
+  aggiornamenti sono registrati da update.py come eventi in una piccola
+  collezione dello stesso Qdrant dell'indice (INDEX_UPDATES_COLLECTION), che
+  ogni server legge a intervalli: anche un server che non condivide il file
+  system dell'updater li vede. Senza client Qdrant gli eventi passano da un
+  file locale (INDEX_UPDATES_FILE).
+
+La cache del retrieval conserva invece i nodi già riordinati e filtrati per
+una domanda condensata (normalizzata): anche quando la risposta cambia per
+via della cronologia, la ricerca su Qdrant e il rerank non vengono ripetuti.
+È legata alla versione della collezione, cioè al suo nome e all'ultimo
+aggiornamento registrato, e si svuota a ogni aggiornamento.
+"""
+import datetime
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+
+import numpy as np
+from llama_index.core.schema import NodeWithScore
+from qdrant_client import models
+
+from embedding_cache import normalize_query
+
+INDEX_UPDATES_FILE = os.getenv("INDEX_UPDATES_FILE", "data/index_updates.json")
+# Eventi conservati nel file: bastano a coprire l'intervallo fra due letture dell'app
+MAX_INDEX_UPDATE_EVENTS = 200
+# Collezione Qdrant degli eventi (fuori dal prefisso '<alias>_' delle collezioni versionate)
+INDEX_UPDATES_COLLECTION = os.getenv("INDEX_UPDATES_COLLECTION", "askdiem_index_updates")
+# Eventi più vecchi di così vengono eliminati dalla collezione a ogni nuova registrazione
+INDEX_UPDATES_RETENTION_SECONDS = 7 * 24 * 3600
+
+_ENGLISH_WORDS = {"the", "is", "are", "what", "when", "where", "how", "who", "which", "can", "do", "does",
+                  "i", "my", "to", "of", "for", "in", "and", "exam", "course", "professor"}
+_ITALIAN_WORDS = {"il", "lo", "la", "le", "gli", "è", "sono", "che", "cosa", "quando", "dove", "come", "chi",
+                  "quale", "posso", "di", "per", "del", "della", "e", "esame", "corso", "docente"}
+
+
+def guess_language(text):
+    """Stima grossolana della lingua ('en' o 'it'): la risposta segue la lingua della domanda."""
+    words = re.findall(r"\w+", text.lower())
+    english = sum(word in _ENGLISH_WORDS for word in words)
+    italian = sum(word in _ITALIAN_WORDS for word in words)
+    return "en" if english > italian else "it"
+
+
+def load_index_updates(filepath=INDEX_UPDATES_FILE):
+    if not os.path.exists(filepath):
+        return []
+    try:
+        with open(filepath, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        # File in scrittura o danneggiato: si riprova alla prossima lettura
+        return []
+
+
+def record_index_update(source_urls=None, filepath=INDEX_UPDATES_FILE, client=None,
+                        collection_name=INDEX_UPDATES_COLLECTION):
+    """
+    Registra un aggiornamento dell'indice. `source_urls` sono i documenti
+    re-indicizzati o eliminati; None indica un cambiamento dell'intera collezione
+    (ricostruzione, rollback, delta). Con `client` l'evento va nella collezione
+    Qdrant `collection_name`, altrimenti nel file `filepath`.
+    """
+    event = {"time": time.time(), "source_urls": sorted(source_urls) if source_urls is not None else None}
+    if client is not None:
+        if not client.collection_exists(collection_name=collection_name):
+            # Gli eventi sono solo payload: il vettore (obbligatorio) ha dimensione 1
+            client.create_collection(
+                collection_name=collection_name,
+                vectors_config=models.VectorParams(size=1, distance=models.Distance.DOT),
+            )
+        client.upsert(
+            collection_name=collection_name,
+            points=[models.PointStruct(id=str(uuid.uuid4()), vector=[0.0], payload=event)],
+            wait=True,
+        )
+        client.delete(
+            collection_name=collection_name,
+            points_selector=models.FilterSelector(filter=models.Filter(must=[models.FieldCondition(
+                key="time", range=models.Range(lt=event["time"] - INDEX_UPDATES_RETENTION_SECONDS)
+            )])),
+        )
+        return
+    events = load_index_updates(filepath)[-(MAX_INDEX_UPDATE_EVENTS - 1):] + [event]
+    directory = os.path.dirname(filepath)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = filepath + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(events, f)
+    os.replace(tmp_path, filepath)
+
+
+class FileIndexUpdates:
+    """Eventi di aggiornamento dal file locale scritto da record_index_update."""
+
+    def __init__(self, filepath=INDEX_UPDATES_FILE):
+        self.filepath = filepath
+
+    def version(self):
+        """Valore che cambia a ogni nuovo evento (None se non ce ne sono)."""
+        try:
+            return os.path.getmtime(self.filepath)
+        except OSError:
+            return None
+
+    def events(self):
+        return load_index_updates(self.filepath)
+
+
+class QdrantIndexUpdates:
+    """
+    Eventi di aggiornamento dalla collezione Qdrant scritta da record_index_update.
+    La collezione viene interrogata al più ogni `poll_seconds` e solo per gli
+    eventi successivi all'ultimo già letto. Thread-safe.
+    """
+
+    def __init__(self, client, collection_name=INDEX_UPDATES_COLLECTION, poll_seconds=30):
+        self.client = client
+        self.collection_name = collection_name
+        self.poll_seconds = poll_seconds
+        self._events = []
+        self._last_poll = None
+        self._lock = threading.Lock()
+
+    def _poll(self):
+        if self._last_poll is not None and time.monotonic() - self._last_poll < self.poll_seconds:
+            return
+        self._last_poll = time.monotonic()
+        try:
+            if not self.client.collection_exists(collection_name=self.collection_name):
+                return
+            after = self._events[-1]["time"] if self._events else None
+            scroll_filter = None
+            if after is not None:
+                scroll_filter = models.Filter(must=[models.FieldCondition(key="time", range=models.Range(gt=after))])
+            new_events, offset = [], None
+            while True:
+                points, offset = self.client.scroll(
+                    collection_name=self.collection_name, scroll_filter=scroll_filter,
+                    limit=256, offset=offset, with_payload=True, with_vectors=False,
+                )
+                new_events.extend(point.payload for point in points)
+                if offset is None:
+                    break
+        except Exception as e:
+            # Qdrant non raggiungibile: si riprova al prossimo intervallo, la cache resta valida
+            print(f"Lettura degli aggiornamenti dell'indice fallita: {e}")
+            return
+        if new_events:
+            self._events = sorted(self._events + new_events, key=lambda event: event["time"])[-MAX_INDEX_UPDATE_EVENTS:]
+
+    def version(self):
+        """Istante dell'ultimo evento letto (None se non ce ne sono)."""
+        with self._lock:
+            self._poll()
+            return self._events[-1]["time"] if self._events else None
+
+    def events(self):
+        with self._lock:
+            self._poll()
+            return list(self._events)
+
+
+class SemanticAnswerCache:
+    """
+    Cache LRU in memoria delle risposte, con ricerca per similarità coseno
+    sugli embedding (normalizzati) delle domande condensate. Thread-safe.
+    """
+
+    def __init__(self, threshold=0.95, max_size=2000, ttl_seconds=24 * 3600, updates=None):
+        self.threshold = threshold
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        # Sorgente degli eventi di aggiornamento (FileIndexUpdates o QdrantIndexUpdates)
+        self.updates = updates if updates is not None else FileIndexUpdates()
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._next_id = 0
+        self._matrix = None
+        self._matrix_ids = []
+        self._updates_version = None
+        self._updates_seen = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _normalize(embedding):
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _drop(self, entry_ids):
+        for entry_id in entry_ids:
+            self._entries.pop(entry_id, None)
+        if entry_ids:
+            self._matrix = None
+
+    def _apply_index_updates(self):
+        """
+        Rilegge gli eventi di aggiornamento (solo se cambiati) e scarta le risposte
+        che citano i documenti aggiornati. Gli istanti degli eventi vengono
+        confrontati solo fra loro (orologio di chi li scrive), mai con quello
+        locale: alla prima lettura si registra l'ultimo evento esistente.
+        """
+        version = self.updates.version()
+        if self._updates_seen is not None and version == self._updates_version:
+            return
+        self._updates_version = version
+        events = self.updates.events()
+        if self._updates_seen is None:
+            self._updates_seen = max((event["time"] for event in events), default=0.0)
+            return
+        for event in events:
+            if event["time"] <= self._updates_seen:
+                continue
+            self._updates_seen = event["time"]
+            urls = set(event["source_urls"]) if event["source_urls"] is not None else None
+            # Anche le risposte memorizzate fra l'aggiornamento e la sua lettura: scartarle è innocuo
+            self._drop([
+                entry_id for entry_id, entry in self._entries.items()
+                if urls is None or urls & set(entry["source_urls"])
+            ])
+
+    def _expire(self):
+        today = datetime.date.today().isoformat()
+        now = time.time()
+        self._drop([
+            entry_id for entry_id, entry in self._entries.items()
+            if entry["date"] != today or now - entry["created"] > self.ttl_seconds
+        ])
+
+    def lookup(self, embedding, language):
+        """Restituisce la voce più simile sopra soglia (dizionario con 'answer', 'sources', 'similarity') o None."""
+        query = self._normalize(embedding)
+        with self._lock:
+            self._apply_index_updates()
+            self._expire()
+            if self._entries and self._matrix is None:
+                self._matrix_ids = list(self._entries)
+                self._matrix = np.stack([self._entries[entry_id]["embedding"] for entry_id in self._matrix_ids])
+            best = None
+            if self._entries and self._matrix.shape[1] == query.shape[0]:
+                similarities = self._matrix @ query
+                for i in np.argsort(-similarities):
+                    if similarities[i] < self.threshold:
+                        break
+                    entry_id = self._matrix_ids[i]
+                    if self._entries[entry_id]["language"] == language:
+                        best = dict(self._entries[entry_id], similarity=float(similarities[i]))
+                        self._entries.move_to_end(entry_id)
+                        break
+            if best is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return best
+
+    def put(self, embedding, language, answer, sources):
+        """Memorizza una risposta; `sources` è una lista di coppie (source_url, punteggio)."""
+        if not answer.strip():
+            return
+        with self._lock:
+            self._entries[self._next_id] = {
+                "embedding": self._normalize(embedding),
+                "language": language,
+                "answer": answer,
+                "sources": sources,
+                "source_urls": [url for url, _ in sources if url],
+                "date": datetime.date.today().isoformat(),
+                "created": time.time(),
+            }
+            self._next_id += 1
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            self._matrix = None
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class RetrievalCache:
+    """
+    Cache LRU con scadenza dei nodi restituiti dalla catena retriever + post-processori,
+    chiavata sulla domanda condensata normalizzata. I nodi sono conservati una
+    sola volta anche se compaiono nei risultati di più domande. Thread-safe.
+    """
+
+    def __init__(self, collection_name, max_size=512, ttl_seconds=6 * 3600, updates=None):
+        self.collection_name = collection_name
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.updates = updates if updates is not None else FileIndexUpdates()
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._nodes = {}
+        self._node_refs = Counter()
+        self._version = None
+        self._lock = threading.Lock()
+
+    def _current_version(self):
+        return self.collection_name, self.updates.version()
+
+    def _check_version(self):
+        version = self._current_version()
+        if version != self._version:
+            self._entries.clear()
+            self._nodes.clear()
+            self._node_refs.clear()
+            self._version = version
+
+    def _pop(self, key):
+        _, results = self._entries.pop(key)
+        for node_id, _ in results:
+            self._node_refs[node_id] -= 1
+            if self._node_refs[node_id] <= 0:
+                del self._node_refs[node_id]
+                del self._nodes[node_id]
+
+    def get(self, query):
+        """Nuovi NodeWithScore (sui nodi in cache) per la domanda, o None."""
+        key = normalize_query(query)
+        with self._lock:
+            self._check_version()
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[0] > self.ttl_seconds:
+                self._pop(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            # Oggetti nuovi a ogni lettura: chi li riceve può modificarne il punteggio
+            return [NodeWithScore(node=self._nodes[node_id], score=score) for node_id, score in entry[1]]
+
+    def put(self, query, nodes):
+        key = normalize_query(query)
+        with self._lock:
+            self._check_version()
+            if key in self._entries:
+                self._pop(key)
+            for node in nodes:
+                self._nodes.setdefault(node.node.node_id, node.node)
+                self._node_refs[node.node.node_id] += 1
+            self._entries[key] = (time.monotonic(), [(node.node.node_id, node.score) for node in nodes])
+            while len(self._entries) > self.max_size:
+                self._pop(next(iter(self._entries)))
+
+    def __len__(self):
+        return len(self._entries)
+
+
+_index_updates = None
+_answer_cache = None
+_answer_cache_lock = threading.Lock()
+
+
+def get_index_updates(client=None):
+    """
+    Sorgente degli eventi di aggiornamento unica per processo: la collezione
+    Qdrant se viene fornito il client dell'indice (intervallo di lettura da
+    INDEX_UPDATES_POLL_SECONDS), altrimenti il file locale.
+    """
+    global _index_updates
+    with _answer_cache_lock:
+        if _index_updates is None:
+            if client is not None:
+                _index_updates = QdrantIndexUpdates(
+                    client, poll_seconds=int(os.getenv("INDEX_UPDATES_POLL_SECONDS", 30))
+                )
+            else:
+                _index_updates = FileIndexUpdates()
+        return _index_updates
+
+
+def get_answer_cache(client=None):
+    """
+    Cache delle risposte unica per processo (soglia, dimensione e TTL da
+    ANSWER_CACHE_THRESHOLD / _SIZE / _TTL). Restituisce None se ANSWER_CACHE_ENABLED=0.
+    `client` è il client Qdrant dell'indice, da cui leggere gli aggiornamenti.
+    """
+    global _answer_cache
+    if os.getenv("ANSWER_CACHE_ENABLED", "1") != "1":
+        return None
+    updates = get_index_updates(client)
+    with _answer_cache_lock:
+        if _answer_cache is None:
+            _answer_cache = SemanticAnswerCache(
+                threshold=float(os.getenv("ANSWER_CACHE_THRESHOLD", 0.95)),
+                max_size=int(os.getenv("ANSWER_CACHE_SIZE", 2000)),
+                ttl_seconds=int(os.getenv("ANSWER_CACHE_TTL", 24 * 3600)),
+                updates=updates,
+            )
+        return _answer_cache
+
+
+_retrieval_caches = {}
+
+
+def get_retrieval_cache(collection_name, client=None):
+    """
+    Cache del retrieval unica per processo e collezione (dimensione e TTL da
+    RETRIEVAL_CACHE_SIZE / _TTL). Restituisce None se RETRIEVAL_CACHE_ENABLED=0.
+    """
+    if os.getenv("RETRIEVAL_CACHE_ENABLED", "1") != "1":
+        return None
+    updates = get_index_updates(client)
+    with _answer_cache_lock:
+        if collection_name not in _retrieval_caches:
+            _retrieval_caches[collection_name] = RetrievalCache(
+                collection_name,
+                max_size=int(os.getenv("RETRIEVAL_CACHE_SIZE", 512)),
+                ttl_seconds=int(os.getenv("RETRIEVAL_CACHE_TTL", 6 * 3600)),
+                updates=updates,
+            )
+        return _retrieval_caches[collection_name]
@@ -0,0 +1,58 @@
+"""
+Politica di condensazione delle domande: quando riscrivere la domanda con l'LLM.
+
+CondensePlusContextChatEngine riscrive ogni domanda successiva alla prima in
+forma autonoma, con una chiamata all'LLM sull'intera cronologia. La maggior
+parte delle domande però è già autonoma ("Quando apre la segreteria
+studenti?"): un classificatore locale a regole riconosce i riferimenti al
+contesto precedente (pronomi, dimostrativi, ellissi come "e per magistrale?")
+e solo in quel caso la domanda viene condensata, usando gli ultimi turni.
+"""
+import re
+
+from rerank import content_terms
+
+# Parole che rimandano a qualcosa detto prima
+_ANAPHORA = {
+    # Italiano
+    "lui", "lei", "esso", "essa", "essi", "esse", "questo", "questa", "questi", "queste", "quello", "quella",
+    "quelli", "quelle", "stesso", "stessa", "stessi", "stesse", "suo", "sua", "suoi", "sue", "loro", "anche",
+    "invece", "allora", "altro", "altra", "altri", "altre", "ciò", "precedente", "sopra", "detto", "lì", "là",
+    # Inglese
+    "it", "its", "they", "them", "their", "this", "that", "these", "those", "he", "she", "him", "his", "her",
+    "also", "instead", "same", "above", "previous", "ones",
+}
+# Inizi di frase che continuano il discorso precedente
+_CONTINUATION_START = re.compile(
+    r"^(e|ed|ma|però|quindi|dunque|oppure|o|and|but|so|or|what about|how about)\b", re.IGNORECASE
+)
+
+
+class CondensePolicy:
+    """
+    Decide se una domanda va condensata e limita la cronologia usata per
+    condensarla agli ultimi `max_history_turns` turni (coppie utente/assistente).
+    """
+
+    def __init__(self, max_history_turns=3, min_content_words=3):
+        self.max_history_turns = max_history_turns
+        self.min_content_words = min_content_words
+
+    def is_self_contained(self, message):
+        """Classificatore a regole: True se la domanda non sembra dipendere dalla cronologia."""
+        text = message.strip().lower()
+        if _CONTINUATION_START.match(text):
+            return False
+        if any(word in _ANAPHORA for word in re.findall(r"\w+", text)):
+            return False
+        # Domande brevi ("dove si trova?", "e il secondo anno?") sono quasi sempre ellittiche
+        return len(content_terms(text)) >= self.min_content_words
+
+    def history_for_condense(self, chat_history, message):
+        """
+        Cronologia da usare per condensare `message`, oppure None se la
+        condensazione va saltata (primo turno o domanda già autonoma).
+        """
+        if not chat_history or self.is_self_contained(message):
+            return None
+        return chat_history[-2 * self.max_history_turns:]
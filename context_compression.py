@@ -0,0 +1,107 @@
+"""
+Compressione del contesto passato all'LLM entro un budget di token.
+
+Dopo il rerank, i nodi (fino a 8k token ciascuno) vengono ridotti ai periodi
+pertinenti alla domanda, con i periodi vicini come contesto. I periodi
+vengono scelti in ordine di priorità (pertinenza del nodo secondo il rerank
+per sovrapposizione lessicale del periodo con la domanda, con una preferenza
+per l'inizio del nodo) finché il budget non è esaurito.
+
+Nodi adiacenti dello stesso documento condividono la sovrapposizione del
+chunking (1024 token): un periodo già scelto per un documento non viene
+ripetuto negli altri suoi nodi. I metadati (compreso source_url, usato per
+le citazioni) restano invariati.
+"""
+import re
+from typing import List, Optional
+
+from llama_index.core.postprocessor.types import BaseNodePostprocessor
+from llama_index.core.schema import NodeWithScore, QueryBundle
+from pydantic import Field
+
+from rerank import TOKENS_PER_WORD, content_terms
+
+GAP_MARKER = " [...] "
+
+
+def split_sentences(text):
+    """Periodi e righe (elenchi, tabelle) di un testo."""
+    return [part.strip() for part in re.split(r"(?<=[.!?;])\s+|\n+", text) if part.strip()]
+
+
+def estimate_tokens(text):
+    return int(len(text.split()) * TOKENS_PER_WORD) + 1
+
+
+class ContextCompressor(BaseNodePostprocessor):
+    """
+    Post-processore LlamaIndex che comprime il testo dei nodi in modo che il
+    contesto complessivo non superi `token_budget` token (stima). I nodi
+    restituiti sono copie: quelli originali (anche se in cache) non cambiano.
+    """
+
+    token_budget: int = Field(default=12000)
+    neighbor_sentences: int = Field(default=1)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "ContextCompressor"
+
+    @staticmethod
+    def _source(node):
+        return node.node.metadata.get("source_url") or node.node.ref_doc_id or node.node.node_id
+
+    def _postprocess_nodes(
+        self, nodes: List[NodeWithScore], query_bundle: Optional[QueryBundle] = None
+    ) -> List[NodeWithScore]:
+        if not nodes or query_bundle is None:
+            return nodes
+        if sum(estimate_tokens(node.node.get_content()) for node in nodes) <= self.token_budget:
+            return nodes
+        node_sentences = [split_sentences(node.node.get_content()) for node in nodes]
+
+        query_terms = set(content_terms(query_bundle.query_str))
+        candidates = []
+        for rank, (node, sentences) in enumerate(zip(nodes, node_sentences)):
+            node_weight = node.score if node.score is not None else 1 / (1 + rank)
+            for i, sentence in enumerate(sentences):
+                overlap = len(query_terms & set(content_terms(sentence)))
+                candidates.append((node_weight * (overlap + 0.5 / (1 + i)), rank, i))
+        candidates.sort(key=lambda candidate: (-candidate[0], candidate[1], candidate[2]))
+
+        selected = [set() for _ in nodes]
+        selected_text = {}
+        remaining = self.token_budget
+        for _, rank, i in candidates:
+            if remaining <= 0:
+                break
+            sentences = node_sentences[rank]
+            source = self._source(nodes[rank])
+            window = range(max(0, i - self.neighbor_sentences), min(len(sentences), i + self.neighbor_sentences + 1))
+            for j in window:
+                sentence = sentences[j]
+                if j in selected[rank] or sentence in selected_text.get(source, ""):
+                    # Già scelto, o ripetuto nella sovrapposizione con un altro chunk dello stesso documento
+                    continue
+                cost = estimate_tokens(sentence)
+                if cost > remaining:
+                    continue
+                selected[rank].add(j)
+                selected_text[source] = selected_text.get(source, "") + "\n" + sentence
+                remaining -= cost
+
+        compressed = []
+        for node, sentences, indices in zip(nodes, node_sentences, selected):
+            if not indices:
+                continue
+            parts = []
+            previous = None
+            for j in sorted(indices):
+                if previous is not None:
+                    parts.append(" " if j == previous + 1 else GAP_MARKER)
+                parts.append(sentences[j])
+                previous = j
+            new_node = node.node.model_copy()
+            new_node.set_content("".join(parts))
+            compressed.append(NodeWithScore(node=new_node, score=node.score))
+        return compressed or nodes[:1]
@@ -0,0 +1,245 @@
+"""
+Sincronizzazione incrementale fra due deployment Qdrant tramite file delta.
+
+L'esportazione confronta la collezione sorgente con un manifest (ID dei punti
+con un hash di payload e vettori, alla precisione float16 esportata) e scrive
+solo i punti nuovi o il cui hash è cambiato, più un tombstone per ogni punto
+eliminato. Il confronto si basa solo sui dati: non richiede che chi scrive
+nella collezione sorgente (preparation.ipynb per il cloud) aggiorni il campo
+di payload 'updated_at', che viene escluso dall'hash. Il costo è la lettura
+completa della collezione (con i vettori) a ogni esportazione.
+
+Il file è un JSON Lines compresso con gzip: una riga di intestazione e una
+riga per operazione, con i vettori densi in float16 codificati in base64.
+All'applicazione i nomi dei vettori vengono adattati alla collezione di
+destinazione (es. vettore senza nome del cloud -> 'text-dense' delle
+collezioni create da update.py --rebuild).
+
+Dipende solo da qdrant-client e dalla libreria standard, così migrate.py può
+essere eseguito anche senza le dipendenze dell'app.
+"""
+import base64
+import gzip
+import hashlib
+import json
+import os
+import struct
+import time
+
+from qdrant_client import models
+
+DELTA_FORMAT_VERSION = 1
+UPDATED_AT_KEY = "updated_at"
+
+
+def _encode_vector(vector):
+    if isinstance(vector, models.SparseVector):
+        return {"indices": vector.indices, "values": vector.values}
+    return {"f16": base64.b64encode(struct.pack(f"<{len(vector)}e", *vector)).decode("ascii")}
+
+
+def _decode_vector(data):
+    if "indices" in data:
+        return models.SparseVector(indices=data["indices"], values=data["values"])
+    raw = base64.b64decode(data["f16"])
+    return list(struct.unpack(f"<{len(raw) // 2}e", raw))
+
+
+def encode_vectors(vector):
+    """Vettori di un punto come dizionario nome -> vettore ('' per il vettore senza nome)."""
+    if isinstance(vector, dict):
+        return {name: _encode_vector(value) for name, value in vector.items()}
+    return {"": _encode_vector(vector)}
+
+
+def point_hash(payload, encoded_vectors):
+    """Hash del contenuto di un punto (payload senza 'updated_at' e vettori già codificati)."""
+    payload = {key: value for key, value in (payload or {}).items() if key != UPDATED_AT_KEY}
+    content = json.dumps({"payload": payload, "vector": encoded_vectors}, sort_keys=True, ensure_ascii=False)
+    return hashlib.blake2b(content.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def load_manifest(filepath):
+    if not os.path.exists(filepath):
+        return {}
+    with open(filepath, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_manifest(filepath, collection_name, watermark, point_hashes):
+    tmp_path = filepath + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"collection": collection_name, "watermark": watermark, "hashes": point_hashes}, f, sort_keys=True)
+    os.replace(tmp_path, filepath)
+
+
+def scroll_points(client, collection_name, batch_size=256):
+    """Tutti i punti della collezione, con payload e vettori, a blocchi."""
+    offset = None
+    while True:
+        points, offset = client.scroll(
+            collection_name=collection_name,
+            limit=batch_size,
+            offset=offset,
+            with_payload=True,
+            with_vectors=True,
+        )
+        yield from points
+        if offset is None:
+            return
+
+
+def record_manifest(client, collection_name, manifest_path, watermark, batch_size=256):
+    """Registra lo stato attuale della collezione come base per il prossimo delta (es. dopo uno snapshot)."""
+    point_hashes = {
+        str(point.id): point_hash(point.payload, encode_vectors(point.vector))
+        for point in scroll_points(client, collection_name, batch_size)
+    }
+    save_manifest(manifest_path, collection_name, watermark, point_hashes)
+
+
+def export_delta(client, collection_name, manifest_path, output_path, batch_size=256):
+    """
+    Scrive in `output_path` il delta della collezione rispetto al manifest e
+    aggiorna il manifest. Senza manifest (o per un'altra collezione, o con un
+    manifest senza hash) esporta tutto. Restituisce (punti esportati, tombstone).
+    """
+    manifest = load_manifest(manifest_path)
+    if manifest.get("collection") != collection_name:
+        manifest = {}
+    previous_hashes = manifest.get("hashes", {})
+    started = time.time()
+
+    current_hashes = {}
+    upserts = 0
+    tmp_path = output_path + ".tmp"
+    tmp_body_path = output_path + ".body.tmp"
+    # Le operazioni vanno in un file temporaneo: l'intestazione con i conteggi si scrive alla fine
+    with open(tmp_body_path, "w", encoding="utf-8") as body:
+        for point in scroll_points(client, collection_name, batch_size):
+            point_id = str(point.id)
+            vectors = encode_vectors(point.vector)
+            current_hashes[point_id] = point_hash(point.payload, vectors)
+            if previous_hashes.get(point_id) != current_hashes[point_id]:
+                record = {"op": "upsert", "id": point_id, "payload": point.payload, "vector": vectors}
+                body.write(json.dumps(record, ensure_ascii=False) + "\n")
+                upserts += 1
+        deleted_ids = sorted(set(previous_hashes) - set(current_hashes))
+        for point_id in deleted_ids:
+            body.write(json.dumps({"op": "delete", "id": point_id}) + "\n")
+
+    with gzip.open(tmp_path, "wt", encoding="utf-8") as f, open(tmp_body_path, "r", encoding="utf-8") as body:
+        header = {
+            "version": DELTA_FORMAT_VERSION,
+            "collection": collection_name,
+            "from_watermark": manifest.get("watermark"),
+            "to_watermark": started,
+            "upserts": upserts,
+            "deletes": len(deleted_ids),
+        }
+        f.write(json.dumps(header) + "\n")
+        for line in body:
+            f.write(line)
+    os.remove(tmp_body_path)
+    os.replace(tmp_path, output_path)
+
+    # Il manifest avanza solo dopo che il delta è stato scritto per intero
+    save_manifest(manifest_path, collection_name, started, current_hashes)
+    return upserts, len(deleted_ids)
+
+
+def read_delta(filepath):
+    """Restituisce (intestazione, iteratore sulle operazioni) di un file delta."""
+    f = gzip.open(filepath, "rt", encoding="utf-8")
+    header = json.loads(f.readline())
+    if header.get("version") != DELTA_FORMAT_VERSION:
+        f.close()
+        raise ValueError(f"Versione del file delta non supportata: {header.get('version')}.")
+
+    def records():
+        with f:
+            for line in f:
+                yield json.loads(line)
+
+    return header, records()
+
+
+def vector_mapper(client, collection_name):
+    """
+    Funzione che adatta i vettori decodificati di un punto (nome -> vettore)
+    alla configurazione della collezione di destinazione: i nomi presenti
+    restano, un unico vettore denso (o sparso) con un altro nome prende quello
+    dell'unico vettore denso (o sparso) della destinazione, gli altri vengono
+    scartati. Solleva ValueError se non resta nessun vettore denso.
+    """
+    params = client.get_collection(collection_name=collection_name).config.params
+    unnamed_target = not isinstance(params.vectors, dict)
+    dense_names = set() if unnamed_target else set(params.vectors)
+    sparse_names = set(params.sparse_vectors or {})
+
+    def map_vectors(vectors):
+        dense = {name: vector for name, vector in vectors.items() if not isinstance(vector, models.SparseVector)}
+        sparse = {name: vector for name, vector in vectors.items() if isinstance(vector, models.SparseVector)}
+        if unnamed_target:
+            if "" in dense:
+                return dense[""]
+            if len(dense) == 1:
+                return next(iter(dense.values()))
+            raise ValueError(f"Vettori {sorted(dense)} non adattabili al vettore senza nome di '{collection_name}'.")
+        mapped = {name: vector for name, vector in dense.items() if name in dense_names}
+        if not mapped and len(dense) == 1 and len(dense_names) == 1:
+            mapped[next(iter(dense_names))] = next(iter(dense.values()))
+        if not mapped:
+            raise ValueError(f"Vettori {sorted(dense)} non adattabili ai vettori {sorted(dense_names)} di '{collection_name}'.")
+        mapped_sparse = {name: vector for name, vector in sparse.items() if name in sparse_names}
+        if not mapped_sparse and len(sparse) == 1 and len(sparse_names) == 1:
+            mapped_sparse[next(iter(sparse_names))] = next(iter(sparse.values()))
+        mapped.update(mapped_sparse)
+        return mapped
+
+    return map_vectors
+
+
+def apply_delta(client, collection_name, filepath, batch_size=256):
+    """
+    Applica un file delta alla collezione con upsert ed eliminazioni a blocchi,
+    senza attesa per blocco; l'ultima scrittura attende l'applicazione di tutte.
+    I vettori sono adattati alla configurazione della collezione (vector_mapper).
+    Restituisce (punti scritti, punti eliminati).
+    """
+    map_vectors = vector_mapper(client, collection_name)
+    header, records = read_delta(filepath)
+    counts = {"upsert": 0, "delete": 0}
+    pending = {"upsert": [], "delete": []}
+    last_sent = None
+
+    def send(op, batch, wait=False):
+        nonlocal last_sent
+        if op == "upsert":
+            client.upsert(collection_name=collection_name, points=batch, wait=wait)
+        else:
+            client.delete(collection_name=collection_name, points_selector=models.PointIdsList(points=batch), wait=wait)
+        last_sent = (op, batch)
+
+    for record in records:
+        op = record["op"]
+        if op == "upsert":
+            vectors = {name: _decode_vector(value) for name, value in record["vector"].items()}
+            item = models.PointStruct(id=record["id"], payload=record["payload"], vector=map_vectors(vectors))
+        elif op == "delete":
+            item = record["id"]
+        else:
+            continue
+        pending[op].append(item)
+        counts[op] += 1
+        if len(pending[op]) >= batch_size:
+            send(op, pending[op])
+            pending[op] = []
+
+    # I tombstone seguono gli upsert nel file: l'ultimo blocco inviato attende l'applicazione di tutti
+    final = [(op, pending[op]) for op in ("upsert", "delete") if pending[op]]
+    if not final and last_sent is not None:
+        final = [last_sent]  # riscrittura idempotente dell'ultimo blocco, solo come barriera
+    for i, (op, batch) in enumerate(final):
+        send(op, batch, wait=i == len(final) - 1)
+    return counts["upsert"], counts["delete"]
@@ -0,0 +1,332 @@
+"""
+Cache degli embedding: persistente per i nodi, in memoria per le query.
+
+I vettori sono salvati in float16 in un file binario letto tramite memory map,
+mentre un indice SQLite associa a ogni chiave (hash del testo da incorporare e
+del nome del modello) la riga corrispondente. In questo modo la ricostruzione
+di una collezione o un nuovo esperimento di chunking non ricalcola i vettori
+già ottenuti in precedenza.
+
+Le query della chat usano invece una cache LRU con scadenza (TTL), condivisa
+da tutte le sessioni del processo.
+"""
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, List, Optional
+
+import numpy as np
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from pydantic import PrivateAttr
+
+
+def make_embedding_key(text, model_name):
+    """
+    Chiave di cache: SHA256 dell'identificativo del modello (vedi
+    CachedEmbedding: nome, più backend e quantizzazione se diversi
+    dall'originale) e del testo da incorporare.
+    """
+    return hashlib.sha256(f"{model_name}\x00{text}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Archivio di vettori float16 (file `vectors.f16`, accesso in memory map)
+    con indice chiave -> riga in SQLite (`index.sqlite`). I vettori sparsi
+    (pesi lessicali, di lunghezza variabile) sono salvati nello stesso database,
+    con la stessa chiave del vettore denso.
+    """
+
+    DTYPE = np.float16
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.vectors_path = os.path.join(directory, "vectors.f16")
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(os.path.join(directory, "index.sqlite"), check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, row INTEGER NOT NULL)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sparse (key TEXT PRIMARY KEY, indices BLOB NOT NULL, weights BLOB NOT NULL)"
+        )
+        self._conn.commit()
+        dim = self._conn.execute("SELECT value FROM meta WHERE name = 'dim'").fetchone()
+        self.dim = int(dim[0]) if dim else None
+        self._mmap = None
+        self._mmap_rows = 0
+
+    def _rows_on_disk(self):
+        if self.dim is None or not os.path.exists(self.vectors_path):
+            return 0
+        return os.path.getsize(self.vectors_path) // (self.dim * np.dtype(self.DTYPE).itemsize)
+
+    def _vectors(self):
+        """Memory map del file dei vettori, riaperta solo se il file è cresciuto."""
+        rows = self._rows_on_disk()
+        if rows and rows != self._mmap_rows:
+            self._mmap = np.memmap(self.vectors_path, dtype=self.DTYPE, mode="r", shape=(rows, self.dim))
+            self._mmap_rows = rows
+        return self._mmap
+
+    def get_many(self, keys):
+        """Restituisce un dizionario chiave -> vettore (lista di float) per le chiavi presenti."""
+        if not keys or self.dim is None:
+            return {}
+        with self._lock:
+            rows = {}
+            unique_keys = list(dict.fromkeys(keys))
+            # SQLite limita il numero di parametri per query: interroga a blocchi
+            for i in range(0, len(unique_keys), 500):
+                block = unique_keys[i:i + 500]
+                placeholders = ",".join("?" * len(block))
+                rows.update(self._conn.execute(
+                    f"SELECT key, row FROM embeddings WHERE key IN ({placeholders})", block
+                ).fetchall())
+            vectors = self._vectors()
+            return {key: vectors[row].astype(np.float32).tolist() for key, row in rows.items()}
+
+    def put_many(self, items):
+        """Aggiunge i vettori `items` (dizionario chiave -> vettore) in coda al file."""
+        if not items:
+            return
+        with self._lock:
+            matrix = np.asarray(list(items.values()), dtype=self.DTYPE)
+            if self.dim is None:
+                self.dim = matrix.shape[1]
+                self._conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('dim', ?)", (str(self.dim),))
+            elif matrix.shape[1] != self.dim:
+                raise ValueError(f"Dimensione del vettore {matrix.shape[1]} diversa da quella della cache ({self.dim}).")
+
+            first_row = self._rows_on_disk()
+            row_bytes = self.dim * np.dtype(self.DTYPE).itemsize
+            with open(self.vectors_path, "ab") as f:
+                # Una riga parziale lasciata da un'interruzione viene scartata: le nuove righe restano allineate
+                if f.tell() != first_row * row_bytes:
+                    f.truncate(first_row * row_bytes)
+                    f.seek(first_row * row_bytes)
+                f.write(matrix.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            # L'indice viene aggiornato solo dopo la scrittura dei vettori: in caso di
+            # interruzione restano al più righe orfane, mai chiavi senza vettore.
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, row) VALUES (?, ?)",
+                ((key, first_row + i) for i, key in enumerate(items.keys())),
+            )
+            self._conn.commit()
+
+    def get_sparse_many(self, keys):
+        """Restituisce un dizionario chiave -> (indici, pesi) per i vettori sparsi presenti."""
+        if not keys:
+            return {}
+        with self._lock:
+            found = {}
+            unique_keys = list(dict.fromkeys(keys))
+            for i in range(0, len(unique_keys), 500):
+                block = unique_keys[i:i + 500]
+                placeholders = ",".join("?" * len(block))
+                for key, indices, weights in self._conn.execute(
+                    f"SELECT key, indices, weights FROM sparse WHERE key IN ({placeholders})", block
+                ):
+                    found[key] = (
+                        np.frombuffer(indices, dtype=np.int32).tolist(),
+                        np.frombuffer(weights, dtype=np.float32).tolist(),
+                    )
+            return found
+
+    def put_sparse_many(self, items):
+        """Salva i vettori sparsi `items` (dizionario chiave -> (indici, pesi))."""
+        if not items:
+            return
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO sparse (key, indices, weights) VALUES (?, ?, ?)",
+                (
+                    (key, np.asarray(indices, dtype=np.int32).tobytes(), np.asarray(weights, dtype=np.float32).tobytes())
+                    for key, (indices, weights) in items.items()
+                ),
+            )
+            self._conn.commit()
+
+    def __len__(self):
+        return self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def close(self):
+        self._conn.close()
+
+
+def normalize_query(query):
+    """Normalizza una query per la cache: minuscolo, spazi compattati, senza punteggiatura finale."""
+    return re.sub(r"\s+", " ", query.strip().lower()).rstrip(" ?!.")
+
+
+class QueryEmbeddingCache:
+    """
+    Cache LRU in memoria, con scadenza (TTL), degli embedding delle query.
+    Thread-safe: è pensata per essere condivisa da tutte le sessioni Streamlit del processo.
+    """
+
+    def __init__(self, max_size=5000, ttl_seconds=24 * 3600):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, query, model_name):
+        key = (model_name, normalize_query(query))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.monotonic() - entry[0] > self.ttl_seconds:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, query, model_name, embedding):
+        key = (model_name, normalize_query(query))
+        with self._lock:
+            self._entries[key] = (time.monotonic(), embedding)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+_query_cache = None
+_query_cache_lock = threading.Lock()
+
+
+def get_query_embedding_cache():
+    """Cache delle query unica per processo (dimensione e TTL da QUERY_EMBED_CACHE_SIZE / _TTL)."""
+    global _query_cache
+    with _query_cache_lock:
+        if _query_cache is None:
+            _query_cache = QueryEmbeddingCache(
+                max_size=int(os.getenv("QUERY_EMBED_CACHE_SIZE", 5000)),
+                ttl_seconds=int(os.getenv("QUERY_EMBED_CACHE_TTL", 24 * 3600)),
+            )
+        return _query_cache
+
+
+class CachedEmbedding(BaseEmbedding):
+    """
+    Modello di embedding con cache davanti al modello sottostante:
+    - `cache` (EmbeddingCache): i testi dei nodi mai visti per questo modello
+      vengono effettivamente incorporati, gli altri letti dal disco;
+    - `query_cache` (QueryEmbeddingCache): le query ripetute non vengono ricalcolate.
+    Entrambe sono opzionali.
+
+    Se il modello sottostante calcola anche i vettori sparsi (`encode_sparse`),
+    anche questi passano dalla cache persistente: un nodo già incorporato non
+    richiede un nuovo passaggio del modello per la ricerca ibrida.
+
+    Le voci sono indicizzate dal `cache_id` del modello sottostante, se lo
+    definisce, altrimenti dal suo `model_name`: lo stesso modello eseguito con
+    un altro backend o quantizzazione (es. bge-m3 ONNX int8 locale rispetto
+    all'API fp32) produce vettori diversi e non deve condividerne le voci.
+    """
+
+    _embed_model: BaseEmbedding = PrivateAttr()
+    _cache: Optional[EmbeddingCache] = PrivateAttr()
+    _query_cache: Optional[QueryEmbeddingCache] = PrivateAttr()
+    _cache_id: str = PrivateAttr()
+
+    def __init__(self, embed_model: BaseEmbedding, cache: Optional[EmbeddingCache] = None,
+                 query_cache: Optional[QueryEmbeddingCache] = None, **kwargs: Any) -> None:
+        super().__init__(
+            model_name=embed_model.model_name,
+            embed_batch_size=embed_model.embed_batch_size,
+            **kwargs,
+        )
+        self._embed_model = embed_model
+        self._cache = cache
+        self._query_cache = query_cache
+        self._cache_id = getattr(embed_model, "cache_id", None) or embed_model.model_name
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CachedEmbedding"
+
+    @property
+    def supports_sparse(self) -> bool:
+        return getattr(self._embed_model, "supports_sparse", False)
+
+    def encode_sparse(self, texts: List[str]):
+        """Vettori sparsi dei testi (funzione sparsa di QdrantVectorStore), letti dalla cache se presenti."""
+        if self._cache is None:
+            return self._embed_model.encode_sparse(texts)
+        keys = [make_embedding_key(text, self._cache_id) for text in texts]
+        found = self._cache.get_sparse_many(keys)
+        missing = {key: text for key, text in zip(keys, texts) if key not in found}
+        if missing:
+            indices, weights = self._embed_model.encode_sparse(list(missing.values()))
+            computed = dict(zip(missing, zip(indices, weights)))
+            self._cache.put_sparse_many(computed)
+            found.update(computed)
+        return [found[key][0] for key in keys], [found[key][1] for key in keys]
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        if self._query_cache is None:
+            return self._embed_model.get_query_embedding(query)
+        embedding = self._query_cache.get(query, self._cache_id)
+        if embedding is None:
+            embedding = self._embed_model.get_query_embedding(query)
+            self._query_cache.put(query, self._cache_id, embedding)
+        return embedding
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        if self._query_cache is None:
+            return await self._embed_model.aget_query_embedding(query)
+        embedding = self._query_cache.get(query, self._cache_id)
+        if embedding is None:
+            embedding = await self._embed_model.aget_query_embedding(query)
+            self._query_cache.put(query, self._cache_id, embedding)
+        return embedding
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._get_text_embeddings([text])[0]
+
+    async def _aget_text_embedding(self, text: str) -> List[float]:
+        return (await self._aget_text_embeddings([text]))[0]
+
+    def _split_cached(self, texts):
+        keys = [make_embedding_key(text, self._cache_id) for text in texts]
+        found = self._cache.get_many(keys) if self._cache is not None else {}
+        # Un solo calcolo per testo, anche se ripetuto nello stesso batch
+        first_index = {}
+        for i, key in enumerate(keys):
+            if key not in found:
+                first_index.setdefault(key, i)
+        return keys, found, list(first_index.values())
+
+    def _merge(self, keys, found, missing, new_embeddings):
+        computed = {keys[i]: embedding for i, embedding in zip(missing, new_embeddings)}
+        if self._cache is not None:
+            self._cache.put_many(computed)
+        found.update(computed)
+        return [found[key] for key in keys]
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        keys, found, missing = self._split_cached(texts)
+        new_embeddings = []
+        if missing:
+            new_embeddings = self._embed_model.get_text_embedding_batch([texts[i] for i in missing])
+        return self._merge(keys, found, missing, new_embeddings)
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        keys, found, missing = self._split_cached(texts)
+        new_embeddings = []
+        if missing:
+            new_embeddings = await self._embed_model.aget_text_embedding_batch([texts[i] for i in missing])
+        return self._merge(keys, found, missing, new_embeddings)
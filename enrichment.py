@@ -0,0 +1,710 @@
+"""
+Motore di arricchimento dei metadati tramite LLM usato da update.py.
+
+Le chiamate a Gemini vengono eseguite in modo concorrente e regolate da un
+limitatore a token bucket (richieste e token al minuto), così da sfruttare
+tutta la quota disponibile invece di attendere a vuoto tra un documento e l'altro.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import random
+import re
+import time
+from collections import Counter
+from math import log
+from urllib.parse import urlparse, parse_qs
+
+from tqdm import tqdm
+
+# Stima grossolana: circa 4 caratteri per token (sufficiente per il rate limiting)
+CHARS_PER_TOKEN = 4
+# Token di output stimati per ogni risposta JSON di metadati
+OUTPUT_TOKENS_ESTIMATE = 400
+
+# Versione del prompt di estrazione: va incrementata ogni volta che il prompt
+# (o il formato della risposta) cambia, così da invalidare la cache dei metadati.
+PROMPT_VERSION = "v2"
+
+# Campi dei metadati prodotti dall'arricchimento, nell'ordine del formato JSON
+ALL_FIELDS = ("title", "summary", "questions", "keywords", "years")
+
+
+def estimate_tokens(text):
+    """Stima il numero di token di un testo senza dipendere da un tokenizer."""
+    return max(1, len(text) // CHARS_PER_TOKEN)
+
+
+class TokenBucket:
+    """
+    Token bucket asincrono: `capacity` unità per `period_seconds`,
+    ricaricate in modo continuo.
+    """
+
+    def __init__(self, capacity, period_seconds=60.0):
+        self.capacity = float(capacity)
+        self.rate = self.capacity / period_seconds
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def drain(self):
+        """Svuota il bucket (usato quando il server segnala un 429)."""
+        self._refill()
+        self._tokens = 0.0
+
+    async def acquire(self, amount=1):
+        """Attende finché non sono disponibili `amount` unità e le consuma."""
+        # Una richiesta più grande dell'intero bucket passa comunque quando è pieno
+        amount = min(float(amount), self.capacity)
+        # Il lock garantisce un ordine FIFO tra i chiamanti in attesa
+        async with self._lock:
+            while True:
+                self._refill()
+                if self._tokens >= amount:
+                    self._tokens -= amount
+                    return
+                await asyncio.sleep((amount - self._tokens) / self.rate)
+
+
+class RateLimiter:
+    """Limita sia le richieste al minuto (RPM) sia i token al minuto (TPM)."""
+
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+
+    async def acquire(self, estimated_tokens):
+        await self.requests.acquire(1)
+        await self.tokens.acquire(estimated_tokens)
+
+    def backoff(self):
+        """Azzera entrambi i bucket: tutti i worker rallentano dopo un 429."""
+        self.requests.drain()
+        self.tokens.drain()
+
+
+class EnrichmentCache:
+    """
+    Cache persistente dei metadati generati dall'LLM, indirizzata per contenuto:
+    la chiave è l'hash SHA256 della versione del prompt, dei campi richiesti e del
+    testo del documento.
+    Un documento invariato (anche se ri-scaricato) non richiede nuove chiamate.
+    """
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.hits = 0
+        self.misses = 0
+        self._entries = self._load()
+
+    def _load(self):
+        if not os.path.exists(self.filepath) or os.path.getsize(self.filepath) == 0:
+            return {}
+        try:
+            with open(self.filepath, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (json.JSONDecodeError, IOError) as e:
+            print(f"Attenzione: impossibile leggere la cache dei metadati '{self.filepath}'. Parto da una cache vuota. Errore: {e}")
+            return {}
+
+    @staticmethod
+    def make_key(text, fields=ALL_FIELDS, prompt_version=PROMPT_VERSION):
+        return hashlib.sha256(f"{prompt_version}:{','.join(fields)}\n{text}".encode("utf-8")).hexdigest()
+
+    def get(self, text, fields=ALL_FIELDS):
+        metadata = self._entries.get(self.make_key(text, fields))
+        if metadata is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return dict(metadata)
+
+    def put(self, text, metadata, fields=ALL_FIELDS):
+        self._entries[self.make_key(text, fields)] = metadata
+
+    def save(self):
+        """Salva la cache in modo atomico (file temporaneo + rename)."""
+        directory = os.path.dirname(self.filepath)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{self.filepath}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self._entries, f, ensure_ascii=False)
+            os.replace(tmp_path, self.filepath)
+        except IOError as e:
+            print(f"Errore: impossibile salvare la cache dei metadati '{self.filepath}'. Errore: {e}")
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def is_rate_limit_error(error):
+    """Riconosce gli errori di quota (HTTP 429 / RESOURCE_EXHAUSTED) dei client LLM."""
+    status = getattr(error, "code", None) or getattr(error, "status_code", None)
+    if status == 429:
+        return True
+    message = str(error)
+    return "429" in message or "RESOURCE_EXHAUSTED" in message or "rate limit" in message.lower()
+
+
+async def complete_with_retry(llm, prompt, limiter, max_retries=5, base_delay=2.0, max_delay=60.0, output_tokens=OUTPUT_TOKENS_ESTIMATE):
+    """
+    Esegue `llm.acomplete` rispettando il limitatore e ritentando sui 429
+    con backoff esponenziale e jitter ("full jitter").
+    """
+    estimated_tokens = estimate_tokens(prompt) + output_tokens
+    for attempt in range(max_retries + 1):
+        await limiter.acquire(estimated_tokens)
+        try:
+            return await llm.acomplete(prompt)
+        except Exception as e:
+            if not is_rate_limit_error(e) or attempt == max_retries:
+                raise
+            limiter.backoff()
+            delay = random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
+            await asyncio.sleep(delay)
+
+
+# Regole e formato comuni al prompt singolo e a quello a lotti.
+# Il prompt include solo le regole e i campi effettivamente richiesti all'LLM.
+GENERAL_RULE = "- Se il documento è troppo breve o non contiene informazioni sufficienti per generare un campo specifico (title, summary, etc.), lascia quel campo vuoto (es. `\"title\": \"\"` o `\"questions\": []`).\n"
+
+FIELD_RULES = {
+    "keywords": "- **Keywords**: Estrai un numero di parole chiave proporzionale alla lunghezza del testo, fino a un massimo di 10. Per documenti molto brevi, poche parole chiave (o nessuna) sono accettabili.\n",
+    "questions": "- **Domande**: Genera un numero di domande proporzionale alla lunghezza del testo, fino a un massimo di 3. Per documenti molto brevi, una sola domanda o nessuna sono accettabili.\n",
+}
+
+YEARS_RULES = (
+    "REGOLE PER 'years':\n"
+    "- Identifica l'anno o gli anni accademici (es. '2024/2025') o solari (es. '2023') *PRINCIPALI* del documento. Controlla sia il testo che l'URL di origine.\n"
+    "- Se il documento tratta un singolo anno, inserisci solo quello. Esempio: [\"2023\"].\n"
+    "- Se nell'URL è presente il parametro 'anno', considera il suo valore corrispondente come UNICO anno principale, NON considerare il parametro quando 'anno=0'.\n"
+    "- Se tratta più anni, IDENTIFICA QUELLO PRINCIPALE ed inseriscilo, altrimenti inseriscili tutti. Esempio: [\"2022\", \"2023\", \"2024\"].\n"
+    "- Se non riesci ad identificare l'anno principale dal testo, ma è presente nell'URL, usa quello. Esempio: [\"2023\"] se l'URL contiene 'anno=2023' (sempre escludendo il caso in cui sia 'anno=0').\n"
+    "- Se non ha un anno di riferimento, lascia la lista vuota. Esempio: [].\n\n"
+)
+
+FIELD_FORMATS = {
+    "title": '"title": "Un titolo conciso e descrittivo del documento"',
+    "summary": '"summary": "Un riassunto di 2-3 frasi del contenuto principale"',
+    "questions": '"questions": []',  # Da 0 a 3 domande in base alla lunghezza del testo
+    "keywords": '"keywords": []',    # Da 0 a 10 parole chiave in base alla lunghezza del testo
+    "years": '"years": []',
+}
+
+
+def build_metadata_rules(fields=ALL_FIELDS):
+    """Regole del prompt relative ai soli campi richiesti."""
+    rules = "REGOLE GENERALI:\n" + GENERAL_RULE
+    rules += "".join(FIELD_RULES[field] for field in ("keywords", "questions") if field in fields)
+    rules += "\n"
+    if "years" in fields:
+        rules += YEARS_RULES
+    return rules
+
+
+def build_json_fields(fields=ALL_FIELDS):
+    """Righe del formato JSON richiesto per i soli campi richiesti."""
+    return ",\n".join(f"  {FIELD_FORMATS[field]}" for field in fields) + "\n"
+
+
+def build_enrichment_prompt(document, text=None, fields=ALL_FIELDS):
+    """
+    Costruisce il prompt di estrazione dei metadati per un singolo documento.
+    `text` permette di sostituire il testo completo con una sua versione ridotta,
+    `fields` limita la richiesta ai campi non ricavabili localmente.
+    """
+    if text is None:
+        text = document.text
+    return (
+        "Analizza il seguente documento, inclusa la sua URL di origine, per estrarre i metadati richiesti. "
+        "Fornisci l'output esclusivamente in formato JSON, seguendo la struttura e le regole specificate.\n\n"
+        "--- DOCUMENTO ---\n"
+        f'"""{text}"""\n'
+        "--- FINE DOCUMENTO ---\n\n"
+        + build_metadata_rules(fields) +
+        "Formato JSON richiesto:\n"
+        "{\n"
+        + build_json_fields(fields) +
+        "}\n\n"
+        "Output JSON:"
+    )
+
+
+def build_batch_enrichment_prompt(items, fields=ALL_FIELDS):
+    """
+    Costruisce un unico prompt per più documenti brevi.
+    `items` è una lista di coppie (id, documento); la risposta attesa è un
+    array JSON con un oggetto per documento, identificato dal campo "id".
+    """
+    documents_block = "".join(
+        f"--- DOCUMENTO id={item_id} ---\n"
+        f'"""{document.text}"""\n'
+        f"--- FINE DOCUMENTO id={item_id} ---\n\n"
+        for item_id, document in items
+    )
+    return (
+        f"Analizza ciascuno dei seguenti {len(items)} documenti, in modo indipendente dagli altri, per estrarre i metadati richiesti. "
+        "Fornisci l'output esclusivamente come array JSON, con un oggetto per ogni documento, seguendo la struttura e le regole specificate.\n\n"
+        + documents_block
+        + build_metadata_rules(fields) +
+        "Formato JSON richiesto (un oggetto per documento, con lo stesso \"id\" indicato nell'intestazione del documento):\n"
+        "[\n"
+        "{\n"
+        '  "id": "1",\n'
+        + build_json_fields(fields) +
+        "}\n"
+        "]\n\n"
+        "Output JSON:"
+    )
+
+
+# Righe che identificano l'inizio di una sezione: titoli Markdown e intestazioni tipiche dei regolamenti
+HEADING_PATTERN = re.compile(
+    r"^\s*(#{1,6}\s+\S.*|(art\.?|articolo|capo|titolo|sezione|allegato)\s+[0-9IVXLC]+\b.*)$",
+    re.IGNORECASE,
+)
+OMISSION_MARKER = "\n[...]\n"
+
+
+def _cut_at_line(text, max_chars):
+    """Tronca il testo a `max_chars`, possibilmente alla fine di una riga."""
+    if len(text) <= max_chars:
+        return text
+    cut = text.rfind("\n", 0, max_chars)
+    return text[:cut] if cut > max_chars // 2 else text[:max_chars]
+
+
+def extract_headings(text, max_chars):
+    """Restituisce i titoli delle sezioni del documento (senza duplicati) entro `max_chars`."""
+    headings = []
+    seen = set()
+    used_chars = 0
+    for line in text.splitlines():
+        line = line.strip()
+        if len(line) > 200 or line in seen or not HEADING_PATTERN.match(line):
+            continue
+        if used_chars + len(line) + 1 > max_chars:
+            break
+        seen.add(line)
+        headings.append(line)
+        used_chars += len(line) + 1
+    return headings
+
+
+def budget_document_text(text, max_tokens, head_ratio=0.4, headings_ratio=0.2, sample_chunk_tokens=400):
+    """
+    Riduce un documento lungo entro `max_tokens` token stimati.
+    Mantiene l'inizio del documento, l'elenco dei titoli delle sezioni e un
+    campione di estratti distribuiti uniformemente nel resto del testo.
+    I documenti che rientrano nel budget vengono restituiti invariati.
+    """
+    max_chars = max_tokens * CHARS_PER_TOKEN
+    if len(text) <= max_chars:
+        return text
+
+    head = _cut_at_line(text, int(max_chars * head_ratio))
+    headings = extract_headings(text[len(head):], int(max_chars * headings_ratio))
+    headings_block = ""
+    if headings:
+        headings_block = "\n--- STRUTTURA DEL DOCUMENTO (titoli delle sezioni) ---\n" + "\n".join(headings) + "\n"
+
+    # Estratti campionati a intervalli regolari nella parte restante del documento
+    remaining_chars = max_chars - len(head) - len(headings_block)
+    rest = text[len(head):]
+    chunk_chars = sample_chunk_tokens * CHARS_PER_TOKEN
+    n_samples = remaining_chars // (chunk_chars + len(OMISSION_MARKER))
+    samples = []
+    if n_samples > 0:
+        stride = max(chunk_chars, len(rest) // n_samples)
+        for start in range(0, len(rest), stride)[:n_samples]:
+            samples.append(_cut_at_line(rest[start:start + chunk_chars], chunk_chars).strip())
+
+    parts = [head.rstrip(), headings_block]
+    if samples:
+        parts.append("\n--- ESTRATTI DAL RESTO DEL DOCUMENTO ---" + OMISSION_MARKER + OMISSION_MARKER.join(samples))
+    return "\n".join(part for part in parts if part) + OMISSION_MARKER
+
+
+def build_section_summary_prompt(section_text, index, total):
+    """Prompt della fase "map": riassunto di una singola sezione di un documento molto lungo."""
+    return (
+        f"Il testo seguente è la sezione {index} di {total} di un documento ufficiale universitario. "
+        "Riassumilo in al massimo 5 frasi, mantenendo titoli, anni accademici, date, scadenze, nomi di corsi e di docenti.\n\n"
+        "--- SEZIONE ---\n"
+        f'"""{section_text}"""\n'
+        "--- FINE SEZIONE ---\n\n"
+        "Riassunto:"
+    )
+
+
+def _strip_code_fences(response_text):
+    return response_text.strip().replace("```json", "").replace("```", "").strip()
+
+
+def parse_metadata_response(response_text):
+    """Rimuove gli eventuali delimitatori Markdown e decodifica il JSON restituito dall'LLM."""
+    return json.loads(_strip_code_fences(response_text))
+
+
+def parse_batch_metadata_response(response_text, expected_ids):
+    """
+    Estrae i metadati per documento da una risposta a lotti.
+    Se l'array completo non è JSON valido, recupera singolarmente ogni oggetto
+    decodificabile. Restituisce un dizionario id -> metadati con i soli id attesi;
+    gli id mancanti vanno rielaborati singolarmente.
+    """
+    cleaned = _strip_code_fences(response_text)
+    try:
+        parsed = json.loads(cleaned)
+        candidates = parsed if isinstance(parsed, list) else [parsed]
+    except json.JSONDecodeError:
+        # Recupero oggetto per oggetto: decodifica ogni '{' che apre un oggetto valido
+        candidates = []
+        decoder = json.JSONDecoder()
+        position = cleaned.find("{")
+        while position != -1:
+            try:
+                obj, end = decoder.raw_decode(cleaned, position)
+                candidates.append(obj)
+                position = cleaned.find("{", end)
+            except json.JSONDecodeError:
+                position = cleaned.find("{", position + 1)
+
+    expected_ids = set(expected_ids)
+    results = {}
+    for obj in candidates:
+        if not isinstance(obj, dict):
+            continue
+        item_id = str(obj.get("id", "")).strip()
+        if item_id in expected_ids and item_id not in results:
+            results[item_id] = {key: value for key, value in obj.items() if key != "id"}
+    return results
+
+
+def pack_batches(documents, max_doc_tokens, token_budget, max_items):
+    """
+    Separa i documenti brevi (al più `max_doc_tokens`) dagli altri e li
+    raggruppa in lotti entro `token_budget` token e `max_items` documenti.
+    Restituisce (lotti, documenti_da_elaborare_singolarmente).
+    """
+    batches = []
+    singles = []
+    current_batch = []
+    current_tokens = 0
+    for doc in documents:
+        doc_tokens = estimate_tokens(doc.text)
+        if doc_tokens > max_doc_tokens:
+            singles.append(doc)
+            continue
+        if current_batch and (current_tokens + doc_tokens > token_budget or len(current_batch) >= max_items):
+            batches.append(current_batch)
+            current_batch, current_tokens = [], 0
+        current_batch.append(doc)
+        current_tokens += doc_tokens
+    if current_batch:
+        batches.append(current_batch)
+
+    # Un lotto con un solo documento è meglio servito dal prompt singolo
+    singles.extend(batch[0] for batch in batches if len(batch) == 1)
+    batches = [batch for batch in batches if len(batch) > 1]
+    return batches, singles
+
+
+# --- Estrazione locale (senza LLM) dei metadati deterministici ---
+
+STOPWORDS = set("""
+a ad agli al alla alle allo ai anche avere che chi ci con come cui da dal dalla dalle dai degli dei del della delle dello di
+dove e ed essere fra gli ha hanno il in la le lo loro ma mi ne nei nel nella nelle nello noi non o per più po poi quale quali
+quando quanto quella quelle quello questa queste questo se sei si sia sono su sua sue sui sul sulla suo suoi tra tu un una uno
+vi voi anno anni sono stato stata stati essere può possono deve devono ogni altro altri altre tutti tutte tutto via nonché
+about after all also and any are as at be been but by can for from had has have if in into is it its may more not of on or
+our such than that the their there these this to was were which will with
+""".split())
+
+URL_PATTERN = re.compile(r"\(?https?://[^\s)]+\)?")
+MARKDOWN_LINK_PATTERN = re.compile(r"\[([^\]]*)\]\([^)]*\)")
+H1_PATTERN = re.compile(r"^#\s+(.+?)\s*#*$", re.MULTILINE)
+WORD_PATTERN = re.compile(r"[^\W\d_]{3,}")
+YEAR_PATTERN = re.compile(r"(19|20)\d{2}")
+
+
+def extract_years_from_url(url):
+    """
+    Anni ricavabili dall'URL: il parametro 'anno' (escluso 'anno=0') è l'unico
+    anno principale; in sua assenza si usano i segmenti del percorso come '/2025/'.
+    """
+    if not url:
+        return []
+    parsed_url = urlparse(url)
+    anno = parse_qs(parsed_url.query).get("anno", [None])[0]
+    if anno and anno != "0" and YEAR_PATTERN.fullmatch(anno):
+        return [anno]
+    segments = [segment for segment in parsed_url.path.split("/") if YEAR_PATTERN.fullmatch(segment)]
+    return list(dict.fromkeys(segments))
+
+
+def extract_title(text):
+    """Titolo dal primo heading di primo livello (<h1>, '# ' in Markdown) del documento."""
+    match = H1_PATTERN.search(text)
+    if not match:
+        return None
+    title = MARKDOWN_LINK_PATTERN.sub(r"\1", match.group(1))
+    title = title.replace("*", "").replace("_", " ").strip()
+    return title or None
+
+
+def _tokenize(text):
+    text = MARKDOWN_LINK_PATTERN.sub(r"\1", text)
+    text = URL_PATTERN.sub(" ", text)
+    return [word for word in WORD_PATTERN.findall(text) if word.lower() not in STOPWORDS]
+
+
+class LocalMetadataExtractor:
+    """
+    Estrae in modo deterministico i metadati che non richiedono un LLM:
+    'title' (dal titolo <h1>), 'years' (dall'URL) e 'keywords' (TF-IDF sul corpus).
+    La frequenza dei documenti è calcolata sui `documents` in elaborazione e sul
+    `corpus` già archiviato (coppie (id, testo), ad es. NodeStore.iter_document_texts),
+    dove le versioni archiviate dei documenti in elaborazione vengono ignorate:
+    così anche un aggiornamento incrementale con pochi documenti ha le keywords.
+    Le keywords vengono calcolate solo se il corpus è abbastanza ampio da
+    rendere significativa la frequenza inversa dei documenti.
+    """
+
+    def __init__(self, documents, min_corpus_size=20, max_keywords=10, words_per_keyword=50, corpus=()):
+        self.max_keywords = max_keywords
+        self.words_per_keyword = words_per_keyword
+        self._document_frequency = Counter()
+        self._n_documents = 0
+        current_ids = set()
+        for doc in documents:
+            current_ids |= {doc.id_, doc.metadata.get("source_url")}
+            self._count_document(doc.text)
+        for doc_id, text in corpus:
+            if doc_id not in current_ids:
+                self._count_document(text)
+        self.keywords_enabled = self._n_documents >= min_corpus_size
+
+    def _count_document(self, text):
+        if isinstance(text, str) and text.strip():
+            self._document_frequency.update({word.lower() for word in _tokenize(text)})
+            self._n_documents += 1
+
+    def extract_keywords(self, text):
+        words = _tokenize(text)
+        # Numero di keywords proporzionale alla lunghezza del testo, fino al massimo consentito
+        n_keywords = min(self.max_keywords, len(words) // self.words_per_keyword)
+        if n_keywords == 0:
+            return []
+        term_counts = Counter(word.lower() for word in words)
+        surface_forms = Counter(words)
+        scores = {
+            term: (count / len(words)) * (log((1 + self._n_documents) / (1 + self._document_frequency[term])) + 1)
+            for term, count in term_counts.items()
+        }
+        best_terms = sorted(scores, key=lambda term: (-scores[term], term))[:n_keywords]
+        # Restituisce la forma più frequente nel testo (es. "Erasmus" invece di "erasmus")
+        return [
+            max((form for form in surface_forms if form.lower() == term), key=lambda form: surface_forms[form])
+            for term in best_terms
+        ]
+
+    def extract(self, document):
+        """Restituisce i soli metadati individuati localmente."""
+        metadata = {}
+        title = extract_title(document.text)
+        if title:
+            metadata["title"] = title
+        years = extract_years_from_url(document.metadata.get("source_url"))
+        if years:
+            metadata["years"] = years
+        if self.keywords_enabled:
+            metadata["keywords"] = self.extract_keywords(document.text)
+        return metadata
+
+
+def llm_fields_for(local_metadata):
+    """Campi da chiedere all'LLM: summary e questions, più quelli non ricavati localmente."""
+    return tuple(
+        field for field in ALL_FIELDS
+        if field in ("summary", "questions") or field not in local_metadata
+    )
+
+
+def empty_metadata(fields):
+    """Valori vuoti per i campi indicati, come da regole del prompt."""
+    return {field: "" if field in ("title", "summary") else [] for field in fields}
+
+
+def _apply_metadata(document, metadata, fields, cache):
+    metadata = {field: metadata[field] for field in fields if field in metadata}
+    document.metadata.update(metadata) # Aggiorna direttamente i metadati del documento
+    if cache is not None:
+        cache.put(document.text, metadata, fields)
+
+
+async def _map_reduce_text(text, llm, limiter, semaphore, max_retries, budget):
+    """
+    Fase "map" per i documenti molto lunghi: riassume in parallelo le sezioni del
+    documento e restituisce l'inizio del testo seguito dai riassunti parziali,
+    a loro volta ridotti entro il budget.
+    """
+    part_chars = budget["map_part_tokens"] * CHARS_PER_TOKEN
+    sections = [text[i:i + part_chars] for i in range(0, len(text), part_chars)]
+    if len(sections) > budget["map_max_parts"]:
+        # Campiona le sezioni a intervalli regolari, mantenendo sempre la prima
+        stride = len(sections) / budget["map_max_parts"]
+        sections = [sections[int(i * stride)] for i in range(budget["map_max_parts"])]
+
+    async def summarize(index, section):
+        async with semaphore:
+            response = await complete_with_retry(
+                llm, build_section_summary_prompt(section, index, len(sections)), limiter, max_retries=max_retries
+            )
+        return response.text.strip()
+
+    summaries = await asyncio.gather(*(summarize(i, section) for i, section in enumerate(sections, start=1)))
+    head = _cut_at_line(text, int(budget["max_tokens"] * CHARS_PER_TOKEN * 0.3))
+    reduced = (
+        head.rstrip()
+        + "\n\n--- RIASSUNTI DELLE SEZIONI DEL DOCUMENTO ---\n"
+        + "\n\n".join(f"[Sezione {i}] {summary}" for i, summary in enumerate(summaries, start=1))
+    )
+    return budget_document_text(reduced, budget["max_tokens"])
+
+
+async def _prepare_text(text, llm, limiter, semaphore, max_retries, budget):
+    """Applica il budget di token al testo da inviare all'LLM (eventualmente con map-reduce)."""
+    if not budget:
+        return text
+    if budget.get("map_reduce") and estimate_tokens(text) > budget["map_reduce_threshold"]:
+        return await _map_reduce_text(text, llm, limiter, semaphore, max_retries, budget)
+    return budget_document_text(text, budget["max_tokens"])
+
+
+async def _enrich_document(document, fields, llm, limiter, semaphore, max_retries, cache, budget=None):
+    try:
+        text = await _prepare_text(document.text, llm, limiter, semaphore, max_retries, budget)
+        async with semaphore:
+            response = await complete_with_retry(llm, build_enrichment_prompt(document, text=text, fields=fields), limiter, max_retries=max_retries)
+        _apply_metadata(document, parse_metadata_response(response.text), fields, cache)
+    except Exception as e:
+        print(f"\nErrore durante l'arricchimento del documento {document.metadata.get('source_url', 'N/A')}: {e}")
+    return 1
+
+
+async def _enrich_batch(batch, fields, llm, limiter, semaphore, max_retries, cache):
+    items = [(str(i), doc) for i, doc in enumerate(batch, start=1)]
+    results = {}
+    async with semaphore:
+        try:
+            response = await complete_with_retry(
+                llm, build_batch_enrichment_prompt(items, fields), limiter,
+                max_retries=max_retries, output_tokens=OUTPUT_TOKENS_ESTIMATE * len(items),
+            )
+            results = parse_batch_metadata_response(response.text, [item_id for item_id, _ in items])
+        except Exception as e:
+            print(f"\nErrore durante l'arricchimento di un lotto di {len(items)} documenti: {e}. Ripiego sulle richieste singole.")
+
+    # I documenti assenti, non decodificabili o privi di qualche campo richiesto nella
+    # risposta vengono rielaborati singolarmente, prima di finire in cache
+    fallback = []
+    for item_id, doc in items:
+        if item_id in results and all(field in results[item_id] for field in fields):
+            _apply_metadata(doc, results[item_id], fields, cache)
+        else:
+            fallback.append(doc)
+    if 0 < len(fallback) < len(items):
+        print(f"\nLotto di {len(items)} documenti: {len(fallback)} senza metadati completi, rielaborati singolarmente.")
+    if fallback:
+        await asyncio.gather(*(_enrich_document(doc, fields, llm, limiter, semaphore, max_retries, cache) for doc in fallback))
+    return len(items)
+
+
+async def enrich_documents_async(documents, llm, requests_per_minute, tokens_per_minute, max_concurrency, max_retries=5, cache=None, batching=None, budget=None, local_extraction=None):
+    """
+    Arricchisce i documenti in parallelo (al massimo `max_concurrency` richieste
+    in volo) rispettando i limiti di quota RPM/TPM.
+    Se viene fornita una `EnrichmentCache`, i documenti già noti non vengono inviati all'LLM.
+    Se `batching` è un dizionario con `max_doc_tokens`, `token_budget` e `max_items`,
+    i documenti brevi vengono raggruppati in un'unica richiesta.
+    Se `budget` è un dizionario con `max_tokens` (e opzionalmente `map_reduce`,
+    `map_reduce_threshold`, `map_part_tokens`, `map_max_parts`), i documenti
+    lunghi vengono ridotti prima dell'invio.
+    Se `local_extraction` è un dizionario con `min_llm_chars` e `min_corpus_size`
+    (e opzionalmente `corpus`, i documenti già archiviati come coppie (id, testo)),
+    title, years e keywords vengono calcolati localmente quando possibile e
+    all'LLM vengono chiesti solo i campi mancanti; i documenti più brevi di
+    `min_llm_chars` caratteri non vengono inviati affatto.
+    """
+    limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    extractor = None
+    if local_extraction:
+        extractor = LocalMetadataExtractor(
+            documents, min_corpus_size=local_extraction["min_corpus_size"], corpus=local_extraction.get("corpus", ())
+        )
+
+    to_enrich = [] # Coppie (documento, campi da chiedere all'LLM)
+    skipped_short = 0
+    for doc in documents:
+        if not isinstance(doc.text, str) or not doc.text.strip():
+            continue
+        fields = ALL_FIELDS
+        if extractor is not None:
+            local_metadata = extractor.extract(doc)
+            doc.metadata.update(local_metadata)
+            fields = llm_fields_for(local_metadata)
+            if len(doc.text.strip()) < local_extraction["min_llm_chars"]:
+                # Documento troppo breve: i campi restanti restano vuoti, senza chiamare l'LLM
+                doc.metadata.update(empty_metadata(fields))
+                skipped_short += 1
+                continue
+        cached_metadata = cache.get(doc.text, fields) if cache is not None else None
+        if cached_metadata is not None:
+            doc.metadata.update(cached_metadata)
+        else:
+            to_enrich.append((doc, fields))
+
+    if extractor is not None:
+        print(f"Estrazione locale: {skipped_short} documenti brevi completati senza LLM (keywords locali: {'sì' if extractor.keywords_enabled else 'no'}).")
+    if cache is not None:
+        print(f"Cache metadati: {cache.hits} documenti già arricchiti, {len(to_enrich)} da inviare all'LLM.")
+
+    # I lotti devono richiedere gli stessi campi per tutti i documenti
+    documents_by_fields = {}
+    for doc, fields in to_enrich:
+        documents_by_fields.setdefault(fields, []).append(doc)
+
+    tasks = []
+    for fields, docs in documents_by_fields.items():
+        if batching:
+            batches, singles = pack_batches(docs, **batching)
+        else:
+            batches, singles = [], docs
+        tasks += [
+            asyncio.ensure_future(_enrich_batch(batch, fields, llm, limiter, semaphore, max_retries, cache))
+            for batch in batches
+        ]
+        tasks += [
+            asyncio.ensure_future(_enrich_document(doc, fields, llm, limiter, semaphore, max_retries, cache, budget))
+            for doc in singles
+        ]
+    if batching:
+        print(f"Richieste all'LLM per {len(to_enrich)} documenti: {len(tasks)} (con raggruppamento dei documenti brevi).")
+
+    with tqdm(total=len(to_enrich), desc="Arricchendo documenti") as progress:
+        for task in asyncio.as_completed(tasks):
+            progress.update(await task)
+
+    return documents
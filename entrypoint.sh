@@ -1,10 +1,27 @@
 #!/bin/sh
 
-# 1. Avvia l'app Streamlit in background
-echo "Avvio dell'applicazione Streamlit..."
-streamlit run app-docker.py --server.port 8501 --server.address 0.0.0.0 &
+# 1. Avvia il server API (pipeline di chat asincrona, streaming SSE) in background.
+# Al primo avvio la collezione può non esistere ancora (la crea update.py, sotto):
+# il server viene riavviato finché non riesce a caricare l'indice.
+echo "Avvio del server API (api_server.py)..."
+(
+    while true; do
+        python api_server.py
+        echo "Server API terminato: nuovo tentativo tra 30 secondi..."
+        sleep 30
+    done
+) &
 
-# 2. Avvia il loop di aggiornamento in PRIMO PIANO
+# 2. Avvia l'app Streamlit (client del server API) in background, quando il server risponde
+(
+    until python -c "import urllib.request; urllib.request.urlopen('http://localhost:${API_PORT:-8000}/health', timeout=2)" 2>/dev/null; do
+        sleep 2
+    done
+    echo "Avvio dell'applicazione Streamlit..."
+    streamlit run app-docker.py --server.port 8501 --server.address 0.0.0.0
+) &
+
+# 3. Avvia il loop di aggiornamento in PRIMO PIANO
 # Questo script terrà il container attivo.
 echo "Avvio del processo di aggiornamento periodico (si esegue ora e poi ogni 24 ore)..."
 while true; do
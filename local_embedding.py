@@ -0,0 +1,368 @@
+"""
+Motore di embedding locale per BAAI/bge-m3 su CPU.
+
+Il modello viene esportato una sola volta in ONNX e quantizzato in int8
+(quantizzazione dinamica), poi eseguito con onnxruntime. Le richieste
+concorrenti (query della chat, batch di nodi dell'aggiornamento) vengono
+raccolte da un micro-batcher dinamico che le esegue insieme, ordinate per
+lunghezza per ridurre il padding.
+
+Oltre al vettore denso il motore calcola, nello stesso passaggio del modello,
+i pesi lessicali (vettore sparso) di bge-m3, usati per la ricerca ibrida su Qdrant.
+"""
+import asyncio
+import hashlib
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, List
+
+import numpy as np
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from pydantic import PrivateAttr
+
+DEFAULT_MODEL_NAME = "BAAI/bge-m3"
+DEFAULT_MODEL_DIR = "models/bge-m3-onnx-int8"
+QUANTIZED_MODEL_FILE = "model_quantized.onnx"
+SPARSE_HEAD_FILE = "sparse_linear.npz"
+
+
+def export_quantized_model(model_name, model_dir):
+    """
+    Esporta il modello HuggingFace in ONNX e lo quantizza in int8 (dinamico) in `model_dir`.
+    Richiede `optimum[onnxruntime]`; viene eseguito solo se il modello non è già presente.
+    """
+    try:
+        from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+        from optimum.onnxruntime.configuration import AutoQuantizationConfig
+        from transformers import AutoTokenizer
+    except ImportError as e:
+        raise ImportError(
+            "Per esportare il modello in ONNX è necessario installare 'optimum[onnxruntime]' e 'transformers'."
+        ) from e
+
+    print(f"Esportazione di '{model_name}' in ONNX e quantizzazione int8 in '{model_dir}'...")
+    fp32_dir = os.path.join(model_dir, "fp32")
+    model = ORTModelForFeatureExtraction.from_pretrained(model_name, export=True)
+    model.save_pretrained(fp32_dir)
+    AutoTokenizer.from_pretrained(model_name).save_pretrained(model_dir)
+
+    quantizer = ORTQuantizer.from_pretrained(fp32_dir)
+    quantization_config = AutoQuantizationConfig.avx2(is_static=False, per_channel=True)
+    quantizer.quantize(save_dir=model_dir, quantization_config=quantization_config)
+    export_sparse_head(model_name, model_dir)
+    print("Esportazione completata.")
+
+
+def export_sparse_head(model_name, model_dir):
+    """
+    Salva in `model_dir` (formato numpy) la testa lineare di bge-m3 che produce i
+    pesi lessicali, distribuita a parte (`sparse_linear.pt`) rispetto al modello base.
+    """
+    try:
+        import torch
+        from huggingface_hub import hf_hub_download
+    except ImportError as e:
+        raise ImportError("Per esportare i pesi lessicali è necessario installare 'torch'.") from e
+
+    state_dict = torch.load(hf_hub_download(model_name, "sparse_linear.pt"), map_location="cpu")
+    np.savez(
+        os.path.join(model_dir, SPARSE_HEAD_FILE),
+        weight=state_dict["weight"].numpy().astype(np.float32),
+        bias=state_dict["bias"].numpy().astype(np.float32),
+    )
+
+
+class BGEM3OnnxEncoder:
+    """
+    Esecuzione ONNX (int8) di bge-m3: embedding densi normalizzati dal token [CLS]
+    e, con `sparse=True`, pesi lessicali per token (relu della testa lineare, massimo per token).
+    """
+
+    def __init__(self, model_name=DEFAULT_MODEL_NAME, model_dir=DEFAULT_MODEL_DIR, num_threads=None,
+                 max_length=8192, max_batch_tokens=16384, sparse=False):
+        try:
+            import onnxruntime as ort
+            from transformers import AutoTokenizer
+        except ImportError as e:
+            raise ImportError(
+                "Il motore di embedding locale richiede 'onnxruntime' e 'transformers'."
+            ) from e
+
+        model_path = os.path.join(model_dir, QUANTIZED_MODEL_FILE)
+        if not os.path.exists(model_path):
+            export_quantized_model(model_name, model_dir)
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(model_path, sess_options=options, providers=["CPUExecutionProvider"])
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.max_length = max_length
+        self.max_batch_tokens = max_batch_tokens
+
+        self.sparse = sparse
+        if sparse:
+            sparse_head_path = os.path.join(model_dir, SPARSE_HEAD_FILE)
+            if not os.path.exists(sparse_head_path):
+                export_sparse_head(model_name, model_dir)
+            sparse_head = np.load(sparse_head_path)
+            self.sparse_weight = sparse_head["weight"]
+            self.sparse_bias = sparse_head["bias"]
+            self.special_ids = {
+                self.tokenizer.cls_token_id, self.tokenizer.eos_token_id,
+                self.tokenizer.pad_token_id, self.tokenizer.unk_token_id,
+            }
+
+    def _sub_batches(self, token_ids):
+        """
+        Ordina i testi per lunghezza e li divide in sotto-batch il cui costo
+        (numero di testi x lunghezza massima) non supera `max_batch_tokens`.
+        """
+        order = sorted(range(len(token_ids)), key=lambda i: len(token_ids[i]))
+        batch = []
+        for i in order:
+            longest = len(token_ids[i])
+            if batch and (len(batch) + 1) * longest > self.max_batch_tokens:
+                yield batch
+                batch = []
+            batch.append(i)
+        if batch:
+            yield batch
+
+    def _run(self, batch_ids):
+        """Esegue il modello su un sotto-batch e restituisce last_hidden_state e attention mask."""
+        longest = max(len(ids) for ids in batch_ids)
+        input_ids = np.full((len(batch_ids), longest), self.tokenizer.pad_token_id, dtype=np.int64)
+        attention_mask = np.zeros((len(batch_ids), longest), dtype=np.int64)
+        for row, ids in enumerate(batch_ids):
+            input_ids[row, :len(ids)] = ids
+            attention_mask[row, :len(ids)] = 1
+        inputs = {"input_ids": input_ids, "attention_mask": attention_mask}
+        inputs = {name: value for name, value in inputs.items() if name in self.input_names}
+        last_hidden_state = self.session.run(None, inputs)[0]
+        return last_hidden_state, input_ids, attention_mask
+
+    def _lexical_weights(self, last_hidden_state, input_ids, attention_mask):
+        """Vettori sparsi (indici, valori) per riga: peso massimo di ciascun token non speciale."""
+        weights = np.maximum(last_hidden_state @ self.sparse_weight.T + self.sparse_bias, 0)[..., 0]
+        sparse_vectors = []
+        for ids, row_weights, mask in zip(input_ids, weights, attention_mask):
+            lexical = {}
+            for token_id, weight, valid in zip(ids.tolist(), row_weights.tolist(), mask.tolist()):
+                if valid and weight > 0 and token_id not in self.special_ids and weight > lexical.get(token_id, 0):
+                    lexical[token_id] = weight
+            sparse_vectors.append((list(lexical.keys()), list(lexical.values())))
+        return sparse_vectors
+
+    def encode(self, texts):
+        """
+        Restituisce gli embedding densi (normalizzati L2) dei testi, nello stesso ordine.
+        Con `sparse=True` ogni elemento è la coppia (denso, (indici, valori)).
+        """
+        token_ids = self.tokenizer(texts, truncation=True, max_length=self.max_length)["input_ids"]
+        embeddings = [None] * len(texts)
+        for batch in self._sub_batches(token_ids):
+            last_hidden_state, input_ids, attention_mask = self._run([token_ids[i] for i in batch])
+            dense = last_hidden_state[:, 0]
+            dense = dense / np.linalg.norm(dense, axis=1, keepdims=True)
+            if self.sparse:
+                sparse_vectors = self._lexical_weights(last_hidden_state, input_ids, attention_mask)
+                for row, i in enumerate(batch):
+                    embeddings[i] = (dense[row].tolist(), sparse_vectors[row])
+            else:
+                for row, i in enumerate(batch):
+                    embeddings[i] = dense[row].tolist()
+        return embeddings
+
+
+class DynamicBatcher:
+    """
+    Micro-batching dinamico: i testi inviati da thread diversi vengono raccolti
+    fino a `max_batch_size` elementi (o per al massimo `max_wait_ms` dal primo)
+    ed elaborati insieme da uno dei `num_workers` thread.
+    """
+
+    def __init__(self, encode_fn, max_batch_size=32, max_wait_ms=5, num_workers=1):
+        self._encode_fn = encode_fn
+        self._max_batch_size = max_batch_size
+        self._max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self._workers = [
+            threading.Thread(target=self._worker_loop, name=f"embedding-batcher-{i}", daemon=True)
+            for i in range(num_workers)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, texts):
+        """Accoda i testi e restituisce un Future per ciascuno."""
+        futures = []
+        for text in texts:
+            future = Future()
+            self._queue.put((text, future))
+            futures.append(future)
+        return futures
+
+    def encode(self, texts):
+        return [future.result() for future in self.submit(texts)]
+
+    def _collect(self):
+        items = [self._queue.get()]
+        deadline = time.monotonic() + self._max_wait
+        while len(items) < self._max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining <= 0:
+                    items.append(self._queue.get_nowait())
+                else:
+                    items.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return items
+
+    def _worker_loop(self):
+        while True:
+            items = self._collect()
+            texts = [text for text, _ in items]
+            try:
+                results = self._encode_fn(texts)
+                for (_, future), result in zip(items, results):
+                    future.set_result(result)
+            except Exception as e:
+                for _, future in items:
+                    future.set_exception(e)
+
+
+class LocalBGEM3Embedding(BaseEmbedding):
+    """
+    Embedding LlamaIndex basato sul motore ONNX locale con micro-batching dinamico.
+    Usabile come `Settings.embed_model` sia dall'app sia da update.py.
+
+    Con `sparse=True` i vettori sparsi calcolati insieme a quelli densi vengono
+    conservati in una piccola cache LRU, da cui `encode_sparse` (funzione
+    sparsa del vector store Qdrant) li legge senza un secondo passaggio del modello.
+    """
+
+    _batcher: DynamicBatcher = PrivateAttr()
+    _sparse: bool = PrivateAttr()
+    _sparse_cache: OrderedDict = PrivateAttr()
+    _sparse_cache_size: int = PrivateAttr()
+    _sparse_lock: threading.Lock = PrivateAttr()
+
+    def __init__(self, model_name: str = DEFAULT_MODEL_NAME, model_dir: str = DEFAULT_MODEL_DIR,
+                 num_threads: int = None, num_workers: int = 1, max_batch_size: int = 32,
+                 max_wait_ms: int = 5, max_length: int = 8192, embed_batch_size: int = 32,
+                 sparse: bool = False, sparse_cache_size: int = 4096, **kwargs: Any) -> None:
+        super().__init__(model_name=model_name, embed_batch_size=embed_batch_size, **kwargs)
+        encoder = BGEM3OnnxEncoder(
+            model_name=model_name, model_dir=model_dir, num_threads=num_threads, max_length=max_length, sparse=sparse
+        )
+        self._batcher = DynamicBatcher(
+            encoder.encode, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms, num_workers=num_workers
+        )
+        self._sparse = sparse
+        self._sparse_cache = OrderedDict()
+        self._sparse_cache_size = sparse_cache_size
+        self._sparse_lock = threading.Lock()
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "LocalBGEM3Embedding"
+
+    @property
+    def supports_sparse(self) -> bool:
+        return self._sparse
+
+    @property
+    def cache_id(self) -> str:
+        """Identificativo per le cache degli embedding: i vettori int8 differiscono da quelli fp32 dell'API."""
+        return f"{self.model_name}@onnx-int8"
+
+    @staticmethod
+    def _sparse_key(text):
+        return hashlib.sha256(text.encode("utf-8")).digest()
+
+    def _dense(self, texts, results):
+        """Estrae i vettori densi e, se presenti, memorizza quelli sparsi."""
+        if not self._sparse:
+            return results
+        with self._sparse_lock:
+            for text, (_, sparse_vector) in zip(texts, results):
+                key = self._sparse_key(text)
+                self._sparse_cache[key] = sparse_vector
+                self._sparse_cache.move_to_end(key)
+            while len(self._sparse_cache) > self._sparse_cache_size:
+                self._sparse_cache.popitem(last=False)
+        return [dense for dense, _ in results]
+
+    def encode_sparse(self, texts: List[str]):
+        """
+        Vettori sparsi dei testi nel formato delle funzioni sparse di QdrantVectorStore:
+        (lista di indici, lista di valori).
+        """
+        if not self._sparse:
+            raise ValueError("Il motore locale non è stato creato con sparse=True.")
+        found = {}
+        with self._sparse_lock:
+            for text in texts:
+                sparse_vector = self._sparse_cache.get(self._sparse_key(text))
+                if sparse_vector is not None:
+                    found[text] = sparse_vector
+        missing = [text for text in dict.fromkeys(texts) if text not in found]
+        if missing:
+            results = self._batcher.encode(missing)
+            self._dense(missing, results)
+            found.update((text, sparse_vector) for text, (_, sparse_vector) in zip(missing, results))
+        return [found[text][0] for text in texts], [found[text][1] for text in texts]
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        return self._dense([query], self._batcher.encode([query]))[0]
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        result = await asyncio.wrap_future(self._batcher.submit([query])[0])
+        return self._dense([query], [result])[0]
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._dense([text], self._batcher.encode([text]))[0]
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return self._dense(texts, self._batcher.encode(texts))
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        results = await asyncio.gather(*(asyncio.wrap_future(f) for f in self._batcher.submit(texts)))
+        return self._dense(texts, list(results))
+
+
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def get_local_embedding(**kwargs):
+    """
+    Restituisce un'istanza di `LocalBGEM3Embedding` condivisa nel processo
+    (una per configurazione), così il modello viene caricato una sola volta.
+    """
+    key = tuple(sorted(kwargs.items()))
+    with _engines_lock:
+        if key not in _engines:
+            _engines[key] = LocalBGEM3Embedding(**kwargs)
+        return _engines[key]
+
+
+def local_embedding_from_env():
+    """Configurazione del motore locale tramite variabili d'ambiente LOCAL_EMBED_*."""
+    num_threads = os.getenv("LOCAL_EMBED_THREADS")
+    return get_local_embedding(
+        model_dir=os.getenv("LOCAL_EMBED_MODEL_DIR", DEFAULT_MODEL_DIR),
+        num_threads=int(num_threads) if num_threads else None,
+        num_workers=int(os.getenv("LOCAL_EMBED_WORKERS", 1)),
+        max_batch_size=int(os.getenv("LOCAL_EMBED_MAX_BATCH_SIZE", 32)),
+        max_wait_ms=int(os.getenv("LOCAL_EMBED_MAX_WAIT_MS", 5)),
+        sparse=os.getenv("LOCAL_EMBED_SPARSE", "1") == "1",
+    )
@@ -1,8 +1,15 @@
 import os
+import json
+import glob
 import time
+import hashlib
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import requests
 from qdrant_client import QdrantClient
 from dotenv import load_dotenv
+from delta_sync import export_delta, record_manifest
 
 # Carica le chiavi API dal tuo file .env locale
 load_dotenv()
@@ -10,18 +17,161 @@ load_dotenv()
 # --- 1. CONFIGURAZIONE ---
 QDRANT_CLOUD_URL = "https://e542824d-6590-4005-91db-6dd34bf8f471.eu-west-2-0.aws.cloud.qdrant.io:6333" # Da cambiare con il tuo URL Qdrant Cloud
 QDRANT_CLOUD_API_KEY = os.getenv("QDRANT__API_KEY")
-COLLECTION_NAME = "diem_chatbot3_v2"
+COLLECTION_NAME = "diem_chatbot3_v2" # Usata se l'alias non esiste
+COLLECTION_ALIAS = os.getenv("QDRANT_COLLECTION_ALIAS", "diem_chatbot")
 
 # Percorso di salvataggio (corrisponde al volume del compose)
 LOCAL_SNAPSHOT_DIR = "qdrant_snapshots"
 os.makedirs(LOCAL_SNAPSHOT_DIR, exist_ok=True)
 SNAPSHOT_FILENAME = "migration_snapshot.snapshot"
 SNAPSHOT_FILE_PATH_LOCAL = os.path.join(LOCAL_SNAPSHOT_DIR, SNAPSHOT_FILENAME)
+# Download parziale e avanzamento (per riprendere un download interrotto)
+SNAPSHOT_PART_FILE = SNAPSHOT_FILE_PATH_LOCAL + ".part"
+SNAPSHOT_PROGRESS_FILE = SNAPSHOT_FILE_PATH_LOCAL + ".progress.json"
+# Checksum SHA256 dello snapshot, verificato da update.py prima del ripristino
+SNAPSHOT_CHECKSUM_FILE = SNAPSHOT_FILE_PATH_LOCAL + ".sha256"
+
+# Download parallelo a intervalli di byte (HTTP Range)
+DOWNLOAD_WORKERS = int(os.getenv("SNAPSHOT_DOWNLOAD_WORKERS", 8))
+DOWNLOAD_PART_SIZE = 64 * 1024 * 1024
+DOWNLOAD_BUFFER_SIZE = 1024 * 1024
+DOWNLOAD_MAX_RETRIES = 5
+
+# Sincronizzazione incrementale: manifest dell'ultima esportazione e file delta
+# (applicati da update.py al successivo avvio)
+DELTA_MANIFEST_FILE = os.path.join(LOCAL_SNAPSHOT_DIR, "delta_manifest.json")
+DELTA_FILE_PATTERN = os.path.join(LOCAL_SNAPSHOT_DIR, "delta_*.jsonl.gz")
+# Scritto da update.py quando un delta non si riesce ad applicare
+DELTA_RESYNC_MARKER_FILE = os.path.join(LOCAL_SNAPSHOT_DIR, "delta_resync_required.json")
+
+def sha256_file(filepath):
+    """Calcola lo SHA256 di un file leggendolo a blocchi."""
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for block in iter(lambda: f.read(DOWNLOAD_BUFFER_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def load_progress(snapshot_name, size):
+    """Parti già scaricate, solo se il download parziale riguarda lo stesso snapshot."""
+    if not (os.path.exists(SNAPSHOT_PROGRESS_FILE) and os.path.exists(SNAPSHOT_PART_FILE)):
+        return set()
+    with open(SNAPSHOT_PROGRESS_FILE, "r", encoding="utf-8") as f:
+        progress = json.load(f)
+    if progress.get("snapshot") != snapshot_name or progress.get("size") != size:
+        return set()
+    return set(progress.get("done", []))
+
+def save_progress(snapshot_name, size, checksum, done, manifest_time):
+    tmp_path = SNAPSHOT_PROGRESS_FILE + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"snapshot": snapshot_name, "size": size, "checksum": checksum, "done": sorted(done),
+                   "manifest_time": manifest_time}, f)
+    os.replace(tmp_path, SNAPSHOT_PROGRESS_FILE)
+
+def download_part(snapshot_url, headers, start, end):
+    """Scarica l'intervallo [start, end] nel file parziale, con tentativi ripetuti."""
+    for attempt in range(DOWNLOAD_MAX_RETRIES):
+        try:
+            response = requests.get(
+                snapshot_url, headers={**headers, "Range": f"bytes={start}-{end}"}, stream=True, timeout=60
+            )
+            response.raise_for_status()
+            if response.status_code != 206:
+                raise IOError("Il server non supporta le richieste a intervalli (HTTP Range).")
+            with open(SNAPSHOT_PART_FILE, "r+b") as f:
+                f.seek(start)
+                written = 0
+                for block in response.iter_content(chunk_size=DOWNLOAD_BUFFER_SIZE):
+                    f.write(block)
+                    written += len(block)
+            if written != end - start + 1:
+                raise IOError(f"Intervallo incompleto: {written} byte su {end - start + 1}.")
+            return
+        except (requests.RequestException, IOError) as e:
+            if attempt == DOWNLOAD_MAX_RETRIES - 1:
+                raise
+            delay = 2 ** attempt
+            print(f"Errore sull'intervallo {start}-{end} ({e}). Nuovo tentativo tra {delay}s...")
+            time.sleep(delay)
+
+def download_snapshot(snapshot_url, headers, snapshot_name, size, checksum, manifest_time):
+    """
+    Scarica lo snapshot in parti da DOWNLOAD_PART_SIZE con DOWNLOAD_WORKERS richieste
+    parallele, riprendendo dalle parti già completate, e ne verifica il checksum.
+    `manifest_time` (registrazione del manifest dello snapshot) resta nel file di
+    avanzamento, così anche un download ripreso sa quali delta sono superati.
+    """
+    parts = [(i, start, min(start + DOWNLOAD_PART_SIZE, size) - 1)
+             for i, start in enumerate(range(0, size, DOWNLOAD_PART_SIZE))]
+    done = load_progress(snapshot_name, size)
+    if done:
+        print(f"Ripresa del download: {len(done)}/{len(parts)} parti già scaricate.")
+    else:
+        with open(SNAPSHOT_PART_FILE, "wb") as f:
+            f.truncate(size)
+        save_progress(snapshot_name, size, checksum, done, manifest_time)
+
+    lock = threading.Lock()
+    started = time.time()
+
+    def fetch(part):
+        index, start, end = part
+        download_part(snapshot_url, headers, start, end)
+        with lock:
+            done.add(index)
+            save_progress(snapshot_name, size, checksum, done, manifest_time)
+            print(f"Parte {len(done)}/{len(parts)} completata.")
+
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+        # list() propaga l'eventuale errore di una parte
+        list(executor.map(fetch, [part for part in parts if part[0] not in done]))
+    elapsed = max(time.time() - started, 1e-6)
+    print(f"Download completato ({size / 1024 / 1024:.1f} MB, {size / 1024 / 1024 / elapsed:.1f} MB/s).")
+
+    print("Verifica del checksum...")
+    local_checksum = sha256_file(SNAPSHOT_PART_FILE)
+    if checksum and local_checksum != checksum:
+        # Le parti non sono più affidabili: il prossimo tentativo riparte da zero
+        os.remove(SNAPSHOT_PROGRESS_FILE)
+        raise ValueError(f"Checksum non valido: atteso {checksum}, ottenuto {local_checksum}.")
+
+    os.replace(SNAPSHOT_PART_FILE, SNAPSHOT_FILE_PATH_LOCAL)
+    with open(SNAPSHOT_CHECKSUM_FILE, "w", encoding="utf-8") as f:
+        f.write(local_checksum)
+    os.remove(SNAPSHOT_PROGRESS_FILE)
+
+def find_resumable_snapshot(client_cloud, collection_name):
+    """
+    Snapshot sul cloud di cui esiste un download parziale da riprendere, se ancora
+    disponibile, con l'istante di registrazione del suo manifest: (snapshot, manifest_time) o None.
+    """
+    if not os.path.exists(SNAPSHOT_PROGRESS_FILE):
+        return None
+    with open(SNAPSHOT_PROGRESS_FILE, "r", encoding="utf-8") as f:
+        progress = json.load(f)
+    if progress.get("manifest_time") is None:
+        return None
+    for snapshot in client_cloud.list_snapshots(collection_name=collection_name):
+        if snapshot.name == progress.get("snapshot"):
+            return snapshot, progress["manifest_time"]
+    return None
+
+def remove_superseded_deltas(manifest_time):
+    """
+    Elimina i delta esportati prima del manifest dello snapshot appena scaricato:
+    applicati dopo il ripristino riporterebbe indietro i punti modificati nel frattempo.
+    I delta esportati dopo (anche durante il download) restano da applicare.
+    """
+    for delta_path in glob.glob(DELTA_FILE_PATTERN):
+        if os.path.getmtime(delta_path) < manifest_time:
+            print(f"Rimozione del delta superato '{delta_path}'.")
+            os.remove(delta_path)
 
 def create_and_download_snapshot():
     """
-    Si collega al Qdrant Cloud, crea uno snapshot 
-    e lo scarica nella cartella locale 'qdrant_snapshots'.
+    Si collega al Qdrant Cloud, crea uno snapshot (o riprende il download di
+    quello interrotto) e lo scarica nella cartella locale 'qdrant_snapshots'.
     """
     
     print(f"Connessione a Qdrant Cloud: {QDRANT_CLOUD_URL}")
@@ -31,30 +181,70 @@ def create_and_download_snapshot():
     )
     
     try:
-        print(f"Creazione snapshot per '{COLLECTION_NAME}'...")
-        snapshot = client_cloud.create_snapshot(collection_name=COLLECTION_NAME, wait=True)
-        snapshot_name = snapshot.name
-        print(f"Snapshot '{snapshot_name}' creato sul cloud.")
+        # Lo snapshot si crea sulla collezione reale a cui punta l'alias
+        aliases = {a.alias_name: a.collection_name for a in client_cloud.get_aliases().aliases}
+        collection_name = aliases.get(COLLECTION_ALIAS, COLLECTION_NAME)
+        resumable = find_resumable_snapshot(client_cloud, collection_name)
+        if resumable is not None:
+            snapshot, manifest_time = resumable
+        else:
+            # Il manifest si registra PRIMA dello snapshot: i punti scritti nel frattempo sono
+            # nello snapshot e di nuovo nel delta successivo (riapplicarli è innocuo), mai in nessuno dei due
+            # (il manifest sostituisce il precedente solo se lo snapshot viene creato)
+            manifest_time = time.time()
+            record_manifest(client_cloud, collection_name, DELTA_MANIFEST_FILE + ".pending", watermark=manifest_time)
+            print(f"Creazione snapshot per '{collection_name}'...")
+            snapshot = client_cloud.create_snapshot(collection_name=collection_name, wait=True)
+            os.replace(DELTA_MANIFEST_FILE + ".pending", DELTA_MANIFEST_FILE)
+            print(f"Snapshot '{snapshot.name}' creato sul cloud.")
         
-        print(f"Download snapshot '{snapshot_name}' in corso...")
-        snapshot_url = f"{QDRANT_CLOUD_URL}/collections/{COLLECTION_NAME}/snapshots/{snapshot_name}"
+        print(f"Download snapshot '{snapshot.name}' in corso...")
+        snapshot_url = f"{QDRANT_CLOUD_URL}/collections/{collection_name}/snapshots/{snapshot.name}"
         headers = {"api-key": QDRANT_CLOUD_API_KEY}
+        download_snapshot(snapshot_url, headers, snapshot.name, snapshot.size, snapshot.checksum, manifest_time)
         
-        response = requests.get(snapshot_url, headers=headers, stream=True)
-        response.raise_for_status() 
-        
-        with open(SNAPSHOT_FILE_PATH_LOCAL, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192): 
-                f.write(chunk)
-        
-        print(f"Download completato!")
         print(f"Snapshot salvato in: {SNAPSHOT_FILE_PATH_LOCAL}")
+        # Solo ora, con lo snapshot scaricato e verificato, i delta precedenti sono superati
+        remove_superseded_deltas(manifest_time)
 
     except Exception as e:
         print(f"ERRORE durante il download dal cloud: {e}")
+        if os.path.exists(SNAPSHOT_PROGRESS_FILE):
+            print("Il download parziale verrà ripreso alla prossima esecuzione.")
+
+def export_delta_from_cloud():
+    """
+    Esporta dal Qdrant Cloud solo i punti modificati dall'ultima esportazione
+    (o dallo snapshot), più i tombstone dei punti eliminati.
+    """
+    print(f"Connessione a Qdrant Cloud: {QDRANT_CLOUD_URL}")
+    client_cloud = QdrantClient(url=QDRANT_CLOUD_URL, api_key=QDRANT_CLOUD_API_KEY)
+    aliases = {a.alias_name: a.collection_name for a in client_cloud.get_aliases().aliases}
+    collection_name = aliases.get(COLLECTION_ALIAS, COLLECTION_NAME)
+
+    if os.path.exists(DELTA_RESYNC_MARKER_FILE):
+        with open(DELTA_RESYNC_MARKER_FILE, "r", encoding="utf-8") as f:
+            failure = json.load(f)
+        print(f"ATTENZIONE: il delta '{failure.get('delta')}' non è stato applicato ({failure.get('error')}).")
+        print("I nuovi delta restano in coda dopo di esso; se l'errore persiste esegui 'python migrate.py'"
+              " per uno snapshot completo, che update.py ripristinerà al posto della collezione locale.")
+    if not os.path.exists(DELTA_MANIFEST_FILE):
+        print("Nessun manifest trovato: il delta conterrà l'intera collezione.")
+    delta_path = os.path.join(LOCAL_SNAPSHOT_DIR, f"delta_{time.strftime('%Y%m%d%H%M%S')}.jsonl.gz")
+    print(f"Esportazione del delta di '{collection_name}'...")
+    upserts, deletes = export_delta(client_cloud, collection_name, DELTA_MANIFEST_FILE, delta_path)
+    size_mb = os.path.getsize(delta_path) / 1024 / 1024
+    print(f"Delta salvato in: {delta_path} ({upserts} punti, {deletes} eliminazioni, {size_mb:.2f} MB)")
 
 if __name__ == "__main__":
-    if os.path.exists(SNAPSHOT_FILE_PATH_LOCAL):
+    parser = argparse.ArgumentParser(description="Trasferimento della collezione da Qdrant Cloud.")
+    parser.add_argument("--delta", action="store_true",
+                        help="Esporta solo le modifiche dall'ultima esportazione invece dello snapshot completo.")
+    args = parser.parse_args()
+
+    if args.delta:
+        export_delta_from_cloud()
+    elif os.path.exists(SNAPSHOT_FILE_PATH_LOCAL):
         print(f"Il file di snapshot '{SNAPSHOT_FILE_PATH_LOCAL}' esiste già.")
         risposta = input("Vuoi scaricarlo di nuovo (sovrascrivendolo)? (s/n): ")
         if risposta.lower() == 's':
@@ -62,4 +252,4 @@ if __name__ == "__main__":
         else:
             print("Operazione annullata.")
     else:
-        create_and_download_snapshot()
\ No newline at end of file
+        create_and_download_snapshot()
@@ -0,0 +1,129 @@
+"""
+Archivio dei nodi (chunk) indicizzato per documento, basato su SQLite.
+
+Sostituisce il singolo file pickle con tutti i nodi del corpus: un
+aggiornamento riscrive solo i nodi dei documenti modificati, e la lettura
+dell'intero corpus avviene in streaming senza caricarlo tutto in memoria.
+"""
+import os
+import pickle
+import sqlite3
+
+
+class NodeStore:
+    """
+    Nodi LlamaIndex serializzati (pickle) in una tabella SQLite con chiave
+    `node_id` e indice su `ref_doc_id`, per upsert e cancellazione per documento.
+    """
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        directory = os.path.dirname(filepath)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(filepath)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS nodes ("
+            " node_id TEXT PRIMARY KEY,"
+            " ref_doc_id TEXT NOT NULL,"
+            " position INTEGER NOT NULL,"
+            " data BLOB NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_nodes_ref_doc_id ON nodes (ref_doc_id)")
+        self._conn.commit()
+
+    @staticmethod
+    def _ref_doc_id(node):
+        return node.ref_doc_id or node.metadata.get("source_url") or ""
+
+    def upsert_documents(self, nodes, document_ids=()):
+        """
+        Sostituisce, in un'unica transazione, tutti i nodi dei documenti
+        `document_ids` e di quelli a cui appartengono i `nodes` forniti: un
+        documento aggiornato che non produce più nodi perde quelli vecchi.
+        Restituisce il numero di nodi rimossi.
+        """
+        nodes_by_doc = {}
+        for node in nodes:
+            nodes_by_doc.setdefault(self._ref_doc_id(node), []).append(node)
+
+        with self._conn:
+            removed = self._delete(set(document_ids) | set(nodes_by_doc))
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO nodes (node_id, ref_doc_id, position, data) VALUES (?, ?, ?, ?)",
+                (
+                    (node.node_id, ref_doc_id, position, pickle.dumps(node))
+                    for ref_doc_id, doc_nodes in nodes_by_doc.items()
+                    for position, node in enumerate(doc_nodes)
+                ),
+            )
+        return removed
+
+    def _delete(self, ref_doc_ids):
+        removed = 0
+        for ref_doc_id in ref_doc_ids:
+            removed += self._conn.execute("DELETE FROM nodes WHERE ref_doc_id = ?", (ref_doc_id,)).rowcount
+        return removed
+
+    def delete_documents(self, ref_doc_ids):
+        """Rimuove tutti i nodi dei documenti indicati. Restituisce il numero di nodi rimossi."""
+        with self._conn:
+            return self._delete(ref_doc_ids)
+
+    def get_document_nodes(self, ref_doc_id):
+        """Nodi di un singolo documento, nell'ordine in cui sono stati creati."""
+        rows = self._conn.execute(
+            "SELECT data FROM nodes WHERE ref_doc_id = ? ORDER BY position", (ref_doc_id,)
+        )
+        return [pickle.loads(data) for (data,) in rows]
+
+    def iter_nodes(self, batch_size=500):
+        """Itera su tutti i nodi del corpus leggendoli a blocchi dal database."""
+        cursor = self._conn.execute("SELECT data FROM nodes ORDER BY ref_doc_id, position")
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for (data,) in rows:
+                yield pickle.loads(data)
+
+    def iter_document_texts(self, batch_size=500):
+        """
+        Itera sulle coppie (ref_doc_id, testo) dei documenti del corpus, con il
+        testo ricomposto dai nodi (le sovrapposizioni fra chunk restano).
+        """
+        current_id, parts = None, []
+        for node in self.iter_nodes(batch_size=batch_size):
+            ref_doc_id = self._ref_doc_id(node)
+            if ref_doc_id != current_id:
+                if parts:
+                    yield current_id, "\n".join(parts)
+                current_id, parts = ref_doc_id, []
+            parts.append(node.text)
+        if parts:
+            yield current_id, "\n".join(parts)
+
+    def ref_doc_ids(self):
+        return [row[0] for row in self._conn.execute("SELECT DISTINCT ref_doc_id FROM nodes")]
+
+    def count(self):
+        return self._conn.execute("SELECT COUNT(*) FROM nodes").fetchone()[0]
+
+    def is_empty(self):
+        return self._conn.execute("SELECT 1 FROM nodes LIMIT 1").fetchone() is None
+
+    def import_pickle(self, filepath):
+        """
+        Importa una tantum i nodi dal vecchio file pickle monolitico.
+        Restituisce il numero di nodi importati.
+        """
+        with open(filepath, "rb") as f:
+            nodes = pickle.load(f)
+        if not isinstance(nodes, list):
+            raise ValueError(f"Il file '{filepath}' non contiene una lista di nodi.")
+        self.upsert_documents(nodes)
+        return len(nodes)
+
+    def close(self):
+        self._conn.close()
@@ -0,0 +1,318 @@
+"""
+Operazioni di scrittura in blocco su Qdrant usate da update.py.
+
+Cancellazioni con un unico filtro sui documenti, aggiornamenti dei payload e
+upsert dei punti a blocchi, inviati in parallelo senza attendere la loro
+applicazione (wait=False). L'attesa avviene una sola volta alla fine: Qdrant
+applica gli aggiornamenti di una collezione nell'ordine in cui li riceve, per
+cui un'ultima operazione con wait=True garantisce che tutte le precedenti
+siano state applicate.
+
+Contiene inoltre la gestione dell'alias con cui l'app legge la collezione:
+le ricostruzioni complete scrivono in una nuova collezione versionata e,
+dopo la validazione, spostano l'alias in un'unica operazione atomica.
+
+Le nuove collezioni sono create da un profilo dichiarativo (quantizzazione,
+vettori originali su disco, parametri HNSW) con indici sui campi del payload
+usati per filtri e cancellazioni.
+
+Con il motore di embedding locale le collezioni possono essere ibride: al
+vettore denso si affianca quello sparso dei pesi lessicali di bge-m3, e i due
+elenchi di risultati vengono fusi con la reciprocal rank fusion (RRF).
+"""
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from llama_index.core.schema import MetadataMode
+from llama_index.core.vector_stores.types import VectorStoreQuery, VectorStoreQueryResult
+from llama_index.core.vector_stores.utils import node_to_metadata_dict
+from qdrant_client import QdrantClient, models
+from tqdm import tqdm
+
+from delta_sync import UPDATED_AT_KEY
+
+DOCUMENT_ID_KEY = "doc_id"
+DENSE_VECTOR_NAME = "text-dense"
+SPARSE_VECTOR_NAME = "text-sparse-new"
+RRF_K = 60
+
+# Profili di creazione delle collezioni. Con la quantizzazione i vettori
+# quantizzati restano in RAM e gli originali su disco: Qdrant li usa per il
+# rescoring dei candidati (rescore attivo di default).
+COLLECTION_PROFILES = {
+    # float32 in RAM, come le collezioni create da LlamaIndex
+    "fp32": {"quantization": None, "on_disk": False, "on_disk_payload": False, "hnsw_m": 16, "hnsw_ef_construct": 100},
+    # int8: circa 4 volte meno memoria, perdita di qualità trascurabile
+    "scalar": {"quantization": "scalar", "on_disk": True, "on_disk_payload": True, "hnsw_m": 16, "hnsw_ef_construct": 200},
+    # 1 bit per dimensione: circa 32 volte meno memoria, adatto ai 1024 valori di bge-m3
+    "binary": {"quantization": "binary", "on_disk": True, "on_disk_payload": True, "hnsw_m": 16, "hnsw_ef_construct": 200},
+}
+
+# Campi del payload indicizzati: cancellazioni per documento e filtri
+PAYLOAD_INDEXES = {
+    "doc_id": models.PayloadSchemaType.KEYWORD,
+    "ref_doc_id": models.PayloadSchemaType.KEYWORD,
+    "source_url": models.PayloadSchemaType.KEYWORD,
+    "years": models.PayloadSchemaType.KEYWORD,
+    # Istante dell'ultima scrittura: base dell'esportazione incrementale (delta_sync.py)
+    UPDATED_AT_KEY: models.PayloadSchemaType.FLOAT,
+}
+
+
+def create_qdrant_client(url, api_key=None, prefer_grpc=True, grpc_port=6334, timeout=300):
+    """Client Qdrant per le scritture in blocco (gRPC se disponibile)."""
+    return QdrantClient(url=url, api_key=api_key, prefer_grpc=prefer_grpc, grpc_port=grpc_port, timeout=timeout)
+
+
+def load_collection_profile(name):
+    """
+    Profilo di collezione: uno dei nomi di COLLECTION_PROFILES oppure il percorso
+    di un file JSON con le chiavi da sovrascrivere al profilo 'fp32'.
+    """
+    if name.endswith(".json"):
+        with open(name, "r", encoding="utf-8") as f:
+            return {**COLLECTION_PROFILES["fp32"], **json.load(f)}
+    if name not in COLLECTION_PROFILES:
+        raise ValueError(f"Profilo di collezione sconosciuto: '{name}'.")
+    return COLLECTION_PROFILES[name]
+
+
+def _quantization_config(quantization):
+    if quantization is None:
+        return None
+    if quantization == "scalar":
+        return models.ScalarQuantization(
+            scalar=models.ScalarQuantizationConfig(type=models.ScalarType.INT8, quantile=0.99, always_ram=True)
+        )
+    if quantization == "binary":
+        return models.BinaryQuantization(binary=models.BinaryQuantizationConfig(always_ram=True))
+    raise ValueError(f"Quantizzazione non supportata: '{quantization}'.")
+
+
+def create_collection(client, collection_name, vector_size, profile, dense_vector_name=DENSE_VECTOR_NAME,
+                      sparse_vector_name=None):
+    """
+    Crea la collezione secondo il profilo, con gli indici del payload.
+    Con `sparse_vector_name` aggiunge il vettore sparso per la ricerca ibrida.
+    """
+    sparse_vectors_config = None
+    if sparse_vector_name:
+        sparse_vectors_config = {
+            sparse_vector_name: models.SparseVectorParams(
+                index=models.SparseIndexParams(on_disk=profile["on_disk"])
+            )
+        }
+    client.create_collection(
+        collection_name=collection_name,
+        vectors_config={
+            dense_vector_name: models.VectorParams(
+                size=vector_size, distance=models.Distance.COSINE, on_disk=profile["on_disk"]
+            )
+        },
+        hnsw_config=models.HnswConfigDiff(m=profile["hnsw_m"], ef_construct=profile["hnsw_ef_construct"]),
+        sparse_vectors_config=sparse_vectors_config,
+        quantization_config=_quantization_config(profile["quantization"]),
+        on_disk_payload=profile["on_disk_payload"],
+    )
+    ensure_payload_indexes(client, collection_name)
+
+
+def ensure_payload_indexes(client, collection_name, indexes=PAYLOAD_INDEXES):
+    """Crea gli indici del payload mancanti (anche su collezioni esistenti)."""
+    existing = client.get_collection(collection_name=collection_name).payload_schema or {}
+    for field_name, field_schema in indexes.items():
+        if field_name not in existing:
+            client.create_payload_index(
+                collection_name=collection_name, field_name=field_name, field_schema=field_schema, wait=True
+            )
+
+
+def _batches(items, batch_size):
+    for i in range(0, len(items), batch_size):
+        yield items[i:i + batch_size]
+
+
+def delete_documents(client, collection_name, doc_ids, wait=False):
+    """Elimina con un unico filtro tutti i punti dei documenti indicati (payload 'doc_id')."""
+    doc_ids = list(doc_ids)
+    if not doc_ids:
+        return
+    client.delete(
+        collection_name=collection_name,
+        points_selector=models.FilterSelector(
+            filter=models.Filter(
+                must=[models.FieldCondition(key=DOCUMENT_ID_KEY, match=models.MatchAny(any=doc_ids))]
+            )
+        ),
+        wait=wait,
+    )
+
+
+def delete_points(client, collection_name, point_ids, wait=False):
+    """Elimina i punti indicati per ID in un'unica richiesta."""
+    if not point_ids:
+        return
+    client.delete(
+        collection_name=collection_name,
+        points_selector=models.PointIdsList(points=list(point_ids)),
+        wait=wait,
+    )
+
+
+def overwrite_payloads(client, vector_store, nodes, batch_size=256, wait=False):
+    """
+    Riscrive il payload dei punti dei nodi forniti senza toccarne i vettori.
+    Con `wait=True` attende solo l'ultimo blocco.
+    """
+    batches = list(_batches(nodes, batch_size))
+    for i, batch in enumerate(batches):
+        client.batch_update_points(
+            collection_name=vector_store.collection_name,
+            update_operations=[
+                models.OverwritePayloadOperation(
+                    overwrite_payload=models.SetPayload(
+                        payload={
+                            **node_to_metadata_dict(node, remove_text=False, flat_metadata=vector_store.flat_metadata),
+                            UPDATED_AT_KEY: time.time(),
+                        },
+                        points=[node.node_id],
+                    )
+                )
+                for node in batch
+            ],
+            wait=wait and i == len(batches) - 1,
+        )
+
+
+def upsert_nodes(vector_store, nodes, embed_model, batch_size=256, workers=4, show_progress=True, profile=None):
+    """
+    Calcola gli embedding dei nodi a blocchi di `batch_size` e li carica su Qdrant
+    con `workers` richieste di upsert in parallelo, senza attesa per blocco.
+    Se la collezione non esiste viene creata secondo `profile` (default 'fp32').
+    Al termine attende che tutti gli aggiornamenti siano stati applicati.
+    """
+    if not nodes:
+        return
+    client = vector_store.client
+    collection_name = vector_store.collection_name
+    batches = list(_batches(nodes, batch_size))
+    progress = tqdm(total=len(nodes), desc="Upsert su Qdrant", disable=not show_progress)
+
+    def embed(batch):
+        texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node in batch]
+        for node, embedding in zip(batch, embed_model.get_text_embedding_batch(texts)):
+            node.embedding = embedding
+
+    def upsert(points, wait=False):
+        client.upsert(collection_name=collection_name, points=points, wait=wait)
+
+    embedded = 0
+    if not client.collection_exists(collection_name):
+        # La dimensione dei vettori si ricava dal primo blocco
+        embed(batches[0])
+        embedded = 1
+        create_collection(client, collection_name, len(batches[0][0].get_embedding()),
+                          profile or COLLECTION_PROFILES["fp32"], dense_vector_name=vector_store.dense_vector_name,
+                          sparse_vector_name=vector_store.sparse_vector_name if vector_store.enable_hybrid else None)
+
+    last_points = None
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = []
+        for i, batch in enumerate(batches):
+            # L'embedding del blocco successivo procede mentre i precedenti vengono caricati
+            if i >= embedded:
+                embed(batch)
+            # Stesso formato di punti (vettori con nome, payload) usato dal vector store
+            last_points, _ = vector_store._build_points(batch, vector_store.sparse_vector_name)
+            updated_at = time.time()
+            for point in last_points:
+                point.payload[UPDATED_AT_KEY] = updated_at
+            pending.append(executor.submit(upsert, last_points))
+            pending[-1].add_done_callback(lambda _, n=len(batch): progress.update(n))
+        for future in pending:
+            future.result()
+    progress.close()
+
+    if last_points:
+        # Barriera: l'ultimo blocco viene riscritto (operazione idempotente) attendendone l'applicazione
+        upsert(last_points, wait=True)
+
+
+def get_alias_target(client, alias):
+    """Nome della collezione a cui punta l'alias, o None se l'alias non esiste."""
+    for description in client.get_aliases().aliases:
+        if description.alias_name == alias:
+            return description.collection_name
+    return None
+
+
+def switch_alias(client, alias, collection_name):
+    """Sposta (o crea) l'alias sulla collezione indicata in un'unica operazione atomica."""
+    operations = []
+    if get_alias_target(client, alias) is not None:
+        operations.append(models.DeleteAliasOperation(delete_alias=models.DeleteAlias(alias_name=alias)))
+    operations.append(
+        models.CreateAliasOperation(create_alias=models.CreateAlias(collection_name=collection_name, alias_name=alias))
+    )
+    client.update_collection_aliases(change_aliases_operations=operations)
+
+
+def validate_collection(vector_store, expected_count, probe_node=None):
+    """
+    Verifica una collezione appena costruita: numero di punti atteso e, se
+    fornito, che `probe_node` (con embedding) compaia fra i primi risultati
+    della ricerca con il proprio vettore (chunk identici hanno lo stesso
+    vettore). Solleva ValueError se la verifica fallisce.
+    """
+    count = vector_store.client.count(collection_name=vector_store.collection_name, exact=True).count
+    if count != expected_count:
+        raise ValueError(f"La collezione contiene {count} punti, attesi {expected_count}.")
+    if probe_node is not None:
+        result = vector_store.query(VectorStoreQuery(query_embedding=probe_node.get_embedding(), similarity_top_k=5))
+        if probe_node.node_id not in (result.ids or []):
+            raise ValueError("La ricerca di prova non restituisce il nodo atteso.")
+
+
+def collection_has_sparse(client, collection_name, sparse_vector_name=SPARSE_VECTOR_NAME):
+    """True se la collezione (o l'alias) ha il vettore sparso per la ricerca ibrida."""
+    if not client.collection_exists(collection_name=collection_name):
+        return False
+    sparse_vectors = client.get_collection(collection_name=collection_name).config.params.sparse_vectors or {}
+    return sparse_vector_name in sparse_vectors
+
+
+def reciprocal_rank_fusion(dense_result, sparse_result, alpha=0.5, top_k=2, k=RRF_K):
+    """
+    Fonde i risultati densi e sparsi con la reciprocal rank fusion pesata:
+    score = alpha / (k + rank denso) + (1 - alpha) / (k + rank sparso).
+    Usa solo le posizioni, per cui non richiede punteggi confrontabili fra le due ricerche.
+    """
+    scores, nodes = {}, {}
+    for result, weight in ((dense_result, alpha), (sparse_result, 1 - alpha)):
+        ranked = sorted(zip(result.similarities or [], result.nodes or []), key=lambda x: x[0], reverse=True)
+        for rank, (_, node) in enumerate(ranked, start=1):
+            scores[node.node_id] = scores.get(node.node_id, 0.0) + weight / (k + rank)
+            nodes.setdefault(node.node_id, node)
+    if not scores:
+        return VectorStoreQueryResult(nodes=None, similarities=None, ids=None)
+    fused = sorted(scores.items(), key=lambda x: x[1], reverse=True)[:top_k]
+    return VectorStoreQueryResult(
+        nodes=[nodes[node_id] for node_id, _ in fused],
+        similarities=[score for _, score in fused],
+        ids=[node_id for node_id, _ in fused],
+    )
+
+
+def hybrid_vector_store_kwargs(sparse_encoder):
+    """
+    Argomenti di QdrantVectorStore per la ricerca ibrida con una funzione sparsa
+    (testi -> (indici, valori)) usata sia per i documenti sia per le query.
+    """
+    return {
+        "enable_hybrid": True,
+        "sparse_doc_fn": sparse_encoder,
+        "sparse_query_fn": sparse_encoder,
+        "hybrid_fusion_fn": reciprocal_rank_fusion,
+        "sparse_vector_name": SPARSE_VECTOR_NAME,
+    }
@@ -0,0 +1,229 @@
+"""
+Reranker locale su CPU basato su un cross-encoder (default: cross-encoder/ms-marco-MiniLM-L6-v2).
+
+Come per gli embedding locali, il modello viene esportato una sola volta in
+ONNX e quantizzato in int8, poi eseguito con onnxruntime; le coppie
+(domanda, passaggio) di sessioni concorrenti passano dallo stesso micro-batcher.
+
+I nodi sono lunghi migliaia di token, mentre il cross-encoder ne legge al più
+512: di ogni nodo si valuta solo la finestra più pertinente alla domanda
+(sovrapposizione lessicale), di ampiezza scelta in modo da restare entro un
+budget di latenza stimato dalla velocità misurata sulle chiamate precedenti.
+Dopo il riordino restano solo i `top_n` nodi migliori.
+"""
+import math
+import os
+import re
+import threading
+import time
+from typing import List, Optional
+
+import numpy as np
+from llama_index.core.postprocessor.types import BaseNodePostprocessor
+from llama_index.core.schema import MetadataMode, NodeWithScore, QueryBundle
+from pydantic import Field, PrivateAttr
+
+from local_embedding import DynamicBatcher, QUANTIZED_MODEL_FILE
+
+DEFAULT_RERANK_MODEL_NAME = "cross-encoder/ms-marco-MiniLM-L6-v2"
+DEFAULT_RERANK_MODEL_DIR = "models/ms-marco-MiniLM-L6-v2-onnx-int8"
+# Rapporto approssimativo fra token del tokenizer e parole
+TOKENS_PER_WORD = 1.4
+
+
+def export_quantized_reranker(model_name, model_dir):
+    """
+    Esporta il cross-encoder HuggingFace in ONNX e lo quantizza in int8 (dinamico) in `model_dir`.
+    Richiede `optimum[onnxruntime]`; viene eseguito solo se il modello non è già presente.
+    """
+    try:
+        from optimum.onnxruntime import ORTModelForSequenceClassification, ORTQuantizer
+        from optimum.onnxruntime.configuration import AutoQuantizationConfig
+        from transformers import AutoTokenizer
+    except ImportError as e:
+        raise ImportError(
+            "Per esportare il reranker in ONNX è necessario installare 'optimum[onnxruntime]' e 'transformers'."
+        ) from e
+
+    print(f"Esportazione di '{model_name}' in ONNX e quantizzazione int8 in '{model_dir}'...")
+    fp32_dir = os.path.join(model_dir, "fp32")
+    model = ORTModelForSequenceClassification.from_pretrained(model_name, export=True)
+    model.save_pretrained(fp32_dir)
+    AutoTokenizer.from_pretrained(model_name).save_pretrained(model_dir)
+
+    quantizer = ORTQuantizer.from_pretrained(fp32_dir)
+    quantization_config = AutoQuantizationConfig.avx2(is_static=False, per_channel=True)
+    quantizer.quantize(save_dir=model_dir, quantization_config=quantization_config)
+    print("Esportazione completata.")
+
+
+class CrossEncoderOnnxScorer:
+    """
+    Esecuzione ONNX (int8) del cross-encoder: punteggio di pertinenza in [0, 1]
+    (sigmoide del logit) per coppie (domanda, passaggio), a sotto-batch
+    ordinati per lunghezza.
+    """
+
+    def __init__(self, model_name=DEFAULT_RERANK_MODEL_NAME, model_dir=DEFAULT_RERANK_MODEL_DIR,
+                 num_threads=None, max_length=512, batch_size=16):
+        try:
+            import onnxruntime as ort
+            from transformers import AutoTokenizer
+        except ImportError as e:
+            raise ImportError("Il reranker locale richiede 'onnxruntime' e 'transformers'.") from e
+
+        model_path = os.path.join(model_dir, QUANTIZED_MODEL_FILE)
+        if not os.path.exists(model_path):
+            export_quantized_reranker(model_name, model_dir)
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = ort.InferenceSession(model_path, sess_options=options, providers=["CPUExecutionProvider"])
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.max_length = max_length
+        self.batch_size = batch_size
+
+    def score(self, pairs):
+        """Punteggi delle coppie (domanda, passaggio), nello stesso ordine."""
+        queries = [query for query, _ in pairs]
+        passages = [passage for _, passage in pairs]
+        encoded = self.tokenizer(queries, passages, truncation="only_second", max_length=self.max_length)
+        order = sorted(range(len(pairs)), key=lambda i: len(encoded["input_ids"][i]))
+        scores = [0.0] * len(pairs)
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start:start + self.batch_size]
+            longest = max(len(encoded["input_ids"][i]) for i in batch)
+            inputs = {}
+            for name in ("input_ids", "attention_mask", "token_type_ids"):
+                if name not in self.input_names or name not in encoded:
+                    continue
+                pad_value = self.tokenizer.pad_token_id if name == "input_ids" else 0
+                values = np.full((len(batch), longest), pad_value, dtype=np.int64)
+                for row, i in enumerate(batch):
+                    values[row, :len(encoded[name][i])] = encoded[name][i]
+                inputs[name] = values
+            logits = self.session.run(None, inputs)[0][:, 0]
+            for row, i in enumerate(batch):
+                scores[i] = 1 / (1 + math.exp(-float(logits[row])))
+        return scores
+
+
+def content_terms(text):
+    """Parole significative (più di due caratteri, minuscole) di un testo."""
+    return [word for word in re.findall(r"\w+", text.lower()) if len(word) > 2]
+
+
+def best_window(query, text, window_words):
+    """
+    Finestra di `window_words` parole di `text` con più occorrenze dei termini
+    della domanda (passo di mezza finestra); il testo intero se è già corto.
+    """
+    words = text.split()
+    if len(words) <= window_words:
+        return text
+    query_terms = set(content_terms(query))
+    hits = [1 if any(term in query_terms for term in content_terms(word)) else 0 for word in words]
+    # Somme prefisse: conteggio in ogni finestra in tempo costante
+    prefix = np.concatenate([[0], np.cumsum(hits)])
+    step = max(1, window_words // 2)
+    starts = list(range(0, len(words) - window_words + 1, step))
+    if starts[-1] != len(words) - window_words:
+        starts.append(len(words) - window_words)
+    best_start = max(starts, key=lambda start: prefix[start + window_words] - prefix[start])
+    return " ".join(words[best_start:best_start + window_words])
+
+
+class LocalRerank(BaseNodePostprocessor):
+    """
+    Post-processore LlamaIndex che riordina i nodi con il cross-encoder locale
+    e conserva i primi `top_n`. La lunghezza dei passaggi valutati si adatta a
+    `latency_budget_ms` in base alla velocità (token/ms) osservata.
+    """
+
+    top_n: int = Field(default=6)
+    latency_budget_ms: float = Field(default=300)
+    min_window_tokens: int = Field(default=128)
+    max_window_tokens: int = Field(default=480)
+
+    _batcher: DynamicBatcher = PrivateAttr()
+    _tokens_per_ms: float = PrivateAttr()
+    _lock: threading.Lock = PrivateAttr()
+
+    def __init__(self, scorer: CrossEncoderOnnxScorer, max_batch_size: int = 64, max_wait_ms: int = 5,
+                 initial_tokens_per_ms: float = 10.0, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self._batcher = DynamicBatcher(scorer.score, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
+        self._tokens_per_ms = initial_tokens_per_ms
+        self._lock = threading.Lock()
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "LocalRerank"
+
+    def _window_tokens(self, num_nodes):
+        with self._lock:
+            budget_tokens = self.latency_budget_ms * self._tokens_per_ms
+        return int(min(self.max_window_tokens, max(self.min_window_tokens, budget_tokens / max(num_nodes, 1))))
+
+    def _update_speed(self, tokens, elapsed_ms):
+        if elapsed_ms <= 0:
+            return
+        with self._lock:
+            # Media mobile esponenziale: si adatta al carico senza oscillare a ogni chiamata
+            self._tokens_per_ms = 0.8 * self._tokens_per_ms + 0.2 * (tokens / elapsed_ms)
+
+    def _postprocess_nodes(
+        self, nodes: List[NodeWithScore], query_bundle: Optional[QueryBundle] = None
+    ) -> List[NodeWithScore]:
+        if query_bundle is None:
+            raise ValueError("Il reranker richiede la domanda (query_bundle).")
+        if not nodes:
+            return []
+
+        query = query_bundle.query_str
+        window_words = int(self._window_tokens(len(nodes)) / TOKENS_PER_WORD)
+        passages = [
+            best_window(query, node.node.get_content(metadata_mode=MetadataMode.EMBED), window_words)
+            for node in nodes
+        ]
+        started = time.perf_counter()
+        scores = self._batcher.encode([(query, passage) for passage in passages])
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self._update_speed(sum(len(passage.split()) for passage in passages) * TOKENS_PER_WORD, elapsed_ms)
+
+        reranked = [NodeWithScore(node=node.node, score=score) for node, score in zip(nodes, scores)]
+        reranked.sort(key=lambda node: node.score, reverse=True)
+        return reranked[:self.top_n]
+
+
+_rerankers = {}
+_rerankers_lock = threading.Lock()
+
+
+def get_local_reranker(top_n=6, latency_budget_ms=300, **scorer_kwargs):
+    """
+    Restituisce un `LocalRerank` condiviso nel processo (uno per configurazione),
+    così il modello viene caricato una sola volta.
+    """
+    key = (top_n, latency_budget_ms, tuple(sorted(scorer_kwargs.items())))
+    with _rerankers_lock:
+        if key not in _rerankers:
+            _rerankers[key] = LocalRerank(
+                CrossEncoderOnnxScorer(**scorer_kwargs), top_n=top_n, latency_budget_ms=latency_budget_ms
+            )
+        return _rerankers[key]
+
+
+def local_reranker_from_env(top_n):
+    """Configurazione del reranker locale tramite variabili d'ambiente LOCAL_RERANK_*."""
+    num_threads = os.getenv("LOCAL_RERANK_THREADS")
+    return get_local_reranker(
+        top_n=top_n,
+        latency_budget_ms=float(os.getenv("LOCAL_RERANK_LATENCY_BUDGET_MS", 300)),
+        model_name=os.getenv("LOCAL_RERANK_MODEL", DEFAULT_RERANK_MODEL_NAME),
+        model_dir=os.getenv("LOCAL_RERANK_MODEL_DIR", DEFAULT_RERANK_MODEL_DIR),
+        num_threads=int(num_threads) if num_threads else None,
+    )
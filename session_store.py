@@ -0,0 +1,205 @@
+"""
+Archivio delle sessioni di chat, condiviso dal processo e limitato in memoria.
+
+Ogni sessione conserva la cronologia in forma compatta (testo dei messaggi e
+URL delle fonti, mai i nodi) e la memoria del motore di chat, limitata agli
+ultimi turni. Le sessioni inattive da più di `ttl_seconds`, o le meno recenti
+oltre `max_sessions`, vengono rimosse dalla memoria; se è configurato un file
+SQLite la loro cronologia vi viene salvata e ripristinata al ritorno
+dell'utente, altrimenti vengono scartate.
+
+Con `shared=True` (server API con più processi, vedi api_server.py) il file
+SQLite è l'unica copia della cronologia: ogni richiesta rilegge la sessione e
+ogni turno vi viene scritto subito, così un processo qualsiasi può servire
+il turno successivo.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from llama_index.core.base.llms.types import ChatMessage, MessageRole
+from llama_index.core.memory import ChatMemoryBuffer
+
+
+class ChatSession:
+    """
+    Stato di una sessione: `messages` (dizionari con 'role', 'content' e, per
+    l'assistente, 'sources' come lista di URL) e `memory` del motore di chat,
+    ricostruita dai messaggi quando la sessione viene ripristinata.
+    """
+
+    def __init__(self, session_id, messages, history_token_limit):
+        self.session_id = session_id
+        self.messages = messages
+        self.memory = ChatMemoryBuffer.from_defaults(
+            chat_history=[
+                ChatMessage(role=MessageRole(message["role"]), content=message["content"]) for message in messages
+            ],
+            token_limit=history_token_limit,
+        )
+        self.last_access = time.time()
+
+
+class SessionStore:
+    """
+    Sessioni attive in un dizionario LRU con scadenza; `spill_path` (opzionale)
+    è il file SQLite in cui vengono salvate le sessioni rimosse. Thread-safe.
+    """
+
+    def __init__(self, max_sessions=200, ttl_seconds=3600, spill_path=None, spill_ttl_seconds=7 * 24 * 3600,
+                 history_token_limit=8000, max_messages=100, shared=False):
+        if shared and not spill_path:
+            raise ValueError("Le sessioni condivise fra processi richiedono un file SQLite (spill_path).")
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self.spill_ttl_seconds = spill_ttl_seconds
+        self.history_token_limit = history_token_limit
+        self.max_messages = max_messages
+        self.shared = shared
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = None
+        if spill_path:
+            directory = os.path.dirname(spill_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(spill_path, check_same_thread=False, timeout=30)
+            if shared:
+                # Letture concorrenti dei processi mentre uno di essi scrive
+                self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions (session_id TEXT PRIMARY KEY, messages TEXT NOT NULL, updated REAL NOT NULL)"
+            )
+            self._conn.commit()
+
+    def _spill(self, session):
+        if self._conn is None or not session.messages:
+            return
+        with self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO sessions (session_id, messages, updated) VALUES (?, ?, ?)",
+                (session.session_id, json.dumps(session.messages, ensure_ascii=False), session.last_access),
+            )
+            self._conn.execute("DELETE FROM sessions WHERE updated < ?", (time.time() - self.spill_ttl_seconds,))
+
+    def _restore(self, session_id):
+        if self._conn is None:
+            return []
+        with self._conn:
+            row = self._conn.execute("SELECT messages FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+            if row is None:
+                return []
+            if not self.shared:
+                self._conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+        return json.loads(row[0])
+
+    def _evict(self):
+        now = time.time()
+        while self._sessions:
+            session = next(iter(self._sessions.values()))
+            if len(self._sessions) <= self.max_sessions and now - session.last_access <= self.ttl_seconds:
+                break
+            del self._sessions[session.session_id]
+            self._spill(session)
+
+    def get(self, session_id):
+        """Sessione con l'ID indicato: attiva, ripristinata dal file SQLite o nuova."""
+        with self._lock:
+            if self.shared:
+                return ChatSession(session_id, self._restore(session_id), self.history_token_limit)
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = ChatSession(session_id, self._restore(session_id), self.history_token_limit)
+                self._sessions[session_id] = session
+            session.last_access = time.time()
+            self._sessions.move_to_end(session_id)
+            self._evict()
+            return session
+
+    def record_turn(self, session, user_message, answer, sources):
+        """
+        Aggiunge un turno alla cronologia compatta e limita sia la cronologia
+        sia la memoria del motore (che vi ha già scritto il turno).
+        Se durante il turno la sessione è stata rimossa dalla memoria (LRU o
+        scadenza), viene reinserita come la più recente; se nel frattempo è
+        già stata ripristinata da un'altra richiesta, il turno viene aggiunto
+        alla sessione ripristinata.
+        """
+        with self._lock:
+            turn = [
+                {"role": "user", "content": user_message},
+                {"role": "assistant", "content": answer, "sources": list(sources)},
+            ]
+            self._append(session, turn)
+            session.last_access = time.time()
+            if self.shared:
+                self._spill(session)
+                return
+            current = self._sessions.get(session.session_id)
+            if current is None:
+                # Rimossa a metà turno: la copia salvata su SQLite non ha il turno, quella in memoria sì
+                self._sessions[session.session_id] = session
+                self._evict()
+            elif current is not session:
+                current.memory.put_messages([
+                    ChatMessage(role=MessageRole(message["role"]), content=message["content"]) for message in turn
+                ])
+                self._append(current, turn)
+                self._sessions.move_to_end(session.session_id)
+            else:
+                self._sessions.move_to_end(session.session_id)
+
+    def _append(self, session, turn):
+        session.messages.extend(turn)
+        del session.messages[:-self.max_messages]
+        history = session.memory.get_all()
+        if len(history) > self.max_messages:
+            session.memory.set(history[-self.max_messages:])
+
+    def reset(self, session):
+        with self._lock:
+            session.messages.clear()
+            session.memory.reset()
+            if self.shared:
+                with self._conn:
+                    self._conn.execute("DELETE FROM sessions WHERE session_id = ?", (session.session_id,))
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                self._spill(session)
+            self._sessions.clear()
+            if self._conn is not None:
+                self._conn.close()
+
+
+_session_store = None
+_session_store_lock = threading.Lock()
+
+
+def get_session_store():
+    """
+    Archivio unico per processo, configurato da SESSION_MAX_ACTIVE, SESSION_TTL,
+    SESSION_SPILL_FILE (vuoto per disattivare il salvataggio), SESSION_SPILL_TTL,
+    CHAT_HISTORY_TOKEN_LIMIT, SESSION_MAX_MESSAGES e SESSION_SHARED (1 per
+    condividere le sessioni fra più processi tramite il file SQLite).
+    """
+    global _session_store
+    with _session_store_lock:
+        if _session_store is None:
+            _session_store = SessionStore(
+                max_sessions=int(os.getenv("SESSION_MAX_ACTIVE", 200)),
+                ttl_seconds=int(os.getenv("SESSION_TTL", 3600)),
+                spill_path=os.getenv("SESSION_SPILL_FILE", "data/chat_sessions.sqlite") or None,
+                spill_ttl_seconds=int(os.getenv("SESSION_SPILL_TTL", 7 * 24 * 3600)),
+                history_token_limit=int(os.getenv("CHAT_HISTORY_TOKEN_LIMIT", 8000)),
+                max_messages=int(os.getenv("SESSION_MAX_MESSAGES", 100)),
+                shared=os.getenv("SESSION_SHARED", "0") == "1",
+            )
+        return _session_store
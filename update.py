@@ -1,19 +1,21 @@
 # ==============================================================================
 # --- SEZIONE 0: IMPORTAZIONI E CONFIGURAZIONE GLOBALE ---
 # ==============================================================================
+import argparse
+import glob
 import requests
 from bs4 import BeautifulSoup
 import time
 from urllib.parse import urljoin, urlparse, parse_qs, urlencode
-from collections import deque
+from collections import deque, defaultdict, Counter
 import re
 import json
 import hashlib
 import os
 from dotenv import load_dotenv
 import pickle
-import random
-from tqdm import tqdm
+import asyncio
+import uuid
 import io
 from pypdf import PdfReader
 
@@ -27,29 +29,50 @@ from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.common.by import By
 
 # Import per LlamaIndex
-from llama_index.core.schema import Document
+from llama_index.core.schema import Document, MetadataMode, NodeRelationship
 from llama_index.core.node_parser import SentenceSplitter
 from llama_index.core.ingestion import IngestionPipeline
 from llama_index.llms.google_genai import GoogleGenAI
 from llama_index.embeddings.huggingface_api import HuggingFaceInferenceAPIEmbedding
 
 # Import per Qdrant
-from llama_index.core import VectorStoreIndex, StorageContext, Settings
+from llama_index.core import Settings
 from llama_index.vector_stores.qdrant import QdrantVectorStore
-from qdrant_client import QdrantClient
+from qdrant_client import QdrantClient, models
 
 from MCER import MainContentExtractorReader
 from MCE import MainContentExtractor
+from enrichment import EnrichmentCache, enrich_documents_async
+from node_store import NodeStore
+from delta_sync import apply_delta
+from chat_cache import record_index_update
+from qdrant_utils import (
+    create_qdrant_client, delete_documents, delete_points, ensure_payload_indexes, get_alias_target,
+    load_collection_profile, overwrite_payloads, switch_alias, upsert_nodes, validate_collection,
+    collection_has_sparse, hybrid_vector_store_kwargs,
+)
+from embedding_cache import CachedEmbedding, EmbeddingCache
+from local_embedding import local_embedding_from_env
 
 load_dotenv()
 os.environ["GOOGLE_API_KEY"] = os.getenv("GOOGLE_API_KEY")
 os.environ["COHERE_API_KEY"] = os.getenv("COHERE_API_KEY")
 os.environ["HUGGINGFACE_API_KEY"] = os.getenv("HUGGINGFACE_API_KEY")
 
-Settings.embed_model = HuggingFaceInferenceAPIEmbedding(
-    model_name="BAAI/bge-m3", 
-    token=os.getenv("HUGGINGFACE_API_KEY")
-)
+# Cache locale degli embedding: i chunk già incorporati (stesso testo e modello) non
+# vengono ricalcolati
+EMBEDDING_CACHE_DIR = "data/embedding_cache"
+# "api" (HuggingFace Inference API) oppure "local" (bge-m3 ONNX int8 su CPU)
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "api")
+
+if EMBEDDING_BACKEND == "local":
+    base_embed_model = local_embedding_from_env()
+else:
+    base_embed_model = HuggingFaceInferenceAPIEmbedding(
+        model_name="BAAI/bge-m3", 
+        token=os.getenv("HUGGINGFACE_API_KEY")
+    )
+Settings.embed_model = CachedEmbedding(base_embed_model, cache=EmbeddingCache(EMBEDDING_CACHE_DIR))
 Settings.llm = GoogleGenAI(
     model="gemini-2.5-flash-lite",
     temperature=0.2,
@@ -60,20 +83,64 @@ STATE_FILE = "data/page_update_state.json"
 ALL_URLS_FILE = "urls_lists/urls_html_master_list.txt"
 ALL_URLS_PDF_FILE = "urls_lists/urls_pdf_master_list.txt"
 DOWNLOADED_PDF_URLS_FILE = "urls_lists/urls_pdf_downloaded_list.txt"
-NODES_OUTPUT_FILE = "nodes/nodes_metadata_sentence_x16.pkl"
+NODES_OUTPUT_FILE = "nodes/nodes_metadata_sentence_x16.pkl" # Formato precedente, importato una tantum
+NODE_STORE_FILE = "nodes/nodes_metadata_sentence_x16.sqlite"
 NEW_NODES_OUTPUT_FILE = "nodes/nodes_metadata_update.pkl"
 
 QDRANT_URL = os.getenv("QDRANT_URL", "http://qdrant_db:6333")
-QDRANT_COLLECTION_NAME = "diem_chatbot3_v2"
+QDRANT_COLLECTION_NAME = "diem_chatbot3_v2" # Collezione storica, usata finché l'alias non esiste
+# Alias letto dall'app: le ricostruzioni complete creano una collezione versionata
+# (<alias>_<timestamp>) e vi spostano l'alias solo dopo averla validata
+QDRANT_COLLECTION_ALIAS = os.getenv("QDRANT_COLLECTION_ALIAS", "diem_chatbot")
+COLLECTION_HISTORY_FILE = "data/collection_history.json"
+QDRANT_KEEP_COLLECTIONS = int(os.getenv("QDRANT_KEEP_COLLECTIONS", 2)) # Attiva + precedente per il rollback
+REBUILD_NODES_PER_STEP = 5000
+# Profilo delle nuove collezioni: "fp32", "scalar", "binary" oppure un file JSON (vedi qdrant_utils.py)
+QDRANT_COLLECTION_PROFILE = os.getenv("QDRANT_COLLECTION_PROFILE", "scalar")
+# Ricerca ibrida (denso + pesi lessicali di bge-m3): richiede il motore di embedding locale
+QDRANT_HYBRID = os.getenv("QDRANT_HYBRID", "1") == "1" and getattr(base_embed_model, "supports_sparse", False)
+# Scritture in blocco: gRPC, dimensione dei blocchi e numero di upsert in parallelo
+QDRANT_PREFER_GRPC = os.getenv("QDRANT_PREFER_GRPC", "1") == "1"
+QDRANT_GRPC_PORT = int(os.getenv("QDRANT_GRPC_PORT", 6334))
+QDRANT_UPSERT_BATCH_SIZE = int(os.getenv("QDRANT_UPSERT_BATCH_SIZE", 256))
+QDRANT_UPSERT_WORKERS = int(os.getenv("QDRANT_UPSERT_WORKERS", 4))
+# Chiave di metadati/payload con l'hash del testo incorporato di ogni chunk (vedi stamp_embed_hashes)
+EMBED_HASH_KEY = "embed_hash"
 
 # Percorso DELLO STESSO FILE, ma visto DALL'INTERNO del container Qdrant
 SNAPSHOT_FILE_PATH_IN_CONTAINER = "/qdrant/snapshots/migration_snapshot.snapshot"
 # Percorso dello snapshot visto dall'app (per os.path.exists)
 SNAPSHOT_FILE_PATH_IN_APP = "/app/snapshots/migration_snapshot.snapshot"
-
-# Configurazione per l'estrazione metadati
-MIN_DELAY_SECONDS = 1
-MAX_DELAY_SECONDS = 2
+# File delta esportati da migrate.py --delta, applicati in ordine e poi rinominati in '.applied'
+DELTA_FILE_PATTERN_IN_APP = "/app/snapshots/delta_*.jsonl.gz"
+# Scritto quando un delta non si riesce ad applicare: la collezione locale va riallineata
+DELTA_RESYNC_MARKER_IN_APP = "/app/snapshots/delta_resync_required.json"
+
+# Configurazione per l'estrazione metadati (quota del modello Gemini usato)
+ENRICHMENT_REQUESTS_PER_MINUTE = int(os.getenv("ENRICHMENT_REQUESTS_PER_MINUTE", 60))
+ENRICHMENT_TOKENS_PER_MINUTE = int(os.getenv("ENRICHMENT_TOKENS_PER_MINUTE", 250000))
+ENRICHMENT_MAX_CONCURRENCY = int(os.getenv("ENRICHMENT_MAX_CONCURRENCY", 8))
+ENRICHMENT_MAX_RETRIES = int(os.getenv("ENRICHMENT_MAX_RETRIES", 5))
+# Raggruppamento dei documenti brevi in un'unica richiesta (ENRICHMENT_BATCHING=0 per disattivarlo)
+ENRICHMENT_BATCHING = os.getenv("ENRICHMENT_BATCHING", "1") == "1"
+ENRICHMENT_BATCH_MAX_DOC_TOKENS = int(os.getenv("ENRICHMENT_BATCH_MAX_DOC_TOKENS", 1500))
+ENRICHMENT_BATCH_TOKEN_BUDGET = int(os.getenv("ENRICHMENT_BATCH_TOKEN_BUDGET", 12000))
+ENRICHMENT_BATCH_MAX_ITEMS = int(os.getenv("ENRICHMENT_BATCH_MAX_ITEMS", 10))
+# Budget di token per il testo inviato all'LLM: i documenti più lunghi vengono ridotti
+# (inizio + titoli delle sezioni + estratti). Con ENRICHMENT_MAP_REDUCE=1 i documenti
+# enormi vengono prima riassunti per sezioni in parallelo.
+ENRICHMENT_MAX_INPUT_TOKENS = int(os.getenv("ENRICHMENT_MAX_INPUT_TOKENS", 8000))
+ENRICHMENT_MAP_REDUCE = os.getenv("ENRICHMENT_MAP_REDUCE", "0") == "1"
+ENRICHMENT_MAP_REDUCE_THRESHOLD_TOKENS = int(os.getenv("ENRICHMENT_MAP_REDUCE_THRESHOLD_TOKENS", 60000))
+ENRICHMENT_MAP_PART_TOKENS = int(os.getenv("ENRICHMENT_MAP_PART_TOKENS", 6000))
+ENRICHMENT_MAP_MAX_PARTS = int(os.getenv("ENRICHMENT_MAP_MAX_PARTS", 12))
+# Estrazione locale di title (<h1>), years (URL) e keywords (TF-IDF): all'LLM vengono
+# chiesti solo i campi mancanti e i documenti più brevi della soglia non gli vengono inviati
+ENRICHMENT_LOCAL_EXTRACTION = os.getenv("ENRICHMENT_LOCAL_EXTRACTION", "1") == "1"
+ENRICHMENT_MIN_LLM_CHARS = int(os.getenv("ENRICHMENT_MIN_LLM_CHARS", 300))
+ENRICHMENT_KEYWORDS_MIN_CORPUS = int(os.getenv("ENRICHMENT_KEYWORDS_MIN_CORPUS", 20))
+# Cache dei metadati indirizzata per contenuto (hash del testo + versione del prompt)
+ENRICHMENT_CACHE_FILE = "data/enrichment_cache.json"
 
 # Header da inviare per simulare un browser reale
 HEADERS = {
@@ -113,8 +180,13 @@ def restore_snapshot_if_needed():
         collections = client_local.get_collections().collections
         collection_exists = any(c.name == QDRANT_COLLECTION_NAME for c in collections)
         
-        if collection_exists:
+        if get_alias_target(client_local, QDRANT_COLLECTION_ALIAS) is not None or collection_exists:
+            if resync_pending_from_snapshot():
+                # Un delta non è stato applicato: uno snapshot scaricato dopo l'errore riallinea la collezione
+                restore_resync_snapshot(client_local)
+                return
             print(f"La collezione '{QDRANT_COLLECTION_NAME}' esiste già. Nessun ripristino necessario.")
+            get_active_collection(client_local)
             return
 
         print(f"La collezione '{QDRANT_COLLECTION_NAME}' non esiste. Tentativo di ripristino da snapshot...")
@@ -125,7 +197,14 @@ def restore_snapshot_if_needed():
             print("Lo script di aggiornamento ora eseguirà un crawling completo da zero.")
             return
 
-        # 3. Esegui il ripristino
+        # 3. Verifica l'integrità del file prima del ripristino (lento)
+        checksum = verify_snapshot_checksum(SNAPSHOT_FILE_PATH_IN_APP)
+        if checksum is False:
+            print(f"ERRORE: lo snapshot '{SNAPSHOT_FILE_PATH_IN_APP}' è corrotto (checksum non valido). Ripristino annullato.")
+            print("Scaricalo di nuovo con migrate.py. Lo script di aggiornamento ora eseguirà un crawling completo da zero.")
+            return
+
+        # 4. Esegui il ripristino
         print(f"Snapshot trovato. Ripristino di '{QDRANT_COLLECTION_NAME}' in corso...")
         
         location_uri = f"file://{SNAPSHOT_FILE_PATH_IN_CONTAINER}"
@@ -133,14 +212,110 @@ def restore_snapshot_if_needed():
         client_local.recover_snapshot(
             collection_name=QDRANT_COLLECTION_NAME,
             location=location_uri,
+            checksum=checksum,
             wait=True
         )
         print("Ripristino da snapshot completato con successo.")
+        get_active_collection(client_local)
 
     except Exception as e:
         print(f"ERRORE durante il ripristino automatico: {e}")
         print("Il database potrebbe essere vuoto. Il crawler tenterà un'indicizzazione completa.")
 
+def resync_pending_from_snapshot():
+    """True se un delta è fallito (marcatore presente) e dopo l'errore è stato scaricato un nuovo snapshot."""
+    if not (os.path.exists(DELTA_RESYNC_MARKER_IN_APP) and os.path.exists(SNAPSHOT_FILE_PATH_IN_APP)):
+        return False
+    with open(DELTA_RESYNC_MARKER_IN_APP, "r", encoding="utf-8") as f:
+        failed_at = json.load(f).get("failed_at", 0)
+    return os.path.getmtime(SNAPSHOT_FILE_PATH_IN_APP) > failed_at
+
+def restore_resync_snapshot(client):
+    """
+    Ripristina lo snapshot in una nuova collezione versionata e vi sposta l'alias
+    (come una ricostruzione blue/green): la collezione disallineata resta
+    disponibile per il rollback finché non viene eliminata da prune_old_collections.
+    """
+    checksum = verify_snapshot_checksum(SNAPSHOT_FILE_PATH_IN_APP)
+    if checksum is False:
+        print(f"ERRORE: lo snapshot '{SNAPSHOT_FILE_PATH_IN_APP}' è corrotto (checksum non valido). Riallineamento annullato.")
+        return
+    new_collection = f"{QDRANT_COLLECTION_ALIAS}_{time.strftime('%Y%m%d%H%M%S')}"
+    print(f"Riallineamento dopo un delta fallito: ripristino dello snapshot in '{new_collection}'...")
+    client.recover_snapshot(
+        collection_name=new_collection,
+        location=f"file://{SNAPSHOT_FILE_PATH_IN_CONTAINER}",
+        checksum=checksum,
+        wait=True,
+    )
+    activate_collection(client, new_collection)
+    os.remove(DELTA_RESYNC_MARKER_IN_APP)
+    record_index_update(client=client)
+    prune_old_collections(client)
+    print("Riallineamento completato.")
+
+def apply_pending_deltas(delta_paths=None):
+    """
+    Applica alla collezione attiva i file delta (vettori e payload dei punti
+    modificati, tombstone dei punti eliminati) esportati da migrate.py --delta.
+
+    I delta vanno applicati tutti e in ordine: l'esportazione ha già fatto
+    avanzare il manifest oltre ciascuno di essi. Al primo errore ci si ferma,
+    lasciando al loro posto il file fallito e i successivi, e si scrive il
+    marcatore DELTA_RESYNC_MARKER_IN_APP. L'applicazione è idempotente (upsert
+    e eliminazioni per ID): all'esecuzione successiva il file fallito viene
+    riapplicato per intero, anche se in parte era già stato scritto. Se il
+    problema persiste serve un nuovo snapshot completo (migrate.py), che
+    restore_snapshot_if_needed ripristina al posto della collezione attiva.
+    """
+    delta_paths = delta_paths if delta_paths is not None else sorted(glob.glob(DELTA_FILE_PATTERN_IN_APP))
+    if not delta_paths:
+        return
+    client = create_qdrant_client(QDRANT_URL, prefer_grpc=QDRANT_PREFER_GRPC, grpc_port=QDRANT_GRPC_PORT)
+    collection_name = get_active_collection(client)
+    if not client.collection_exists(collection_name=collection_name):
+        print(f"ATTENZIONE: la collezione '{collection_name}' non esiste, i delta non possono essere applicati.")
+        return
+    applied = 0
+    for delta_path in delta_paths:
+        print(f"Applicazione del delta '{delta_path}' a '{collection_name}'...")
+        try:
+            written, deleted = apply_delta(client, collection_name, delta_path, batch_size=QDRANT_UPSERT_BATCH_SIZE)
+        except Exception as e:
+            print(f"ERRORE durante l'applicazione del delta '{delta_path}': {e}")
+            print("La collezione locale non è allineata al cloud: il delta verrà riapplicato alla prossima"
+                  " esecuzione; se l'errore persiste esegui 'python migrate.py' per un nuovo snapshot completo.")
+            with open(DELTA_RESYNC_MARKER_IN_APP, "w", encoding="utf-8") as f:
+                json.dump({"delta": os.path.basename(delta_path), "error": str(e), "failed_at": time.time()}, f)
+            break
+        os.replace(delta_path, delta_path + ".applied")
+        applied += 1
+        print(f"Delta applicato: {written} punti scritti, {deleted} eliminati.")
+    else:
+        if os.path.exists(DELTA_RESYNC_MARKER_IN_APP):
+            os.remove(DELTA_RESYNC_MARKER_IN_APP)
+    if applied:
+        # Il delta non dice quali documenti cambiano: l'app scarta tutte le risposte in cache
+        record_index_update(client=client)
+
+def verify_snapshot_checksum(snapshot_path):
+    """
+    Confronta lo SHA256 dello snapshot con quello salvato da migrate.py (file '.sha256').
+    Restituisce il checksum se valido, None se non disponibile, False se non corrisponde.
+    """
+    checksum_path = snapshot_path + ".sha256"
+    if not os.path.exists(checksum_path):
+        print("ATTENZIONE: checksum dello snapshot non disponibile, verifica saltata.")
+        return None
+    with open(checksum_path, "r", encoding="utf-8") as f:
+        expected = f.read().strip()
+    print("Verifica del checksum dello snapshot...")
+    digest = hashlib.sha256()
+    with open(snapshot_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return expected if digest.hexdigest() == expected else False
+
 def save_to_pickle(data, filepath):
     """Salva qualsiasi oggetto Python in un file pickle."""
     print(f"Salvataggio di {len(data)} oggetti in '{filepath}'...")
@@ -603,7 +778,8 @@ def process_pdfs(url_list_file, url_list_downloaded_file):
                 text=text,
                 metadata={
                     "source_url": url,
-                }
+                },
+                id_=url
             )
             pdf_documents.append(doc)
 
@@ -626,6 +802,7 @@ def process_pdfs(url_list_file, url_list_downloaded_file):
 def enrich_documents_with_metadata(documents):
     """
     Arricchisce una lista di documenti con metadati generati da un LLM.
+    Le richieste vengono eseguite in parallelo, entro i limiti di quota configurati.
     """
     if not documents:
         print("\nFASE 4: Nessun documento da arricchire con metadati.")
@@ -633,60 +810,112 @@ def enrich_documents_with_metadata(documents):
 
     print(f"\nFASE 4: Inizio arricchimento metadati per {len(documents)} documenti...")
 
-    for document in tqdm(documents, desc="Arricchendo documenti"):
-        if not isinstance(document.text, str) or not document.text.strip():
-            continue
-        
-        # Estratto dal tuo codice di estrazione
-        prompt = (
-            "Analizza il seguente documento, inclusa la sua URL di origine, per estrarre i metadati richiesti. "
-            "Fornisci l'output esclusivamente in formato JSON, seguendo la struttura e le regole specificate.\n\n"
-            "--- DOCUMENTO ---\n"
-            f'"""{document.text}"""\n'
-            "--- FINE DOCUMENTO ---\n\n"
-            
-            "REGOLE GENERALI:\n"
-            "- Se il documento è troppo breve o non contiene informazioni sufficienti per generare un campo specifico (title, summary, etc.), lascia quel campo vuoto (es. `\"title\": \"\"` o `\"questions\": []`).\n"
-            "- **Keywords**: Estrai un numero di parole chiave proporzionale alla lunghezza del testo, fino a un massimo di 10. Per documenti molto brevi, poche parole chiave (o nessuna) sono accettabili.\n"
-            "- **Domande**: Genera un numero di domande proporzionale alla lunghezza del testo, fino a un massimo di 3. Per documenti molto brevi, una sola domanda o nessuna sono accettabili.\n\n"
-
-            "REGOLE PER 'years':\n"
-            "- Identifica l'anno o gli anni accademici (es. '2024/2025') o solari (es. '2023') *PRINCIPALI* del documento. Controlla sia il testo che l'URL di origine.\n"
-            "- Se il documento tratta un singolo anno, inserisci solo quello. Esempio: [\"2023\"].\n"
-            "- Se nell'URL è presente il parametro 'anno', considera il suo valore corrispondente come UNICO anno principale, NON considerare il parametro quando 'anno=0'.\n"
-            "- Se tratta più anni, IDENTIFICA QUELLO PRINCIPALE ed inseriscilo, altrimenti inseriscili tutti. Esempio: [\"2022\", \"2023\", \"2024\"].\n"
-            "- Se non riesci ad identificare l'anno principale dal testo, ma è presente nell'URL, usa quello. Esempio: [\"2023\"] se l'URL contiene 'anno=2023' (sempre escludendo il caso in cui sia 'anno=0').\n"
-            "- Se non ha un anno di riferimento, lascia la lista vuota. Esempio: [].\n\n"
-
-            "Formato JSON richiesto:\n"
-            "{\n"
-            '  "title": "Un titolo conciso e descrittivo del documento",\n'
-            '  "summary": "Un riassunto di 2-3 frasi del contenuto principale",\n'
-            '  "questions": [],\n'  # Da 0 a 3 domande in base alla lunghezza del testo
-            '  "keywords": [],\n'   # Da 0 a 10 parole chiave in base alla lunghezza del testo
-            '  "years": []\n'
-            "}\n\n"
-            "Output JSON:"
-        )
-        
-        try:
-            response = Settings.llm.complete(prompt)
-            cleaned_response = response.text.strip().replace("```json", "").replace("```", "").strip()
-            metadata = json.loads(cleaned_response)
-            document.metadata.update(metadata) # Aggiorna direttamente i metadati del documento
-        except Exception as e:
-            print(f"\nErrore durante l'arricchimento del documento {document.metadata.get('source_url', 'N/A')}: {e}")
-        
-        time.sleep(random.uniform(MIN_DELAY_SECONDS, MAX_DELAY_SECONDS))
-        
+    cache = EnrichmentCache(ENRICHMENT_CACHE_FILE)
+    batching = None
+    if ENRICHMENT_BATCHING:
+        batching = {
+            "max_doc_tokens": ENRICHMENT_BATCH_MAX_DOC_TOKENS,
+            "token_budget": ENRICHMENT_BATCH_TOKEN_BUDGET,
+            "max_items": ENRICHMENT_BATCH_MAX_ITEMS,
+        }
+    local_extraction = None
+    node_store = None
+    if ENRICHMENT_LOCAL_EXTRACTION:
+        # Frequenze TF-IDF anche sui documenti già archiviati, non solo su quelli di questa esecuzione
+        node_store = open_node_store(NODE_STORE_FILE, legacy_pickle_filepath=NODES_OUTPUT_FILE)
+        local_extraction = {
+            "min_llm_chars": ENRICHMENT_MIN_LLM_CHARS,
+            "min_corpus_size": ENRICHMENT_KEYWORDS_MIN_CORPUS,
+            "corpus": node_store.iter_document_texts(),
+        }
+    try:
+        asyncio.run(enrich_documents_async(
+            documents,
+            llm=Settings.llm,
+            requests_per_minute=ENRICHMENT_REQUESTS_PER_MINUTE,
+            tokens_per_minute=ENRICHMENT_TOKENS_PER_MINUTE,
+            max_concurrency=ENRICHMENT_MAX_CONCURRENCY,
+            max_retries=ENRICHMENT_MAX_RETRIES,
+            cache=cache,
+            batching=batching,
+            budget={
+                "max_tokens": ENRICHMENT_MAX_INPUT_TOKENS,
+                "map_reduce": ENRICHMENT_MAP_REDUCE,
+                "map_reduce_threshold": ENRICHMENT_MAP_REDUCE_THRESHOLD_TOKENS,
+                "map_part_tokens": ENRICHMENT_MAP_PART_TOKENS,
+                "map_max_parts": ENRICHMENT_MAP_MAX_PARTS,
+            },
+            local_extraction=local_extraction,
+        ))
+    finally:
+        # Salva anche in caso di interruzione, per non perdere le chiamate già pagate
+        cache.save()
+        if node_store is not None:
+            node_store.close()
+
     print("Arricchimento metadati completato.")
     return documents
 
-def create_nodes_from_documents(documents, output_filepath):
+def open_node_store(store_filepath, legacy_pickle_filepath=None):
+    """
+    Apre l'archivio SQLite dei nodi. Alla prima apertura importa i nodi
+    dal vecchio file pickle monolitico, se presente.
+    """
+    node_store = NodeStore(store_filepath)
+    if node_store.is_empty() and legacy_pickle_filepath and os.path.exists(legacy_pickle_filepath) and os.path.getsize(legacy_pickle_filepath) > 0:
+        print(f"Archivio nodi vuoto: importazione una tantum da '{legacy_pickle_filepath}'...")
+        try:
+            imported = node_store.import_pickle(legacy_pickle_filepath)
+            print(f"Importati {imported} nodi in '{store_filepath}'.")
+        except Exception as e:
+            print(f"Errore durante l'importazione di '{legacy_pickle_filepath}': {e}. L'archivio parte vuoto.")
+    return node_store
+
+def assign_stable_node_ids(nodes):
+    """
+    Sostituisce gli ID casuali dei nodi con ID deterministici (UUID5) derivati
+    dall'URL di origine e dall'hash del contenuto del chunk: un chunk invariato
+    mantiene lo stesso ID tra un aggiornamento e l'altro.
+    Aggiorna di conseguenza le relazioni PREVIOUS/NEXT tra nodi adiacenti.
+    """
+    occurrences = Counter()
+    id_mapping = {}
+    for node in nodes:
+        source = node.metadata.get("source_url") or node.ref_doc_id or ""
+        content_hash = get_content_hash(node.get_content(metadata_mode=MetadataMode.NONE))
+        # Chunk identici nello stesso documento vengono distinti dall'occorrenza
+        occurrence = occurrences[(source, content_hash)]
+        occurrences[(source, content_hash)] += 1
+        new_id = str(uuid.uuid5(uuid.NAMESPACE_URL, f"{source}#{content_hash}#{occurrence}"))
+        id_mapping[node.node_id] = new_id
+        node.id_ = new_id
+
+    for node in nodes:
+        for relationship in (NodeRelationship.PREVIOUS, NodeRelationship.NEXT):
+            related = node.relationships.get(relationship)
+            if related is not None and related.node_id in id_mapping:
+                related.node_id = id_mapping[related.node_id]
+    return nodes
+
+def stamp_embed_hashes(nodes):
+    """
+    Generatore: salva nei metadati di ogni nodo l'hash del testo che viene incorporato
+    (MetadataMode.EMBED: testo del chunk più titolo, sommario, parole chiave...).
+    L'ID stabile dipende solo dal testo del chunk: l'hash rivela i chunk con lo
+    stesso testo ma metadati rigenerati, il cui vettore va ricalcolato.
+    """
+    for node in nodes:
+        for excluded_keys in (node.excluded_embed_metadata_keys, node.excluded_llm_metadata_keys):
+            if EMBED_HASH_KEY not in excluded_keys:
+                excluded_keys.append(EMBED_HASH_KEY)
+        node.metadata[EMBED_HASH_KEY] = get_content_hash(node.get_content(metadata_mode=MetadataMode.EMBED))
+        yield node
+
+def create_nodes_from_documents(documents, node_store):
     """
     Prende una lista di documenti arricchiti e li trasforma in nodi.
-    Prima di salvare, rimuove i nodi obsoleti dal file .pkl esistente
-    per evitare duplicati.
+    I nodi vengono salvati nell'archivio per documento: quelli obsoleti dei
+    documenti aggiornati vengono sostituiti, senza riscrivere l'intero corpus.
     """
     if not documents:
         print("\nFASE 5: Nessun documento da trasformare in nodi.")
@@ -698,58 +927,15 @@ def create_nodes_from_documents(documents, output_filepath):
     pipeline = IngestionPipeline(transformations=[sentence_splitter])
     
     # 1. Crea i nuovi nodi
-    new_nodes = pipeline.run(documents=documents, show_progress=True)
+    new_nodes = list(stamp_embed_hashes(assign_stable_node_ids(pipeline.run(documents=documents, show_progress=True))))
     print(f"Creati {len(new_nodes)} nuovi nodi.")
 
-    # 2. Ottieni gli ID dei documenti che stiamo aggiornando
-    doc_ids_to_update = set(doc.id_ for doc in documents if doc.id_)
-    
-    if not doc_ids_to_update:
-        print("ATTENZIONE: I documenti in input non hanno un 'id_'.")
-        print("La rimozione dei duplicati potrebbe fallire. Controllo 'source_url' nei metadati...")
-        # Fallback nel caso in cui l'id_ non sia stato impostato, ma 'source_url' sì
-        doc_ids_to_update = set(doc.metadata.get("source_url") for doc in documents if doc.metadata.get("source_url"))
-        if not doc_ids_to_update:
-            print("ERRORE: Impossibile determinare gli ID dei documenti da aggiornare. L'unione dei nodi conterrà duplicati.")
-            
-    # 3. Carica i nodi esistenti
-    existing_nodes = []
-    if os.path.exists(output_filepath):
-        try:
-            print(f"File '{output_filepath}' esistente. Caricamento nodi...")
-            existing_nodes = load_from_pickle(output_filepath)
-            
-            if not isinstance(existing_nodes, list):
-                print(f"Attenzione: il file '{output_filepath}' non conteneva una lista. Sarà sovrascritto.")
-                existing_nodes = []
-            else:
-                print(f"Caricati {len(existing_nodes)} nodi esistenti.")
-                
-                if doc_ids_to_update:
-                    print(f"Filtraggio dei nodi obsoleti (documenti da aggiornare: {len(doc_ids_to_update)})...")
-                    
-                    filtered_existing_nodes = []
-                    nodes_removed_count = 0
-                    
-                    for node in existing_nodes:
-                        if node.ref_doc_id not in doc_ids_to_update:
-                            filtered_existing_nodes.append(node)
-                        else:
-                            nodes_removed_count += 1
-                            
-                    print(f"Rimossi {nodes_removed_count} nodi obsoleti.")
-                    existing_nodes = filtered_existing_nodes # Sovrascrivi la lista
-
-        except Exception as e:
-            print(f"Errore nel caricamento di '{output_filepath}': {e}. Il file sarà sovrascritto.")
-            existing_nodes = []
-    
-    # 4. Combina i nodi esistenti (filtrati) con i nuovi nodi
-    all_nodes = existing_nodes + new_nodes
-    
-    # 5. Salva la lista completa
-    save_to_pickle(all_nodes, output_filepath)
-    print(f"Salvataggio completato. Totale nodi in '{output_filepath}': {len(all_nodes)}")
+    # 2. Sostituisci i nodi dei documenti aggiornati (upsert per ref_doc_id), anche di quelli
+    #    che ora non producono nodi; come ID valgono sia 'id_' sia 'source_url'
+    updated_doc_ids = {doc.id_ for doc in documents if doc.id_}
+    updated_doc_ids |= {doc.metadata.get("source_url") for doc in documents if doc.metadata.get("source_url")}
+    removed_count = node_store.upsert_documents(new_nodes, document_ids=updated_doc_ids)
+    print(f"Rimossi {removed_count} nodi obsoleti. Totale nodi in '{node_store.filepath}': {node_store.count()}")
 
     # Restituisce solo i nodi appena creati
     return new_nodes
@@ -758,50 +944,235 @@ def create_nodes_from_documents(documents, output_filepath):
 # --- SEZIONE 6: INDICIZZAZIONE SU QDRANT ---
 # ==============================================================================
 
+def fetch_indexed_node_ids(client, collection_name, doc_ids):
+    """
+    Restituisce, per ciascun documento (chiave di payload 'doc_id', la stessa
+    usata da delete_ref_doc), gli ID dei punti già presenti su Qdrant con
+    l'hash del testo incorporato (None per i punti indicizzati senza hash).
+    """
+    indexed_ids = defaultdict(dict)
+    if not doc_ids:
+        return indexed_ids
+
+    scroll_filter = models.Filter(
+        must=[models.FieldCondition(key="doc_id", match=models.MatchAny(any=list(doc_ids)))]
+    )
+    offset = None
+    while True:
+        points, offset = client.scroll(
+            collection_name=collection_name,
+            scroll_filter=scroll_filter,
+            limit=1000,
+            offset=offset,
+            with_payload=["doc_id", EMBED_HASH_KEY],
+            with_vectors=False,
+        )
+        for point in points:
+            indexed_ids[point.payload.get("doc_id")][str(point.id)] = point.payload.get(EMBED_HASH_KEY)
+        if offset is None:
+            break
+    return indexed_ids
+
+def diff_nodes(nodes_to_index, indexed_ids, doc_ids_to_update):
+    """
+    Confronta i nuovi nodi con i punti già indicizzati dei documenti aggiornati.
+    Restituisce (nodi da aggiungere, nodi invariati, ID dei punti da eliminare).
+    Un chunk è invariato solo se anche il testo incorporato (metadati compresi)
+    non è cambiato; altrimenti viene reinserito con lo stesso ID e nuovo vettore.
+    """
+    new_ids = {node.node_id for node in nodes_to_index}
+    embed_hashes = {}
+    for points in indexed_ids.values():
+        embed_hashes.update(points)
+
+    def is_unchanged(node):
+        return node.node_id in embed_hashes and embed_hashes[node.node_id] == node.metadata.get(EMBED_HASH_KEY)
+
+    nodes_to_add = [node for node in nodes_to_index if not is_unchanged(node)]
+    unchanged_nodes = [node for node in nodes_to_index if is_unchanged(node)]
+    ids_to_delete = [
+        point_id
+        for doc_id in doc_ids_to_update
+        for point_id in indexed_ids.get(doc_id, ())
+        if point_id not in new_ids
+    ]
+    return nodes_to_add, unchanged_nodes, ids_to_delete
+
+def make_vector_store(client, collection_name, new_collection=False):
+    """
+    Vector store della collezione: ibrido se abilitato e se la collezione ha (o,
+    se nuova, avrà) il vettore sparso; le collezioni solo dense restano tali fino a un --rebuild.
+    """
+    if QDRANT_HYBRID and (new_collection or not client.collection_exists(collection_name=collection_name)
+                          or collection_has_sparse(client, collection_name)):
+        # Pesi sparsi dalla cache persistente degli embedding: i chunk già visti non ripassano dal modello
+        return QdrantVectorStore(client=client, collection_name=collection_name,
+                                 **hybrid_vector_store_kwargs(Settings.embed_model.encode_sparse))
+    return QdrantVectorStore(client=client, collection_name=collection_name)
+
 def index_nodes_to_qdrant(nodes_to_index, urls_to_delete):
     """
     Indicizza una lista di nodi in una collezione Qdrant.
-    Crea la collezione se non esiste, altrimenti aggiunge i nodi.
+    Crea la collezione se non esiste; altrimenti confronta i chunk dei documenti
+    aggiornati con quelli già indicizzati (tramite gli ID stabili) e aggiunge,
+    elimina o aggiorna solo ciò che è cambiato. Le scritture avvengono a blocchi
+    in parallelo, con un'unica attesa finale.
     """
-    if not nodes_to_index:
+    if not nodes_to_index and not urls_to_delete:
         print("\nFASE 6: Nessun nuovo nodo da indicizzare.")
         return
 
     print(f"\nFASE 6: Inizio indicizzazione di {len(nodes_to_index)} nodi su Qdrant Locale...")
 
     # 1. Connettiti a Qdrant
-    client = QdrantClient(url=QDRANT_URL)
-    vector_store = QdrantVectorStore(client=client, collection_name=QDRANT_COLLECTION_NAME)
+    client = create_qdrant_client(QDRANT_URL, prefer_grpc=QDRANT_PREFER_GRPC, grpc_port=QDRANT_GRPC_PORT)
+    collection_name = get_active_collection(client)
+    vector_store = make_vector_store(client, collection_name)
 
     # 2. Controlla se la collezione esiste già
-    try:
-        # Questo comando fallisce se la collezione non esiste
-        client.get_collection(collection_name=QDRANT_COLLECTION_NAME)
-        collection_exists = True
-        print(f"La collezione '{QDRANT_COLLECTION_NAME}' esiste già. Aggiungo i nuovi nodi.")
-    except Exception:
-        collection_exists = False
-        print(f"La collezione '{QDRANT_COLLECTION_NAME}' non esiste. Verrà creata.")
+    collection_exists = client.collection_exists(collection_name=collection_name)
+    if collection_exists:
+        print(f"La collezione '{collection_name}' esiste già. Aggiungo i nuovi nodi.")
+        # Il profilo completo si applica solo alle nuove collezioni (--rebuild); gli indici anche alle esistenti
+        ensure_payload_indexes(client, collection_name)
+    else:
+        print(f"La collezione '{collection_name}' non esiste. Verrà creata.")
 
     # 3. Indicizza i nodi
+    nodes_to_add = nodes_to_index
     if collection_exists:
-        # Carica l'indice esistente
-        index = VectorStoreIndex.from_vector_store(vector_store)
+        # Documenti aggiornati senza più alcun nodo: eliminati con un unico filtro
+        doc_ids_with_nodes = {node.ref_doc_id for node in nodes_to_index if node.ref_doc_id}
+        stale_doc_ids = set(urls_to_delete) - doc_ids_with_nodes
+
+        # Documenti con nuovi nodi: si confrontano i chunk con quelli già indicizzati
+        indexed_ids = fetch_indexed_node_ids(client, collection_name, doc_ids_with_nodes)
+        nodes_to_add, unchanged_nodes, ids_to_delete = diff_nodes(nodes_to_index, indexed_ids, doc_ids_with_nodes)
+        print(f"Chunk da aggiungere: {len(nodes_to_add)}, invariati: {len(unchanged_nodes)}, da eliminare: {len(ids_to_delete)}"
+              f" (più i chunk di {len(stale_doc_ids)} documenti rimossi).")
+
+        # Solo l'ultima scrittura attende: le precedenti sono applicate prima di essa
+        delete_documents(client, collection_name, stale_doc_ids,
+                         wait=not (ids_to_delete or unchanged_nodes or nodes_to_add))
+        delete_points(client, collection_name, ids_to_delete, wait=not (unchanged_nodes or nodes_to_add))
+
+        # I chunk invariati mantengono il loro vettore: si aggiornano solo i metadati
+        overwrite_payloads(client, vector_store, unchanged_nodes, batch_size=QDRANT_UPSERT_BATCH_SIZE,
+                           wait=not nodes_to_add)
+
+    # Inserisci (e quindi incorpora) solo i chunk nuovi o modificati; crea la collezione se serve
+    upsert_nodes(vector_store, nodes_to_add, Settings.embed_model,
+                 batch_size=QDRANT_UPSERT_BATCH_SIZE, workers=QDRANT_UPSERT_WORKERS,
+                 profile=load_collection_profile(QDRANT_COLLECTION_PROFILE))
+
+    # Le risposte in cache che citano questi documenti non sono più valide
+    updated_urls = {node.metadata.get("source_url") or node.ref_doc_id for node in nodes_to_index}
+    record_index_update(updated_urls | set(urls_to_delete), client=client)
+    print("Indicizzazione su Qdrant completata con successo.")
 
-        # Rimuovi i vecchi nodi corrispondenti agli URL da eliminare
-        doc_ids_to_delete = list(urls_to_delete)
-        for doc_id in tqdm(doc_ids_to_delete, desc="Eliminazione vecchi nodi"):
-            # delete_ref_doc cerca e rimuove tutti i nodi con questo ref_doc_id
-            index.delete_ref_doc(doc_id, delete_from_docstore=True)
+def load_collection_history():
+    """Collezioni su cui è stato spostato l'alias, dalla più vecchia alla più recente."""
+    if os.path.exists(COLLECTION_HISTORY_FILE):
+        with open(COLLECTION_HISTORY_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    return []
 
-        # Inserisci i nuovi nodi
-        index.insert_nodes(nodes_to_index, show_progress=True)
-    else:
-        # Crea l'indice da zero con i nuovi nodi
-        storage_context = StorageContext.from_defaults(vector_store=vector_store)
-        index = VectorStoreIndex(nodes_to_index, storage_context=storage_context, show_progress=True)
-    
-    print("Indicizzazione su Qdrant completata con successo.")
+def save_collection_history(history):
+    os.makedirs(os.path.dirname(COLLECTION_HISTORY_FILE), exist_ok=True)
+    with open(COLLECTION_HISTORY_FILE, "w", encoding="utf-8") as f:
+        json.dump(history, f, indent=2)
+
+def activate_collection(client, collection_name):
+    """Sposta l'alias dell'app sulla collezione indicata e lo registra nella cronologia."""
+    switch_alias(client, QDRANT_COLLECTION_ALIAS, collection_name)
+    history = [name for name in load_collection_history() if name != collection_name]
+    save_collection_history(history + [collection_name])
+    print(f"Alias '{QDRANT_COLLECTION_ALIAS}' -> '{collection_name}'.")
+
+def get_active_collection(client):
+    """
+    Restituisce la collezione a cui punta l'alias dell'app. Se l'alias non esiste
+    ancora viene creato sulla collezione storica (se presente).
+    """
+    collection_name = get_alias_target(client, QDRANT_COLLECTION_ALIAS)
+    if collection_name is None:
+        collection_name = QDRANT_COLLECTION_NAME
+        if client.collection_exists(collection_name=collection_name):
+            activate_collection(client, collection_name)
+    return collection_name
+
+def prune_old_collections(client):
+    """Elimina le collezioni versionate non più tra le ultime QDRANT_KEEP_COLLECTIONS attivate."""
+    keep = set(load_collection_history()[-QDRANT_KEEP_COLLECTIONS:])
+    keep.add(get_alias_target(client, QDRANT_COLLECTION_ALIAS))
+    for collection in client.get_collections().collections:
+        if collection.name.startswith(f"{QDRANT_COLLECTION_ALIAS}_") and collection.name not in keep:
+            print(f"Eliminazione della vecchia collezione '{collection.name}'.")
+            client.delete_collection(collection_name=collection.name)
+
+def rebuild_collection():
+    """
+    Ricostruzione completa (blue/green): indicizza tutti i nodi dell'archivio in
+    una nuova collezione versionata, la valida e vi sposta l'alias dell'app in
+    modo atomico. La collezione attiva continua a servire le query fino allo switch.
+    """
+    print(f"--- AVVIO RICOSTRUZIONE COMPLETA ({time.ctime()}) ---")
+    client = create_qdrant_client(QDRANT_URL, prefer_grpc=QDRANT_PREFER_GRPC, grpc_port=QDRANT_GRPC_PORT)
+    get_active_collection(client)
+    new_collection = f"{QDRANT_COLLECTION_ALIAS}_{time.strftime('%Y%m%d%H%M%S')}"
+    print(f"Nuova collezione: '{new_collection}'.")
+    vector_store = make_vector_store(client, new_collection, new_collection=True)
+    profile = load_collection_profile(QDRANT_COLLECTION_PROFILE)
+    print(f"Profilo della collezione: {QDRANT_COLLECTION_PROFILE} {profile}")
+
+    node_store = open_node_store(NODE_STORE_FILE, legacy_pickle_filepath=NODES_OUTPUT_FILE)
+    indexed, probe_node, step = 0, None, []
+    try:
+        # Anche i nodi salvati prima dell'hash del testo incorporato lo ricevono nel payload
+        for node in stamp_embed_hashes(node_store.iter_nodes()):
+            step.append(node)
+            if len(step) >= REBUILD_NODES_PER_STEP:
+                upsert_nodes(vector_store, step, Settings.embed_model, batch_size=QDRANT_UPSERT_BATCH_SIZE,
+                             workers=QDRANT_UPSERT_WORKERS, profile=profile)
+                probe_node = probe_node or step[0]
+                indexed += len(step)
+                step = []
+        if step:
+            upsert_nodes(vector_store, step, Settings.embed_model, batch_size=QDRANT_UPSERT_BATCH_SIZE,
+                         workers=QDRANT_UPSERT_WORKERS, profile=profile)
+            probe_node = probe_node or step[0]
+            indexed += len(step)
+    finally:
+        node_store.close()
+
+    try:
+        if not indexed:
+            raise ValueError("L'archivio dei nodi è vuoto.")
+        validate_collection(vector_store, indexed, probe_node=probe_node)
+    except Exception as e:
+        print(f"ERRORE: validazione di '{new_collection}' fallita ({e}). L'alias resta invariato.")
+        if client.collection_exists(collection_name=new_collection):
+            client.delete_collection(collection_name=new_collection)
+        return
+
+    activate_collection(client, new_collection)
+    record_index_update(client=client)
+    prune_old_collections(client)
+    print(f"--- RICOSTRUZIONE COMPLETATA: {indexed} nodi ({time.ctime()}) ---")
+
+def rollback_collection():
+    """Riporta l'alias sulla collezione attivata in precedenza."""
+    client = create_qdrant_client(QDRANT_URL, prefer_grpc=QDRANT_PREFER_GRPC, grpc_port=QDRANT_GRPC_PORT)
+    history = load_collection_history()
+    current = get_alias_target(client, QDRANT_COLLECTION_ALIAS)
+    previous = [name for name in history if name != current and client.collection_exists(collection_name=name)]
+    if not previous:
+        print("Nessuna collezione precedente disponibile per il rollback.")
+        return
+    switch_alias(client, QDRANT_COLLECTION_ALIAS, previous[-1])
+    save_collection_history([name for name in history if name != current])
+    record_index_update(client=client)
+    print(f"Rollback: alias '{QDRANT_COLLECTION_ALIAS}' -> '{previous[-1]}'.")
 
 # ==============================================================================
 # --- SEZIONE 7: ESECUZIONE DEL FLUSSO INTEGRATO ---
@@ -811,8 +1182,9 @@ def main_workflow():
     """ Esegue il flusso completo di controllo aggiornamenti e crawling. """
     print(f"--- AVVIO PROCESSO DI AGGIORNAMENTO ({time.ctime()}) ---")
 
-    # 0. Ripristina lo snapshot se necessario
+    # 0. Ripristina lo snapshot se necessario e applica gli eventuali delta
     restore_snapshot_if_needed()
+    apply_pending_deltas()
     
     # 1. Carica la lista master di URL da monitorare
     try:
@@ -867,7 +1239,9 @@ def main_workflow():
     enriched_documents = enrich_documents_with_metadata(newly_processed_documents)
     
     # 7. Crea e salva i nodi
-    new_nodes = create_nodes_from_documents(enriched_documents, NODES_OUTPUT_FILE)
+    node_store = open_node_store(NODE_STORE_FILE, legacy_pickle_filepath=NODES_OUTPUT_FILE)
+    new_nodes = create_nodes_from_documents(enriched_documents, node_store)
+    node_store.close()
     save_to_pickle(new_nodes, NEW_NODES_OUTPUT_FILE)
 
     # 8. Indicizza i nodi su Qdrant
@@ -878,4 +1252,20 @@ def main_workflow():
     print(f"--- PROCESSO DI AGGIORNAMENTO TERMINATO ({time.ctime()}) ---")
 
 if __name__ == "__main__":
-    main_workflow()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Aggiornamento del vector store di AskDIEM.")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="Ricostruisce l'intera collezione in una nuova versione e sposta l'alias.")
+    parser.add_argument("--rollback", action="store_true",
+                        help="Riporta l'alias sulla collezione precedente.")
+    parser.add_argument("--apply-delta", nargs="+", metavar="FILE",
+                        help="Applica i file delta indicati (esportati da migrate.py --delta).")
+    args = parser.parse_args()
+
+    if args.apply_delta:
+        apply_pending_deltas(args.apply_delta)
+    elif args.rollback:
+        rollback_collection()
+    elif args.rebuild:
+        rebuild_collection()
+    else:
+        main_workflow()
\ No newline at end of file